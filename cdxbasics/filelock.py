@@ -8,6 +8,7 @@ from .logger import Logger
 from .verbose import Context
 from .util import datetime, fmt_datetime, fmt_seconds
 from .subdir import SubDir
+from . import perf as perf
 _log = Logger(__file__)
 
 import os
@@ -182,6 +183,7 @@ class FileLock(object):
         assert self._cnt == 0
         self._cnt = 0
 
+        wait_start = time.perf_counter() if perf.is_enabled() else None
         i = 0
         while True:
             self.verbose.write("\r%s: acquire(): locking [%s]... ", self._lid, "windows" if IS_WINDOWS else "linux", end='')
@@ -225,6 +227,9 @@ class FileLock(object):
                 # success
                 self._cnt = 1
                 self.verbose.write("done; lock counter set to 1", head=False)
+                if not wait_start is None:
+                    perf.count("filelock.acquired")
+                    perf.observe("filelock.wait_seconds", time.perf_counter() - wait_start )
                 return self._cnt
 
             if timeout_seconds <= 0:
@@ -240,6 +245,9 @@ class FileLock(object):
 
             time.sleep(timeout_seconds)
 
+        if not wait_start is None:
+            perf.count("filelock.failed")
+            perf.observe("filelock.wait_seconds", time.perf_counter() - wait_start )
         if timeout_seconds == 0:
             self.verbose.write("failed.", head=False)
             if raise_on_fail: raise BlockingIOError(self._filename)
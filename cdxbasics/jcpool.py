@@ -12,8 +12,12 @@ import gc as gc
 from collections import OrderedDict
 from collections.abc import Mapping, Callable, Sequence, Iterable
 import functools as functools
+import os as os
+import time as time
 
 from .verbose import Context, Timer
+from .util import Profiler, active_profiler
+from . import perf as perf
 from .subdir import SubDir
 
 class ParallelContextChannel( Context ):
@@ -130,6 +134,74 @@ class _DictIterator(object):
     def __len__(self):#don't really need that but good to have
         return len(self._jobs)
             
+class _ProfiledResult(object):
+    """ Result of a job together with the profile recorded in its worker process """
+    def __init__(self, result, state : dict ):
+        self.result = result
+        self.state  = state
+
+class _ProfiledF(object):
+    """
+    Wraps a job function such that its execution is recorded as a span by the util.Profiler active in the calling thread.
+    In a worker thread that profiler is activated while the job runs.
+    In a worker process a new profiler records the job and its state is returned with the result.
+    """
+    def __init__(self, f : Callable, profiler : Profiler, root : tuple, pid : int ):
+        self._f        = f
+        self._profiler = profiler
+        self._root     = root
+        self._pid      = pid
+    def __getstate__(self):
+        # the calling profiler is not sent to worker processes
+        state = dict(self.__dict__)
+        state['_profiler'] = None
+        return state
+    def __call__(self, *args, **kwargs):
+        f        = self._f._f if isinstance(self._f, _DIF) else self._f
+        label    = getattr(f, "__qualname__", type(f).__name__)
+        profiler = self._profiler
+        if not profiler is None and self._pid == os.getpid():
+            # same process, e.g. threading
+            with profiler.activate():
+                with profiler._span( label, root=self._root ):
+                    return self._f(*args, **kwargs)
+        profiler = Profiler( trace=True )
+        with profiler.activate():
+            with profiler.span(label):
+                r = self._f(*args, **kwargs)
+        return _ProfiledResult( r, profiler.state() )
+
+def _profiled( profiler : Profiler, root : tuple, results : Iterable ) -> Iterable:
+    """ Merge profiles returned from worker processes into 'profiler' """
+    for r in results:
+        if isinstance(r, _ProfiledResult):
+            profiler.merge( r.state, prefix=root )
+            r = r.result
+        yield r
+
+def _measured( start : float, results : Iterable ) -> Iterable:
+    """
+    Record the number of tasks and, for each result, the time since the jobs were submitted with cdxbasics.perf.
+    This is not the duration of the task: results are generated lazily, hence 'jcpool.time_to_result_seconds' also includes
+    queueing and the time the caller spent on earlier results.
+    """
+    for r in results:
+        perf.count("jcpool.tasks")
+        perf.observe("jcpool.time_to_result_seconds", time.perf_counter() - start )
+        yield r
+
+def _run(pool, jobs : Iterable) -> Iterable:
+    """ Run 'jobs' in 'pool'. If a util.Profiler is active, record each job as a span """
+    start    = time.perf_counter() if perf.is_enabled() else None
+    profiler = active_profiler()
+    if profiler is None:
+        results = pool( jobs )
+    else:
+        root    = profiler.path
+        pid     = os.getpid()
+        results = _profiled( profiler, root, pool( (_ProfiledF(f, profiler, root, pid), args, kwargs) for f, args, kwargs in jobs ) )
+    return results if start is None else _measured( start, results )
+
 def _parallel(pool, jobs : Iterable) -> Iterable:
     """
     Process 'jobs' in parallel using the current multiprocessing pool.
@@ -149,8 +221,8 @@ def _parallel(pool, jobs : Iterable) -> Iterable:
         element equal to the dictionary key of the respective function job.
     """
     if not isinstance(jobs, Mapping):
-        return pool( jobs )
-    return pool( _DictIterator(jobs,merge_tuple=True) )
+        return _run( pool, jobs )
+    return _run( pool, _DictIterator(jobs,merge_tuple=True) )
 
 def _parallel_to_dict(pool, jobs : Mapping) -> Mapping:
     """
@@ -173,7 +245,7 @@ def _parallel_to_dict(pool, jobs : Mapping) -> Mapping:
         with the same order as 'jobs'.
     """
     assert isinstance(jobs, Mapping), ("'jobs' must be a Mapping.", type(jobs))
-    r = dict( pool( _DictIterator(jobs,merge_tuple=False) ) )
+    r = dict( _run( pool, _DictIterator(jobs,merge_tuple=False) ) )
     if isinstance( jobs, OrderedDict ):
         q = OrderedDict()
         for k in jobs:
@@ -259,16 +331,36 @@ class JCPool( object ):
             print("Done")
 
     Note that in this case the function returns after all items have been processed.
+
+    Large results
+    -------------
+    Results are pickled through the result queue. To return large results such as dictionaries of numpy arrays or DataFrames
+    without copying them through the queue, return a cdxbasics.sharedarray.SharedObject( result, transfer=True ) and
+    call get( unlink=True ) on the returned handle.
+
+    Profiling
+    ---------
+    If a cdxbasics.util.Profiler is active, each job is recorded as a span named after its function, nested in the
+    span current when parallel() was called. Spans recorded inside worker processes are merged back into the active profiler:
+
+        profiler = Profiler(trace=True)
+        with profiler.activate():
+            r = pool.parallel_to_list( [ pool.delayed(f)( ticker=ticker, tdata=tdata ) for ticker, tdata in self.data.items() ] )
+        print( profiler.tree() )
     """
     def __init__(self, num_workers      : int = 1,
                        threading        : bool = False,
                        tmp_dir          : str = "!/.cdxmp",  *,
                        verbose          : Context = Context.quiet,
-                       parallel_kwargs  : dict = {} ):
+                       parallel_kwargs  : dict = {},
+                       shared_registry  = None ):
         """
         Initialize a multi-processing pool. Thin wrapper aroud joblib.parallel for cdxbasics.verbose.Context() output
+        If 'shared_registry' is a cdxbasics.sharedarray.SharedMemoryRegistry, terminate() closes it, which unlinks all shared memory blocks
+        with its prefix, including those created by workers.
         """
         num_workers            = int(num_workers)
+        self._shared_registry  = shared_registry
         self._tmp_dir          = SubDir(tmp_dir, ext='')
         self._verbose          = verbose if not verbose is None else Context("quiet")
         self._threading        = threading
@@ -294,6 +386,7 @@ class JCPool( object ):
     def terminate(self):
         """
         Stop the current parallel pool, and delete any temporary files.
+        Closes the 'shared_registry', if any.
         """
         if not self._pool is None:
             tme = Timer()
@@ -302,6 +395,9 @@ class JCPool( object ):
             self._verbose.write(f"Shut down parallel pool. This took {tme}.")
         gc.collect()
         self._tmp_dir.eraseEverything(keepDirectory=True)
+        if not getattr(self, "_shared_registry", None) is None:
+            self._shared_registry.close()
+            self._shared_registry = None
 
     def context( self, verbose : Context, verbose_interval : float = None ):
         """
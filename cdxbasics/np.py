@@ -6,6 +6,11 @@ Hans Buehler 2023
 from .logger import Logger
 import numpy as np
 import math as math
+import os as os
+import sys as sys
+import time as time
+import subprocess as subprocess
+import tempfile as tempfile
 from collections.abc import Mapping
 from cdxbasics.prettydict import PrettyOrderedDict
 
@@ -193,6 +198,99 @@ def err( P : np.ndarray, x : np.ndarray, axis : int = None, keepdims : bool = Fa
     assert np.sum(np.isnan(e)) == 0, "Internal error: %g" % e
     return e
 
+def _weighted_rows( p : np.ndarray, x : np.ndarray, axis : int ) -> tuple:
+    """
+    Returns 'x' and 'p' as returned from _prep_P_and_X() as C-contiguous matrices whose rows are the vectors along 'axis'.
+    The weight matrix has a single row if 'p' is a vector.
+    """
+    n  = x.shape[axis]
+    xm = np.ascontiguousarray( np.reshape( np.moveaxis( x, axis, -1 ), (-1,n) ) )
+    if p.shape == x.shape and p.ndim > 1:
+        pm = np.ascontiguousarray( np.reshape( np.moveaxis( p, axis, -1 ), (-1,n) ), dtype=np.float64 )
+    else:
+        pm = np.ascontiguousarray( np.reshape( p, (1,n) ), dtype=np.float64 )
+    return xm, pm
+
+QUANTILE_BLOCK_SIZE = 1024*1024*4  # number of elements sorted at once by quantile() and median_mad()
+
+def _row_blocks( m : int, n : int, block_size : int = None ):
+    """ Yields slices of rows of a (m,n) matrix with at most 'block_size' elements, but at least one row. Default is QUANTILE_BLOCK_SIZE """
+    rows = max( 1, ( block_size if not block_size is None else QUANTILE_BLOCK_SIZE ) // max(n,1) )
+    for i in range(0, m, rows):
+        yield slice( i, min(i+rows, m) )
+
+@njit(nogil=True, cache=True)
+def _wsorted_row( vec, ixs, pv ):
+    """
+    Returns 'vec' sorted by 'ixs' together with the sorted weights 'pv' and their mid-point cumulative distribution,
+    both normalized to 1.
+    """
+    n   = len(vec)
+    xs  = np.empty( (n,), dtype=np.float64 )
+    ps  = np.empty( (n,), dtype=np.float64 )
+    dst = np.empty( (n,), dtype=np.float64 )
+    c   = 0.
+    for j in range(n):
+        k      = ixs[j]
+        xs[j]  = vec[k]
+        ps[j]  = pv[k]
+        dst[j] = c + 0.5 * ps[j]
+        c      += ps[j]
+    if c != 1. and c > 0.:
+        ps  /= c
+        dst /= c
+    return xs, ps, dst
+
+@njit(parallel=True, cache=True)
+def _wquantile_rows( x, ixs, p, quantiles ):
+    """
+    Weighted quantiles of each row of 'x' with the weights in the matching row of 'p', or its only row.
+    'ixs' are the indices which sort each row of 'x'.
+    Returns a matrix with one column per quantile.
+    """
+    m, n = x.shape
+    r    = np.empty( (m,len(quantiles)), dtype=np.float64 )
+    dp   = 1 if p.shape[0] > 1 else 0
+    for i in prange(m):
+        xs, _, dst = _wsorted_row( x[i], ixs[i], p[i*dp] )
+        r[i,:]     = np.interp( quantiles, dst, xs )
+    return r
+
+@njit(parallel=True, cache=True)
+def _wmedian_mad_rows( x, ixs, p ):
+    """
+    Weighted median and median absolute deviation (without factor) of each row of 'x'.
+    'ixs' are the indices which sort each row of 'x'.
+    The absolute deviations from the median are obtained in sorted order by merging the two halves of the sorted row.
+    """
+    m, n = x.shape
+    med  = np.empty( (m,), dtype=np.float64 )
+    mad  = np.empty( (m,), dtype=np.float64 )
+    half = np.full( (1,), 0.5 )
+    dp   = 1 if p.shape[0] > 1 else 0
+    for i in prange(m):
+        xs, ps, dst = _wsorted_row( x[i], ixs[i], p[i*dp] )
+        md          = np.interp( half, dst, xs )[0]
+        # merge
+        lo  = np.searchsorted( xs, md ) - 1
+        hi  = lo + 1
+        ds  = np.empty( (n,), dtype=np.float64 )
+        c   = 0.
+        for j in range(n):
+            if hi >= n or ( lo >= 0 and md - xs[lo] <= xs[hi] - md ):
+                ds[j] = md - xs[lo]
+                w     = ps[lo]
+                lo    -= 1
+            else:
+                ds[j] = xs[hi] - md
+                w     = ps[hi]
+                hi    += 1
+            dst[j] = c + 0.5 * w
+            c      += w
+        med[i] = md
+        mad[i] = np.interp( half, dst, ds )[0]
+    return med, mad
+
 def quantile( P : np.ndarray, x : np.ndarray, quantiles : np.ndarray, axis : int = None, keepdims : bool = False ) -> np.ndarray:
     """
     Compute P-weighted quantiles of 'x'
@@ -226,18 +324,12 @@ def quantile( P : np.ndarray, x : np.ndarray, quantiles : np.ndarray, axis : int
         x = x.flatten() if axis is None else x
         return np.quantile( x, quantiles, axis if not axis is None else -1, keepdims=keepdims )
     p, x, axis = _prep_P_and_X( P, x, axis )
-    p = p.flatten()
-
-    def pfunc( vec, *args, **kwargs ):
-        assert len(vec) == len(p), ("Internal error", len(vec), len(p) )
-        ixs      = np.argsort( vec )
-        vec      = vec[ixs]
-        dst      = np.cumsum( p[ixs] )
-        dst[1:]  = 0.5 * ( dst[1:] + dst[:-1] )
-        dst[0]   = dst[0] / 2.
-        return np.interp( quantiles, dst, vec, left=vec[0], right=vec[-1] )
-
-    r = np.apply_along_axis( pfunc, axis, x )
+    xm, pm     = _weighted_rows( p, x, axis )
+    quantiles  = quantiles.astype(np.float64)
+    r          = np.empty( (xm.shape[0], len(quantiles)), dtype=np.float64 )
+    for rows in _row_blocks( *xm.shape ):
+        r[rows] = _wquantile_rows( xm[rows], np.argsort( xm[rows], axis=-1 ), pm[rows] if pm.shape[0] > 1 else pm, quantiles )
+    r          = np.moveaxis( np.reshape( r, np.moveaxis(x,axis,-1).shape[:-1] + (len(quantiles),) ), -1, axis )
     if not keepdims and len(quantiles) == 1:
         if len(r.shape) == 0:
             r = r[0]
@@ -299,9 +391,131 @@ def mad( P : np.ndarray, x : np.ndarray, axis : int = None, keepdims : bool = Fa
     -------
         Median matrix
     """
-    med = median( P, x, axis=axis,keepdims=True )
-    mad = median( P, np.abs( x - med ), axis=axis, keepdims=keepdims )
-    return mad * factor
+    if P is None:
+        med = median( P, x, axis=axis,keepdims=True )
+        mad = median( P, np.abs( x - med ), axis=axis, keepdims=keepdims )
+        return mad * factor
+    return median_mad( P, x, axis=axis, keepdims=keepdims, factor=factor )[1]
+
+def median_mad( P : np.ndarray, x : np.ndarray, axis : int = None, keepdims : bool = False, factor : float = 1.4826 ) -> tuple:
+    """
+    Compute the P-weighted median and median absolute deviation of 'x' at once, see median() and mad().
+    Each vector along 'axis' is only sorted once.
+
+    Parameters
+    ----------
+        P : vector
+            Density for 'x'. Must not be negative, and should sum up to 1 (will be normalized to 1 automatically)
+        x : tensor
+            Array of data.
+        axis : int
+            Axis to compute along. See np.median().
+            If axis is a valid axis descriptior, then x.shape[axis] must be qual to len(P).
+            If axis is None, then 'x' will be flattened, and P's length must match the length of the flattened x
+        keepdims : bool
+            If True, then the returned arrays' dimension 'axis' will be equal to 1.
+            If False, then the returned arrays will have one less dimension
+        factor : float
+            Multiplicative factor for MAD, with default 1.4826
+    Returns
+    -------
+        Tuple of median and MAD matrices
+    """
+    if P is None:
+        med = median( P, x, axis=axis,keepdims=True )
+        mad = median( P, np.abs( x - med ), axis=axis, keepdims=keepdims )
+        return ( med if keepdims else np.squeeze( med, axis=axis if not axis is None else None ) ), mad * factor
+    p, x, axis = _prep_P_and_X( P, x, axis )
+    xm, pm     = _weighted_rows( p, x, axis )
+    med        = np.empty( (xm.shape[0],), dtype=np.float64 )
+    mad        = np.empty( (xm.shape[0],), dtype=np.float64 )
+    for rows in _row_blocks( *xm.shape ):
+        med[rows], mad[rows] = _wmedian_mad_rows( xm[rows], np.argsort( xm[rows], axis=-1 ), pm[rows] if pm.shape[0] > 1 else pm )
+    shape      = list(x.shape)
+    if keepdims:
+        shape[axis] = 1
+    else:
+        del shape[axis]
+    return np.reshape( med, shape ), np.reshape( mad, shape ) * factor
+
+def _bin_edges( bins, n : int ) -> np.ndarray:
+    """ Returns the index boundaries of 'bins' for a vector of length 'n'. See mean_bins() """
+    if isinstance(bins, (int,np.integer)):
+        _log.verify( bins > 0, "'bins' must be positive. Found %ld", bins )
+        return np.linspace(0, n, int(bins)+1, endpoint=True, dtype=np.int64)
+    edges = np.asarray( bins )
+    _log.verify( len(edges.shape) == 1 and len(edges) >= 2, "'bins' must be an integer or a vector of at least two bin edges. Found shape %s", edges.shape )
+    _log.verify( np.issubdtype( edges.dtype, np.integer ), "'bins' edges must be integer indices. Found dtype %s", edges.dtype )
+    _log.verify( edges[0] >= 0 and edges[-1] <= n and np.all( edges[1:] >= edges[:-1] ), "'bins' edges must be non-decreasing indices between 0 and %ld", n )
+    return edges.astype(np.int64)
+
+def _prep_bins( x : np.ndarray, bins, axis : int, P : np.ndarray ) -> tuple:
+    """ Prepare data for mean_bins() and mean_std_bins() """
+    x = np.asarray(x)
+    if axis is None:
+        x    = x.flatten()
+        P    = np.asarray(P).flatten() if not P is None else None
+        axis = 0
+    _log.verify( -len(x.shape) <= axis < len(x.shape), "Invalid axis %ld for 'x' with shape %s", axis, x.shape )
+    axis  = axis % len(x.shape)
+    n     = x.shape[axis]
+    edges = _bin_edges( bins, n )
+    if not P is None:
+        P = np.asarray(P)
+        _log.verify( P.shape == (n,), "'P' must be a vector of the same length as axis %ld of 'x'. Found shape %s and %ld", axis, P.shape, n )
+        _log.verify( np.min(P) >= 0., "'P' cannot have negative members. Found element %g", np.min(P) )
+    dtype = x.dtype if np.issubdtype( x.dtype, np.floating ) else np.float64
+    return x, edges, axis, P, dtype
+
+@njit(parallel=True, cache=True)
+def _bin_moments( x, p, edges, weighted ):
+    """
+    Mean and standard deviation of each bin [edges[b],edges[b+1]) along the first axis of the matrix 'x',
+    weighted with 'p' if 'weighted' is True.
+    Computed in a single pass with sums shifted by the first element of each bin, accumulated in float64.
+    Bins without weight are nan.
+    """
+    nb   = len(edges)-1
+    m    = x.shape[1]
+    mean = np.full( (nb,m), np.nan )
+    std  = np.full( (nb,m), np.nan )
+    for b in prange(nb):
+        s = edges[b]
+        e = edges[b+1]
+        if e <= s:
+            continue
+        sw  = 0.
+        sx  = np.zeros( (m,) )
+        sxx = np.zeros( (m,) )
+        k   = np.empty( (m,) )
+        for i in range(m):
+            k[i] = x[s,i]
+        for j in range(s,e):
+            w   = p[j] if weighted else 1.
+            sw += w
+            for i in range(m):
+                d       = x[j,i] - k[i]
+                sx[i]  += w*d
+                sxx[i] += w*d*d
+        if sw <= 0.:
+            continue
+        for i in range(m):
+            mu        = sx[i] / sw
+            mean[b,i] = k[i] + mu
+            std[b,i]  = math.sqrt( max( sxx[i] / sw - mu*mu, 0. ) )
+    return mean, std
+
+def _mean_std_bins( x : np.ndarray, edges : np.ndarray, axis : int, P : np.ndarray, dtype ) -> tuple:
+    """ Calls _bin_moments() along 'axis' of 'x' and returns means and standard deviations with 'axis' replaced by the bins """
+    xm         = np.moveaxis( x, axis, 0 )
+    shape      = xm.shape
+    xm         = np.reshape( xm, (shape[0],-1) )
+    p          = P if not P is None else np.zeros( (0,), dtype=np.float64 )
+    mean, std  = _bin_moments( xm, p, edges, not P is None )
+    shape      = (len(edges)-1,) + shape[1:]
+    mean       = np.moveaxis( np.reshape( mean, shape ), 0, axis ).astype( dtype, copy=False )
+    std        = np.moveaxis( np.reshape( std, shape ), 0, axis ).astype( dtype, copy=False )
+    return mean, std
 
 def mean_bins( x : np.ndarray, bins : int, axis : int = None, P : np.ndarray = None ) -> np.ndarray:
     """
@@ -317,55 +531,77 @@ def mean_bins( x : np.ndarray, bins : int, axis : int = None, P : np.ndarray = N
 
     Parameters
     ----------
-        x : vector
-        bins : int
-            Number of bins
-        weights : vector
-            Sample weights or zero for unit weights
-        return_std : bool
-            If true, function returns a tuple of means and std devs
+        x : tensor
+        bins : int or vector
+            Number of bins of (almost) equal size, or a non-decreasing vector of indices of the bin edges along 'axis':
+            bin i contains the elements edges[i] to edges[i+1]-1.
+            To bin a sorted vector by values use np.searchsorted( x, value_edges ).
+        axis : int
+            Axis along which to bin. If None, then 'x' is flattened.
+        P : vector
+            Sample weights along 'axis', or None for unit weights. Weights are normalized per bin.
     Returns
     -------
-        Numpy array of length bins
+        Numpy array with the dimension of 'axis' replaced by the bins.
+        The result has the dtype of 'x' if it is a floating point type, and float64 otherwise.
+        Empty bins are nan.
     """
-    ixs = np.linspace(0, len(x), bins+1, endpoint=True, dtype=np.int32)
-    if P is None:
-        return np.asarray( np.mean( x[ixs[i]:ixs[i+1]], axis=axis ) for i in range(len(ixs)-1))
-    return np.asarray( mean( P[ixs[i]:ixs[i+1]], x[ixs[i]:ixs[i+1]], axis=axis ) for i in range(len(ixs)-1))
+    x, edges, axis, P, dtype = _prep_bins( x, bins, axis, P )
+    if not P is None:
+        return _mean_std_bins( x, edges, axis, P, dtype )[0]
+    # unweighted: sum in float64 without copying 'x'
+    n      = x.shape[axis]
+    counts = np.diff( edges )
+    if n == 0:
+        shape       = list(x.shape)
+        shape[axis] = len(counts)
+        return np.full( shape, np.nan, dtype=dtype )
+    # reduceat() over the starts of non-empty bins only: empty bins would otherwise cut short the preceding bin
+    nonempty    = counts > 0
+    starts      = edges[:-1][nonempty]
+    shape       = list(x.shape)
+    shape[axis] = len(counts)
+    sums        = np.zeros( shape, dtype=np.float64 )
+    if len(starts) > 0:
+        index   = starts if edges[-1] >= n else np.append( starts, edges[-1] )
+        sums[ (slice(None),)*axis + (nonempty,) ] = np.take( np.add.reduceat( x, index, axis=axis, dtype=np.float64 ), np.arange(len(starts)), axis=axis )
+    shape       = [1]*len(x.shape)
+    shape[axis] = len(counts)
+    counts      = np.reshape( counts, shape )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means   = np.where( counts > 0, sums / np.maximum( counts, 1 ), np.nan )
+    return means.astype( dtype, copy=False )
 
 def mean_std_bins( x : np.ndarray, bins : int, axis : int = None, P : np.ndarray = None ) -> np.ndarray:
     """
-    Return a vector of 'bins' means of x.
-    Bins the vector 'x' into 'bins' bins, then computes the mean of each bin, and returns the resulting vector of length 'bins'.
+    Return a vector of 'bins' means and standard deviations of x.
+    Bins the vector 'x' into 'bins' bins, then computes the mean and standard deviation of each bin in a single pass.
 
     Typical use case is computing the mean over percentiles, e.g.
 
         x = np.sort(x)
-        b = mean_bins(x, 9)
+        b, s = mean_std_bins(x, 9)
 
     The resulting 'b' essentially represents E[X|ai<X<ai+1] with ai = ith/10 percentile
 
     Parameters
     ----------
-        x : vector
-        bins : int
-            Number of bins
-        weights : vector
-            Sample weights or zero for unit weights
-        return_std : bool
-            If true, function returns a tuple of means and std devs
+        x : tensor
+        bins : int or vector
+            Number of bins of (almost) equal size, or a non-decreasing vector of indices of the bin edges along 'axis':
+            bin i contains the elements edges[i] to edges[i+1]-1.
+        axis : int
+            Axis along which to bin. If None, then 'x' is flattened.
+        P : vector
+            Sample weights along 'axis', or None for unit weights. Weights are normalized per bin.
     Returns
     -------
-        Tuple of numpy arrays of length bins
+        Tuple of numpy arrays with the dimension of 'axis' replaced by the bins.
+        The results have the dtype of 'x' if it is a floating point type, and float64 otherwise.
+        Empty bins are nan.
     """
-    ixs = np.linspace(0, len(x), bins+1, endpoint=True, dtype=np.int32)
-    if P is None:
-        means = np.asarray( np.mean( x[ixs[i]:ixs[i+1]], axis=axis) for i in range(len(ixs)-1))
-        stds  = np.asarray( np.std( x[ixs[i]:ixs[i+1]], axis=axis) for i in range(len(ixs)-1))
-    else:
-        means = np.asarray( mean( P[ixs[i]:ixs[i+1]], x[ixs[i]:ixs[i+1]], axis=axis) for i in range(len(ixs)-1))
-        stds  = np.asarray( std( P[ixs[i]:ixs[i+1]], x[ixs[i]:ixs[i+1]], axis=axis) for i in range(len(ixs)-1))
-    return means, stds
+    x, edges, axis, P, dtype = _prep_bins( x, bins, axis, P )
+    return _mean_std_bins( x, edges, axis, P, dtype )
 
 # ------------------------------------------------
 # Black Scholes
@@ -453,7 +689,8 @@ def np_european(   *,
                        voltheta
                        dfrho
     """
-    if norm is None: raise ModuleNotFoundError("scipy")
+    if norm is None:
+        return nb_european( ttm=ttm, vols=vols, K=K, cp=cp, DF=DF, F=F, price_only=price_only, price_eps=price_eps )
 
     # ensure we can handle inactive options
     assert np.min( ttm ) >= 0., ("European error: 'ttm' cannot be negative; found", np.min(ttm))
@@ -520,11 +757,312 @@ def np_european(   *,
                        voltheta=voltheta,
                        dfrho=dfrho)
 
+EUROPEAN_CHUNK_SIZE = 1024*64  # number of options priced at once by nb_european()
+EUROPEAN_GREEKS     = ("vega", "fdelta", "fgamma", "voltheta", "dfrho")
+
+_EUROPEAN_ERRORS = {
+    1 : "'ttm' cannot be negative",
+    2 : "'vols' cannot be negative",
+    3 : "'K' must be positive",
+    4 : "'cp' must be +1 (call) or -1 (put)",
+    5 : "'DF' must be positive",
+    6 : "'F' must be positive",
+    7 : "NaN's returned. Check the inputs",
+    8 : "price is below intrinsic by more than 'price_eps'",
+    }
+
+@njit(parallel=True, nogil=True, cache=True)
+def _european_kernel( ttm, vols, K, cp, DF, F, price_eps, price, vega, fdelta, fgamma, voltheta, dfrho ):
+    """
+    Fused kernel for nb_european(). All inputs and outputs are vectors of the same length, except greeks which
+    are not required which have length zero.
+    Returns zero, or the largest error code of _EUROPEAN_ERRORS.
+    """
+    want_vega     = len(vega) > 0
+    want_fdelta   = len(fdelta) > 0
+    want_fgamma   = len(fgamma) > 0
+    want_voltheta = len(voltheta) > 0
+    want_dfrho    = len(dfrho) > 0
+    sqrt2         = math.sqrt(2.)
+    sqrt2pi       = math.sqrt(2.*math.pi)
+    err           = 0
+    for i in prange(len(price)):
+        t  = float(ttm[i])
+        v  = float(vols[i])
+        k  = float(K[i])
+        c  = float(cp[i])
+        df = float(DF[i])
+        f  = float(F[i])
+        code = 0
+        if not t >= 0.:
+            code = 1
+        elif not v >= 0.:
+            code = 2
+        elif not k > 0.:
+            code = 3
+        elif not abs(c)-1. < 1E-12:
+            code = 4
+        elif not df > 0.:
+            code = 5
+        elif not f > 0.:
+            code = 6
+        if code > 0:
+            err = max( err, code )
+            continue
+
+        intrinsic = max( df*c*( f - k ), 0. )
+        is_intr   = t*v*v < 1E-8
+        p  = intrinsic
+        N1 = 0.
+        n1 = 0.
+        sq = 0.
+        if not is_intr:
+            sq  = math.sqrt( t )
+            r   = - math.log( df ) / t
+            e   = math.log( f / k )
+            d1  = ( e + r * t + 0.5 * v * v * t ) / ( v*sq )
+            d2  = ( e + r * t - 0.5 * v * v * t ) / ( v*sq )
+            N1  = 0.5 * math.erfc( - d1 / sqrt2 )
+            N2  = 0.5 * math.erfc( - d2 / sqrt2 )
+            n1  = math.exp( - 0.5 * d1 * d1 ) / sqrt2pi
+            p   = df * ( f * N1 - k * N2 - 0.5 * (1. - c) * ( f - k ) )
+            if not math.isfinite(p):
+                err = max( err, 7 )
+                continue
+            if p - intrinsic < -price_eps:
+                err = max( err, 8 )
+            if p < intrinsic:
+                is_intr = True
+        if is_intr:
+            price[i] = intrinsic
+            if want_vega:
+                vega[i] = 0.
+            if want_fdelta:
+                fdelta[i] = ( df if f>k else 0. ) if c > 0. else ( -df if f<k else 0. )
+            if want_fgamma:
+                fgamma[i] = 0.
+            if want_voltheta:
+                voltheta[i] = 0.
+            if want_dfrho:
+                dfrho[i] = intrinsic/df
+            continue
+        price[i] = p
+        gamma    = df * n1 / ( f * v * sq )
+        if want_vega:
+            vega[i] = df * f * n1 * sq
+        if want_fdelta:
+            fdelta[i] = df * ( N1 - 0.5 * (1. - c) )
+        if want_fgamma:
+            fgamma[i] = gamma
+        if want_voltheta:
+            voltheta[i] = - 0.5 * gamma * f * f * v * v * t
+        if want_dfrho:
+            dfrho[i] = p / df
+    return err
+
+def nb_european(   *,
+                   ttm  : np.ndarray,
+                   vols : np.ndarray,
+                   K    : np.ndarray,
+                   cp   : np.ndarray,
+                   DF   : np.ndarray = 1.,
+                   F    : np.ndarray = 1.,
+                   price_only : bool = False,
+                   price_eps  : float = 1E-4,
+                   greeks     : list = None,
+                   dtype      : type = np.float64,
+                   out        : dict = None,
+                   chunk_size : int = None ) -> dict:
+    """
+    European option pricer with the same conventions and results as np_european(), computed with a fused numba kernel.
+    Price and greeks are computed in one pass over the broadcasted inputs, in chunks of 'chunk_size' options,
+    without temporary arrays and without scipy.
+
+    Parameters
+    ----------
+        ttm, vols, K, cp, DF, F, price_only, price_eps :
+            See np_european()
+        greeks : list
+            Names of the greeks to compute, from EUROPEAN_GREEKS. None for all greeks.
+        dtype : type
+            dtype of the results, e.g. np.float32. Calculations are performed in float64.
+        out : dict
+            Optional output buffers for "price" and any greeks. Each must have the broadcasted shape of the inputs.
+            Buffers with a dtype different from 'dtype' are filled by casting.
+        chunk_size : int
+            Number of options processed at once. Default is EUROPEAN_CHUNK_SIZE
+
+    Returns
+    -------
+    Price if price_only is True, otherwise dictionary with price and the selected greeks
+    """
+    assert price_eps >= 0., ("European error: 'price_eps' must not be negative; found", price_eps )
+    greeks = () if price_only else ( EUROPEAN_GREEKS if greeks is None else tuple(greeks) )
+    for g in greeks:
+        _log.verify( g in EUROPEAN_GREEKS, "Unknown greek '%s'. Must be one of %s", g, EUROPEAN_GREEKS )
+    out    = dict(out) if not out is None else {}
+    for g in out:
+        _log.verify( g == "price" or g in greeks, "'out' contains buffer '%s' which is not computed", g )
+    inputs = [ np.asarray(_) for _ in (ttm, vols, K, cp, DF, F) ]
+    shape  = np.broadcast_shapes( *[ _.shape for _ in inputs ] )
+    names  = ("price",) + greeks
+    for g in names:
+        if g in out:
+            _log.verify( isinstance(out[g], np.ndarray) and out[g].shape == shape, "'out[%s]' must be a numpy array of shape %s", g, shape )
+        else:
+            out[g] = np.empty( shape, dtype=dtype )
+
+    chunk_size = chunk_size if not chunk_size is None else EUROPEAN_CHUNK_SIZE
+    empty      = np.zeros( (0,), dtype=np.float64 )
+    it         = np.nditer( inputs + [ out[g] for g in names ],
+                            flags=["external_loop", "buffered", "zerosize_ok", "refs_ok"],
+                            op_flags=[["readonly"]]*len(inputs) + [["writeonly"]]*len(names),
+                            op_dtypes=[np.float64]*len(inputs) + [np.float64]*len(names),
+                            casting="same_kind",
+                            buffersize=chunk_size )
+    with it:
+        for ops in it:
+            res = dict( zip( names, ops[len(inputs):] ) )
+            err = _european_kernel( *ops[:len(inputs)], float(price_eps), res["price"], *[ res.get(g, empty) for g in EUROPEAN_GREEKS ] )
+            assert err == 0, ("European error:", _EUROPEAN_ERRORS.get(err, err))
+
+    if price_only:
+        return out["price"]
+    return PrettyOrderedDict( **{ g : out[g] for g in names } )
+
+@njit(nogil=True, cache=True)
+def _european_total_vol_value( s, e, F, K ):
+    """ Returns the undiscounted call value F N(d1) - K N(d2) and its derivative with respect to total volatility 's' as used in np_european() """
+    if s <= 0.:
+        return ( F - K if e > 0. else 0. ), 0.
+    sqrt2 = math.sqrt(2.)
+    d1    = ( e + 0.5 * s * s ) / s
+    d2    = ( e - 0.5 * s * s ) / s
+    n1    = math.exp( - 0.5 * d1 * d1 )
+    n2    = math.exp( - 0.5 * d2 * d2 )
+    value = F * 0.5 * math.erfc( - d1 / sqrt2 ) - K * 0.5 * math.erfc( - d2 / sqrt2 )
+    dvds  = ( F * n1 * ( 0.5 - e / ( s*s ) ) + K * n2 * ( 0.5 + e / ( s*s ) ) ) / math.sqrt( 2.*math.pi )
+    return value, dvds
+
+@njit(parallel=True, nogil=True, cache=True)
+def _implied_vol_kernel( price, ttm, K, cp, DF, F, tol, max_iter, vols, converged, iterations ):
+    """
+    Kernel for nb_implied_vol(). All arguments are vectors of the same length.
+    Solves for total volatility s=vol*sqrt(ttm) with Newton steps, safeguarded by bisection within a bracket of the root.
+    """
+    for i in prange(len(price)):
+        t  = float(ttm[i])
+        k  = float(K[i])
+        c  = float(cp[i])
+        df = float(DF[i])
+        f  = float(F[i])
+        vols[i]       = np.nan
+        converged[i]  = False
+        iterations[i] = 0
+        if not ( t >= 0. and k > 0. and df > 0. and f > 0. and abs(c)-1. < 1E-12 ):
+            continue
+        # undiscounted call value including the drift from DF used by np_european()
+        target = float(price[i]) / df + 0.5 * (1. - c) * ( f - k )
+        e      = math.log( f / k ) - math.log( df )
+        lower  = f - k if e > 0. else 0.
+        if abs( target - lower ) <= tol:
+            vols[i]      = 0.
+            converged[i] = True
+            continue
+        if t <= 0. or not ( lower < target < f ):
+            continue
+
+        # closed form initial guess of Corrado and Miller
+        h  = target - 0.5 * ( f - k )
+        s  = math.sqrt( 2.*math.pi ) / ( f + k ) * ( h + math.sqrt( max( h*h - ( f - k )**2 / math.pi, 0. ) ) )
+        s  = s if s > 1E-8 and math.isfinite(s) else 0.2*math.sqrt(t)
+        lo = 0.
+        hi = math.inf
+        for it in range(max_iter):
+            value, dvds = _european_total_vol_value( s, e, f, k )
+            diff        = value - target
+            iterations[i] = it+1
+            if abs(diff) <= tol:
+                converged[i] = True
+                break
+            if diff > 0.:
+                hi = s
+            else:
+                lo = s
+            step = s - diff / dvds if dvds > 0. else -1.
+            if lo < step < hi:
+                s = step
+            elif hi < math.inf:
+                s = 0.5 * ( lo + hi )
+            else:
+                s = 2. * s
+            if hi < math.inf and hi - lo <= 1E-15 * hi:
+                converged[i] = True
+                break
+        vols[i] = s / math.sqrt(t)
+
+def nb_implied_vol( *,
+                   price : np.ndarray,
+                   ttm   : np.ndarray,
+                   K     : np.ndarray,
+                   cp    : np.ndarray,
+                   DF    : np.ndarray = 1.,
+                   F     : np.ndarray = 1.,
+                   tol        : float = 1E-12,
+                   max_iter   : int = 50,
+                   return_info : bool = False,
+                   chunk_size : int = None ):
+    """
+    Implied volatilities for European option prices, i.e. the inverse of np_european() and nb_european() with respect to 'vols'.
+    Inputs are broadcasted and solved in parallel in chunks, with one numba compiled Newton solver per option which
+    starts from the closed form approximation of Corrado and Miller and falls back to bisection whenever a step
+    leaves the bracket of the solution.
+
+    Prices at intrinsic value, up to 'tol', have zero volatility. Prices below intrinsic value, or at or above the forward
+    value, and invalid inputs, have no solution and return NaN.
+
+    Parameters
+    ----------
+        price : option prices
+        ttm, K, cp, DF, F :
+            See np_european()
+        tol : float
+            Absolute tolerance for the undiscounted price
+        max_iter : int
+            Maximum number of iterations per option
+        return_info : bool
+            If True, return a dictionary with 'vols', the boolean mask 'converged' and the number of 'iterations' per option
+        chunk_size : int
+            Number of options processed at once. Default is EUROPEAN_CHUNK_SIZE
+
+    Returns
+    -------
+        Implied volatilities, or a dictionary if 'return_info' is True
+    """
+    _log.verify( tol > 0., "'tol' must be positive. Found %g", tol )
+    _log.verify( max_iter > 0, "'max_iter' must be positive. Found %ld", max_iter )
+    inputs     = [ np.asarray(_) for _ in (price, ttm, K, cp, DF, F) ]
+    shape      = np.broadcast_shapes( *[ _.shape for _ in inputs ] )
+    vols       = np.empty( shape, dtype=np.float64 )
+    converged  = np.empty( shape, dtype=np.bool_ )
+    iterations = np.empty( shape, dtype=np.int32 )
+    it         = np.nditer( inputs + [ vols, converged, iterations ],
+                            flags=["external_loop", "buffered", "zerosize_ok"],
+                            op_flags=[["readonly"]]*len(inputs) + [["writeonly"]]*3,
+                            op_dtypes=[np.float64]*len(inputs) + [np.float64, np.bool_, np.int32],
+                            buffersize=chunk_size if not chunk_size is None else EUROPEAN_CHUNK_SIZE )
+    with it:
+        for ops in it:
+            _implied_vol_kernel( *ops[:len(inputs)], float(tol), int(max_iter), *ops[len(inputs):] )
+    if not return_info:
+        return vols
+    return PrettyOrderedDict( vols=vols, converged=converged, iterations=iterations )
+
 # -----------------------------------------------------------
 # (updated) weighted comoutations for orthonormalization
 # -----------------------------------------------------------
 
-@njit(nogil=True)
+@njit(nogil=True, cache=True)
 def flt_wsum(P,x):
     """
     Returns the flattened product P*x without allocating additional memory.
@@ -541,7 +1079,7 @@ def flt_wsum(P,x):
     if __debug__ and not np.isfinite(r): raise FloatingPointError("Numerical errors in flt_wsum")
     return r
 
-@njit(nogil=True)
+@njit(nogil=True, cache=True)
 def flt_wsumsqm(P,x,y,meanX = 0.,meanY = 0.):
     """
     Returns the flattened product P*(x-meanX)*(y-meanY) without allocating memory.
@@ -567,11 +1105,26 @@ def flt_wsumsqm(P,x,y,meanX = 0.,meanY = 0.):
     if __debug__ and not np.isfinite(r): raise FloatingPointError("Numerical errors in flt_wsumsqm")
     return r
 
-@njit(parallel=True)
-def wmean( P : np.ndarray, x : np.ndarray ):
+WCOV_BLOCK_SIZE = 1024*1024*4  # number of elements of 'x' and 'y' processed at once by wmean() and wcov()
+
+def _cov_dtype( x : np.ndarray ):
+    """ Result dtype of wmean() and wcov() """
+    return x.dtype if np.issubdtype( x.dtype, np.floating ) else np.float64
+
+def _prep_P_and_features( P : np.ndarray, x : np.ndarray, name : str = "x" ) -> tuple:
+    """ Reshape 'x' into a (m,nx) matrix without copying memory mapped files, and verify 'P' """
+    x = np.asarray(x) if not isinstance(x, np.ndarray) else x
+    _log.verify( len(x.shape) > 0 and x.shape[-1] > 0, "'%s' is empty", name )
+    x = x.reshape((-1,x.shape[-1]))
+    P = np.asarray(P).flatten()
+    _log.verify( len(P) == x.shape[0], "'P' must be of flattened length %ld; found %ld", x.shape[0], len(P) )
+    return P, x
+
+def wmean( P : np.ndarray, x : np.ndarray, *, block_size : int = None ):
     """
-    Computes the weighted mean for the last coordinates of 'x' without additional memory.
-    Numba compiled.
+    Computes the weighted mean for the last coordinates of 'x'.
+    Processes blocks of rows of 'x' with BLAS, hence memory mapped 'x' are read only once and
+    only blocks of at most 'block_size' elements are held in memory.
     
     Parameters:
     -----------
@@ -579,28 +1132,67 @@ def wmean( P : np.ndarray, x : np.ndarray ):
             probabiltiy weighting for m samples
         X[m,nx] : np.ndarray
             feature matrix for nx freatures with m samples
+        block_size : int
+            Maximum number of elements of 'x' processed at once. Default is WCOV_BLOCK_SIZE
         
     Returns
     -------
         meanX[nx] : np.ndarray
             weighted means with dtype equal to x
     """    
-    numX  = x.shape[-1]
-    if numX == 0: raise ValueError("'x' is empty")
-    x     = x.reshape((-1,numX))
-    meanX = np.zeros((numX,), dtype=x.dtype)
-    for ix in prange(numX):
-        meanX[ix] = flt_wsum( P=P, x=x[...,ix] )
-    return meanX
-
-@njit(parallel=True)
-def wcov( P : np.ndarray, x : np.ndarray, y : np.ndarray = None, meanX : np.ndarray = None, meanY : np.ndarray = None ):
-    """
-    Computes the weighted covariance matrix for the last coordinates of 'x' and 'y' without additional memory.
-    Numba compiled.
+    P, x   = _prep_P_and_features( P, x )
+    dtype  = _cov_dtype( x )
+    meanX  = np.zeros( (x.shape[1],), dtype=np.float64 )
+    for rows in _row_blocks( x.shape[0], x.shape[1], block_size if not block_size is None else WCOV_BLOCK_SIZE ):
+        meanX += P[rows].astype(dtype) @ np.asarray( x[rows], dtype=dtype )
+    if __debug__ and not np.all( np.isfinite(meanX) ): raise FloatingPointError("Numerical errors in wmean")
+    return meanX.astype(dtype)
+
+def _wcov( P : np.ndarray, Z : list, means : list, block_size : int ):
+    """
+    Computes the weighted covariance matrix of the columns of the matrices in 'Z', in a single pass over blocks of rows.
+    Each block is shifted by 'means' where given, or else by the weighted means of the first block. The products of each block are
+    computed with BLAS in the dtype of the first matrix and accumulated in float64.
+    """
+    dtype  = _cov_dtype( Z[0] )
+    m      = Z[0].shape[0]
+    nz     = sum( z.shape[1] for z in Z )
+    known  = np.concatenate( [ np.full( (z.shape[1],), not mu is None ) for z, mu in zip(Z,means) ] )
+    given  = np.concatenate( [ np.asarray( mu, dtype=np.float64 ).flatten() if not mu is None else np.zeros( (z.shape[1],) ) for z, mu in zip(Z,means) ] )
+    K      = None
+    S      = np.zeros( (nz,nz), dtype=np.float64 )
+    s      = np.zeros( (nz,), dtype=np.float64 )
+    a      = 0.
+    for rows in _row_blocks( m, nz, block_size if not block_size is None else WCOV_BLOCK_SIZE ):
+        p  = P[rows].astype(dtype)
+        z  = np.concatenate( [ np.asarray( _[rows], dtype=dtype ) for _ in Z ], axis=1 )
+        if K is None:
+            w  = np.sum( p, dtype=np.float64 )
+            K  = ( p @ z ) / w if w != 0. else np.zeros( (nz,), dtype=np.float64 )
+            K  = np.where( known, given, K ).astype(dtype)
+        z -= K
+        zw = z * p[:,np.newaxis]
+        S += zw.T @ z
+        s += np.sum( zw, axis=0, dtype=np.float64 )
+        a += np.sum( p, dtype=np.float64 )
+    # correct for the shift: the mean of the columns not given in 'means' is sum P z = s + a K
+    K  = K.astype(np.float64)
+    d  = np.where( known, 0., s + ( a - 1. ) * K )
+    C  = S - np.outer( s, d ) - np.outer( d, s ) + a * np.outer( d, d )
+    if __debug__ and not np.all( np.isfinite(C) ): raise FloatingPointError("Numerical errors in wcov")
+    return C.astype(dtype)
+
+def wcov( P : np.ndarray, x : np.ndarray, y : np.ndarray = None, meanX : np.ndarray = None, meanY : np.ndarray = None, *, block_size : int = None ):
+    """
+    Computes the weighted covariance matrix for the last coordinates of 'x' and 'y'.
     
     Simply computes:
         weights * ( x - meanX ) * ( y - meanY )
+    where the means are the weighted sums of 'x' and 'y' if not provided.
+
+    Blocks of rows of 'x' and 'y' are centered, weighted and multiplied with BLAS, hence memory mapped 'x' and 'y' are read only once and
+    only blocks of at most 'block_size' elements are held in memory. Products are computed in the dtype of 'x', e.g. float32, and accumulated
+    in float64.
     
     Parameters:
     -----------
@@ -614,70 +1206,275 @@ def wcov( P : np.ndarray, x : np.ndarray, y : np.ndarray = None, meanX : np.ndar
             array with weighted means of x. If None this will be computed on the fly
         meanY[ny] : np.ndarray
             array with weighted means of y. If None this will be computed on the fly
+        block_size : int
+            Maximum number of elements of 'x' and 'y' processed at once. Default is WCOV_BLOCK_SIZE
         
     Returns
     -------
-        meanX[nx] : np.ndarray
-            weighted means with dtype equal to x
+        C[nx+ny,nx+ny] : np.ndarray
+            covariance matrix of the features of 'x' and 'y' with dtype equal to x. Use wcov_blocks() for the blocks required by orth_project().
     """
-#    if x.dtype != y.dtype: raise ValueError("'x' and 'y' have different dtypes {x.dtype} and {y.dtype}")
-    numX    = x.shape[-1]
-    numY    = y.shape[-1] 
-    x       = x.reshape((-1,numX))
-    y       = y.reshape((-1,numY)) 
-    P       = P.flatten()
-    m       = x.shape[0]
-    dtype   = x.dtype
-    if len(P) != m: raise ValueError(f"'P' must be of flattened length {m}; found {len(P)}.")
-    if not y is None and y.shape[0] != m: raise ValueError(f"'x' and 'y' do not have compatible sizes {x.shape} and {y.shape} after reshaping")
-    
-    if meanX is None or meanY is None:
-        if meanX is None:
-            meanX = wmean(P=P, x=x)
-        if meanY is None:
-            meanY = wmean(P=P, x=y)
-        return wcov( P=P, x=x, y=y, meanX=meanX, meanY=meanY )
-    meanX   = meanX.flatten()
-    meanY   = meanY.flatten()
-    if numX != len(meanX): raise ValueError(f"'meanX' must be of length {numX} found shape {meanX.shape}")
-    if numY != len(meanY): raise ValueError(f"'meanY' must be of length {numY} found shape {meanY.shape}")
-    
-    Z       = [ x[...,_] for _ in range(numX) ] + [ y[...,_] for _ in range(numY) ]
-    meanZ   = [ meanX[_] for _ in range(numX) ] + [ meanY[_] for _ in range(numY) ] 
-    numZ    = len(Z)
-    x       = None
-    y       = None
-    meanX   = None
-    meanY   = None
-    assert numZ == numX+numY, ("Invalid numZ")
-    C      = np.full((numZ,numZ), np.inf, dtype=dtype)
-    
-    for iz1 in prange(numZ):
-        C[iz1,iz1] = flt_wsumsqm( P=P, x=Z[iz1], y=Z[iz1], meanX=meanZ[iz1], meanY=meanZ[iz1] )
-        for iz2 in range(iz1):
-            c12 = flt_wsumsqm( P=P, x=Z[iz1], y=Z[iz2], meanX=meanZ[iz1], meanY=meanZ[iz2] )
-            C[iz1,iz2] = c12
-            C[iz2,iz1] = c12
-            
-    assert C.dtype == dtype, ("Dtype error", C.dtype, dtype)
-    return C
+    P, x  = _prep_P_and_features( P, x, "x" )
+    Z     = [x]
+    means = [meanX]
+    if not meanX is None:
+        _log.verify( np.asarray(meanX).size == x.shape[1], "'meanX' must be of length %ld found shape %s", x.shape[1], np.asarray(meanX).shape )
+    if not y is None:
+        _, y  = _prep_P_and_features( P, y, "y" )
+        if not meanY is None:
+            _log.verify( np.asarray(meanY).size == y.shape[1], "'meanY' must be of length %ld found shape %s", y.shape[1], np.asarray(meanY).shape )
+        Z.append(y)
+        means.append(meanY)
+    return _wcov( P, Z, means, block_size )
+
+def wcov_blocks( P : np.ndarray, x : np.ndarray, y : np.ndarray, meanX : np.ndarray = None, meanY : np.ndarray = None, *, block_size : int = None ) -> tuple:
+    """
+    Computes the weighted covariance matrices XtX, XtY, YtY of the last coordinates of 'x' and 'y' as required by orth_project().
+    See wcov() for parameters.
+
+    Returns
+    -------
+        XtX[nx,nx], XtY[nx,ny], YtY[ny,ny]
+    """
+    C  = wcov( P, x, y, meanX=meanX, meanY=meanY, block_size=block_size )
+    nx = x.shape[-1]
+    return C[:nx,:nx], C[:nx,nx:], C[nx:,nx:]
+
+# -----------------------------------------------------------
+# Streaming weighted moments
+# -----------------------------------------------------------
+
+class Moments(object):
+    """
+    Streaming weighted means, variances and optionally covariances which can be merged.
+    Data is added in chunks with the same 'axis' semantics as mean() and var():
+
+        acc = Moments( axis=0 )
+        for x, P in chunks:
+            acc.add( x, P )
+        m = acc.mean()
+        v = acc.var()
+
+    Accumulators are pickled and merged with '+' or merge(), for example to combine the summaries
+    computed for shards of data by JCPool workers:
+
+        def summarize( shard ):
+            return Moments( axis=0, cov=True ).add( load(shard) )
+        acc = sum( pool.parallel( pool.delayed(summarize)( shard ) for shard in shards ), Moments( axis=0, cov=True ) )
+        XtX, XtY, YtY = acc.cov_blocks( nx )
+
+    Chunks are reduced with BLAS in blocks of rows and combined with the pairwise updates of Chan, Golub and LeVeque,
+    in float64. Weights do not need to be normalized.
+    """
+
+    def __init__(self, axis : int = None, cov : bool = False ):
+        """
+        Parameters
+        ----------
+            axis : int
+                Axis of the samples in the data passed to add(). If None, data are flattened and all elements are samples.
+            cov : bool
+                Whether to also accumulate the covariance matrix of all features, i.e. of all elements of a sample.
+        """
+        self.axis    = axis
+        self.has_cov = bool(cov)
+        self.reset()
+
+    def reset(self):
+        """ Clears all data """
+        self.shape   = None   # shape of each sample
+        self.count   = 0      # number of samples
+        self.weight  = 0.     # sum of weights
+        self._mean   = None   # (n,) weighted mean of the flattened samples
+        self._m2     = None   # (n,) weighted sum of squared deviations
+        self._c2     = None   # (n,n) weighted sum of deviation products if 'cov'
+
+    # Adding data
+    # -----------
+
+    def add(self, x : np.ndarray, P : np.ndarray = None ):
+        """
+        Add a chunk of samples 'x' with weights 'P'.
+
+        Parameters
+        ----------
+            x : tensor
+                Samples along 'axis'. If 'axis' is None, 'x' is flattened.
+            P : vector
+                Non-negative weights for the samples, or None for unit weights.
+                If 'axis' is None, 'P' must have the shape of 'x'.
+
+        Returns
+        -------
+            self
+        """
+        x = np.asarray(x)
+        if self.axis is None:
+            x = x.reshape((-1,1))
+            if not P is None and np.shape(P) != ( x.shape[0], ) and np.size(P) == x.shape[0]:
+                P = np.reshape( P, (-1,) )
+            shape = ()
+        else:
+            _log.verify( -len(x.shape) <= self.axis < len(x.shape), "Invalid axis %ld for 'x' with shape %s", self.axis, x.shape )
+            x     = np.moveaxis( x, self.axis, 0 )
+            shape = x.shape[1:]
+            x     = x.reshape( (x.shape[0],-1) )
+        if self.shape is None:
+            self.shape = shape
+        _log.verify( shape == self.shape, "Samples must have shape %s. Found %s", self.shape, shape )
+        if not P is None:
+            P = np.asarray( P, dtype=np.float64 )
+            _log.verify( P.shape == (x.shape[0],), "'P' must be a vector of length %ld. Found shape %s", x.shape[0], P.shape )
+            _log.verify( len(P) == 0 or np.min(P) >= 0., "'P' cannot have negative members. Found element %g", np.min(P) if len(P) > 0 else 0. )
+        for rows in _row_blocks( x.shape[0], x.shape[1], WCOV_BLOCK_SIZE ):
+            self._add_block( np.asarray( x[rows], dtype=np.float64 ), P[rows] if not P is None else None )
+        return self
+
+    def _add_block(self, x : np.ndarray, p : np.ndarray ):
+        """ Merge the moments of the (m,n) matrix 'x' with weights 'p' """
+        m  = x.shape[0]
+        if m == 0:
+            return
+        w  = float( np.sum(p) ) if not p is None else float(m)
+        if w <= 0.:
+            self.count += m
+            return
+        mu = ( p @ x ) / w if not p is None else np.mean( x, axis=0 )
+        xc = x - mu
+        xw = xc * p[:,np.newaxis] if not p is None else xc
+        m2 = np.sum( xw * xc, axis=0 )
+        c2 = xw.T @ xc if self.has_cov else None
+        self._merge( m, w, mu, m2, c2 )
+
+    def _merge(self, count : int, weight : float, mean : np.ndarray, m2 : np.ndarray, c2 : np.ndarray ):
+        """ Pairwise update with the moments of another set of samples """
+        self.count += count
+        if weight <= 0.:
+            return
+        if self.weight <= 0.:
+            self.weight = weight
+            self._mean  = np.array( mean, dtype=np.float64 )
+            self._m2    = np.array( m2, dtype=np.float64 )
+            self._c2    = np.array( c2, dtype=np.float64 ) if self.has_cov else None
+            return
+        total       = self.weight + weight
+        delta       = mean - self._mean
+        f           = self.weight * weight / total
+        self._mean  = self._mean + delta * ( weight / total )
+        self._m2    = self._m2 + m2 + delta * delta * f
+        if self.has_cov:
+            self._c2 = self._c2 + c2 + np.outer( delta, delta ) * f
+        self.weight = total
+
+    def merge(self, other ):
+        """ Merge the moments accumulated by 'other' into 'self'. Returns self """
+        _log.verify( isinstance(other, Moments), "Cannot merge with object of type %s", type(other).__name__ )
+        _log.verify( other.axis == self.axis, "Cannot merge moments for axis %s with moments for axis %s", other.axis, self.axis )
+        _log.verify( other.has_cov == self.has_cov, "Cannot merge moments with and without covariance" )
+        if other.shape is None:
+            return self
+        if self.shape is None:
+            self.shape = other.shape
+        _log.verify( other.shape == self.shape, "Cannot merge samples of shape %s with samples of shape %s", other.shape, self.shape )
+        self._merge( other.count, other.weight, other._mean, other._m2, other._c2 )
+        return self
+
+    def __iadd__(self, other ):
+        return self.merge( other )
+
+    def __add__(self, other ):
+        return Moments( self.axis, self.has_cov ).merge( self ).merge( other )
+
+    # Results
+    # -------
+
+    def _result(self, r : np.ndarray, keepdims : bool ) -> np.ndarray:
+        """ Reshape a result to the sample shape """
+        _log.verify( self.weight > 0., "No samples with positive weight were added" )
+        if self.axis is None:
+            return np.reshape( r, (1,) ) if keepdims else r[0]
+        r = np.reshape( r, self.shape )
+        return np.expand_dims( r, self.axis if self.axis >= 0 else self.axis+len(self.shape)+1 ) if keepdims else r
+
+    def mean(self, keepdims : bool = False ) -> np.ndarray:
+        """ Weighted mean. See mean() """
+        return self._result( self._mean, keepdims )
+
+    def var(self, keepdims : bool = False ) -> np.ndarray:
+        """ Weighted variance, using the literal definition of variance. See var() """
+        return self._result( self._m2 / self.weight, keepdims )
+
+    def std(self, keepdims : bool = False ) -> np.ndarray:
+        """ Weighted standard deviation. See std() """
+        return np.sqrt( self.var( keepdims ) )
+
+    def err(self, keepdims : bool = False ) -> np.ndarray:
+        """ Standard error, i.e. the standard deviation divided by the square root of the number of samples. See err() """
+        return self.std( keepdims ) / math.sqrt( float(self.count) )
+
+    def cov(self) -> np.ndarray:
+        """
+        Weighted covariance matrix of the flattened samples, i.e. wcov() with normalized weights.
+        Requires cov=True.
+        """
+        _log.verify( self.has_cov, "Covariance was not accumulated: construct Moments with cov=True" )
+        _log.verify( self.weight > 0., "No samples with positive weight were added" )
+        return self._c2 / self.weight
+
+    def cov_blocks(self, nx : int ) -> tuple:
+        """
+        Returns the covariance matrices XtX, XtY, YtY for orth_project() assuming the first 'nx' features
+        of each sample are 'X', and the remaining ones 'Y'. See wcov_blocks().
+        Requires cov=True.
+        """
+        C = self.cov()
+        _log.verify( 0 < nx < C.shape[0], "'nx' must be between 1 and %ld. Found %ld", C.shape[0]-1, nx )
+        return C[:nx,:nx], C[:nx,nx:], C[nx:,nx:]
 
 # ------------------------------------------------
 # Normalization
 # -------------------------------------------------
 
+RSVD_OVERSAMPLE  = 10   # number of additional random directions used by the randomized decomposition of robust_svd()
+RSVD_POWER_ITER  = 2    # number of power iterations used by the randomized decomposition of robust_svd()
+
+def _randomized_svd( A : np.ndarray, rank : int, symmetric : bool ) -> tuple:
+    """
+    Randomized truncated decomposition of the (stack of) matrices 'A' with the leading 'rank' singular values, c.f. Halko, Martinsson, Tropp 2011.
+    Uses a fixed seed, hence results are reproducible.
+    """
+    n     = A.shape[-1]
+    k     = min( n, rank + RSVD_OVERSAMPLE )
+    At    = np.swapaxes( A, -1, -2 )
+    omega = np.random.default_rng(0).standard_normal( (n,k) ).astype( A.dtype )
+    Y     = A @ omega
+    for _ in range(RSVD_POWER_ITER):
+        Y, _ = np.linalg.qr( Y )
+        Y    = A @ ( At @ Y ) if not symmetric else A @ Y
+    Q, _  = np.linalg.qr( Y )
+    Qt    = np.swapaxes( Q, -1, -2 )
+    if symmetric:
+        s, v = np.linalg.eigh( Qt @ A @ Q )
+        s    = np.maximum( s[...,::-1][...,:rank], 0. )
+        u    = ( Q @ v[...,::-1] )[...,:rank]
+        return u, s, np.swapaxes( u, -1, -2 )
+    u, s, vt = np.linalg.svd( Qt @ A, full_matrices=False, compute_uv=True )
+    return ( Q @ u )[...,:rank], s[...,:rank], vt[...,:rank,:]
+
 def robust_svd( A : np.ndarray, *, total_rel_floor : float = 0.001,
                                    ev0_rel_floor   : float = 0.,
                                    min_abs_ev      : float = 0.0001,
                                    cutoff          : bool = True,
-                                   rescale         : bool = True):
+                                   rescale         : bool = True,
+                                   symmetric       : bool = False,
+                                   rank            : int = None ):
     """
     Computes SVD and cuts/floors he eigenvalues for more robust numerical calculations
     
     Parameters
     ----------
         A : 
-            Matrix
+            Matrix, or a stack of matrices in the last two dimensions.
         total_rel_floor : float
             Total valatility is the square root of the sum of squares of eigenvalues (singular values)
             'total_rel_floor' cuts off or floors any eigenvalues which contribute less than this fraction
@@ -692,38 +1489,51 @@ def robust_svd( A : np.ndarray, *, total_rel_floor : float = 0.001,
             Whether to cutoff (True) or floor (False) eigenvalues.
         rescale : bool
             Whether to rescale the cut off or floored eigenvalues back to the sum of the original eigenvalues.
+        symmetric : bool
+            If True, 'A' must be symmetric positive semi-definite, such as a covariance matrix, and np.linalg.eigh()
+            is used instead of np.linalg.svd(). Small negative eigenvalues are set to zero.
+        rank : int
+            If not None, compute only the 'rank' leading singular values with a randomized decomposition.
+            All floors are then applied relative to the sum of those singular values.
     
     Returns
     -------
-        u, s, vt such that u @ np.diag(s) @ vt ~ A
+        u, s, vt such that u @ np.diag(s) @ vt ~ A, or u @ ( s[...,:,np.newaxis] * vt ) ~ A for stacks of matrices.
     """
     assert ev0_rel_floor >= 0. and ev0_rel_floor < 1., ("'ev0_rel_floor' must be from [0,1)", ev0_rel_floor)    
     assert total_rel_floor >= 0. and total_rel_floor < 1., ("'total_rel_floor' must be from [0,1)", total_rel_floor)    
     assert min_abs_ev > 0., ("'min_abs_ev' must be positive", min_abs_ev)
-
-    u, s, vt            = np.linalg.svd( A, full_matrices=False, compute_uv=True )
-    assert len(s.shape) == 1, ("s should be a vector")
-    assert u.shape == (A.shape[0], s.shape[0]) and vt.shape == (s.shape[0], A.shape[1]), "Bad shapes"
+    assert len(A.shape) >= 2, ("'A' must be a matrix or a stack of matrices", A.shape)
+    assert not symmetric or A.shape[-1] == A.shape[-2], ("'A' must be square if 'symmetric' is True", A.shape)
+
+    if not rank is None:
+        assert rank > 0, ("'rank' must be positive", rank)
+        u, s, vt        = _randomized_svd( A, min( rank, A.shape[-1], A.shape[-2] ), symmetric )
+    elif symmetric:
+        s, u            = np.linalg.eigh( A )
+        s               = np.maximum( s[...,::-1], 0. )
+        u               = u[...,::-1]
+        vt              = np.swapaxes( u, -1, -2 )
+    else:
+        u, s, vt        = np.linalg.svd( A, full_matrices=False, compute_uv=True )
+    s                   = np.array( s, dtype=A.dtype )
+    assert u.shape == A.shape[:-1] + (s.shape[-1],) and vt.shape == A.shape[:-2] + (s.shape[-1], A.shape[-1]), "Bad shapes"
     assert u.dtype == A.dtype, ("'u' dtype error")
-    assert s.dtype == A.dtype, ("'s' dtype error")
     assert vt.dtype == A.dtype, ("'vt' dtype error")
-    _log.verify( s[0] >= min_abs_ev**2, "Lowest matrix eigenvalue %g is below 'min_abs_ev' of %g", math.sqrt(s[0]), min_abs_ev)
+    _log.verify( np.all( s[...,0] >= min_abs_ev**2 ), "Lowest matrix eigenvalue %g is below 'min_abs_ev' of %g", math.sqrt(np.min(s[...,0])), min_abs_ev)
     
-    total_var           = np.sum(s)
+    total_var           = np.sum( s, axis=-1, keepdims=True )
 
     if total_rel_floor > 0.:
-        sum_s           = np.cumsum(s)
-        thrshld         = total_var*(total_rel_floor**2)
-        ix_cut          = np.searchsorted(sum_s,thrshld)
-        assert ix_cut>=0
-        assert (ix_cut==len(s) and thrshld > sum_s[-1]) or (ix_cut<len(s) and thrshld <= sum_s[ix_cut])
-        s[:ix_cut]      = 0.
+        # cut the leading eigenvalues whose cumulative sum is below the threshold
+        sum_s           = np.cumsum( s, axis=-1 )
+        s[ sum_s < total_var*(total_rel_floor**2) ] = 0.
     
-    min_sv = max( min_abs_ev**2, s[0]*(ev0_rel_floor**2) )
-    s[1:][s[1:] < min_sv] = 0. if cutoff else min_sv
+    min_sv              = np.maximum( min_abs_ev**2, s[...,:1]*(ev0_rel_floor**2) )
+    s[...,1:]           = np.where( s[...,1:] < min_sv, 0. if cutoff else min_sv, s[...,1:] )
 
     if rescale:
-        s  *= total_var / np.sum( s )
+        s              *= total_var / np.sum( s, axis=-1, keepdims=True )
     assert np.all(np.isfinite(s)), ("Infinite 's'") 
     return u, s, vt
 
@@ -731,7 +1541,8 @@ def orth_project( XtX, XtY, YtY, * , total_rel_floor : float = 0.001,
                                      ev0_rel_floor   : float = 0.,
                                      min_abs_ev      : float = 0.0001,
                                      cutoff          : bool = True,
-                                     rescale         : bool = True):
+                                     rescale         : bool = True,
+                                     rank            : int = None ):
     """
     Numpy implementation of the partial projection
         Z = X XtoZ + Y YtoZ
@@ -759,11 +1570,16 @@ def orth_project( XtX, XtY, YtY, * , total_rel_floor : float = 0.001,
         By construction S'=S and S'S=S hence
         RtR = X'X - X'S X
             = X'X - X'Y P
+
+    Both decompositions use np.linalg.eigh() as all matrices are symmetric, and {Y'Y}^{-1} is applied to Y'X
+    with the (floored) decomposition of Y'Y instead of being computed explicitly.
+    Inputs may be stacks of matrices with the same leading dimensions, for example to orthogonalize many small
+    regressions at once.
                           
     Parameters
     ----------
         XtX, XtY, YtY
-            Respective covariance matrices of the centered vectors x and y
+            Respective covariance matrices of the centered vectors x and y. See wcov_blocks().
         total_rel_floor : float
             Total valatility is the square root of the sum of squares of eigenvalues (singular values)
             'total_rel_floor' cuts off or floors any eigenvalues which contribute less than this fraction
@@ -778,72 +1594,47 @@ def orth_project( XtX, XtY, YtY, * , total_rel_floor : float = 0.001,
             If True, eigenvalues below the effective minimum eigenvalues are cut off. If False, they will be floored there.
         rescale : bool
             Whether to rescale the cut off or floored eigenvalues back to the sum of the original eigenvalues.
+        rank : int
+            If not None, 'Z' is restricted to the 'rank' leading directions of R'R which are computed with a
+            randomized decomposition. See robust_svd().
             
     Returns
     -------
         XtoZ, YtoZ
     """
-    assert len(XtX.shape) == 2 and XtX.shape[0] == XtX.shape[1], ("XtX must be square")
-    assert len(YtY.shape) == 2 and YtY.shape[0] == YtY.shape[1], ("YtY must be square")
+    XtX   = np.asarray(XtX)
+    XtY   = np.asarray(XtY)
+    YtY   = np.asarray(YtY)
+    assert len(XtX.shape) >= 2 and XtX.shape[-1] == XtX.shape[-2], ("XtX must be square")
+    assert len(YtY.shape) >= 2 and YtY.shape[-1] == YtY.shape[-2], ("YtY must be square")
     dtype = XtX.dtype
     assert dtype == YtY.dtype, ("Dtype mismatch. Likely an issue", dtype, YtY.dtype )
     assert dtype == XtY.dtype, ("Dtype mismatch. Likely an issue", dtype, XtY.dtype )
 
-    num_X = XtX.shape[0]
-    num_Y = YtY.shape[0]
-    assert XtY.shape == (num_X,num_Y), ("XtY has the wrong shape", XtY.shape, (num_X,num_Y))
-
-    def inv( A ):
-        """
-        Compute inverse with SVD
-            A = UDU'
-        as UdU' where d=1/D whereever D>epsilon
-        """  
-        assert len(A.shape) == 2 and A.shape[0] == A.shape[1], ("'A' should be square")
-        u, s, vh  = robust_svd( A, total_rel_floor=total_rel_floor, ev0_rel_floor=ev0_rel_floor, min_abs_ev=min_abs_ev, rescale=rescale, cutoff=False )
-        assert len(s.shape) == 1, ("s should be a vector")
-        assert np.max( s[1:] - s[:-1] ) <= 0., ("s sv error")
-        assert u.shape == A.shape and vh.shape == A.shape, ("Bad shapes", A.shape, u.shape, vh.shape )
-        assert np.min(s) >= min_abs_ev**2, ("Internal floor error", np.min(s), min_abs_ev**2 )
-        s         = 1./s
-        invA      = np.transpose(vh) @ np.diag(s) @ np.transpose(u)
-        del u, s, vh
-        assert invA.shape == A.shape, ("Inverse shape error", invA.shape, A.shape)
-        assert np.all(np.isfinite(invA)), ("Infinite inverse of A") 
-        return invA.astype(A.dtype)
-
-    P   = inv(YtY) @ np.transpose( XtY )
+    num_X = XtX.shape[-1]
+    num_Y = YtY.shape[-1]
+    assert XtY.shape == XtX.shape[:-2] + (num_X,num_Y), ("XtY has the wrong shape", XtY.shape, XtX.shape[:-2] + (num_X,num_Y))
+    assert YtY.shape[:-2] == XtX.shape[:-2], ("XtX and YtY must have the same leading dimensions", XtX.shape, YtY.shape )
+    kwargs = dict( total_rel_floor=total_rel_floor, ev0_rel_floor=ev0_rel_floor, min_abs_ev=min_abs_ev, rescale=rescale, cutoff=False, symmetric=True )
+
+    # P = {Y'Y}^{-1} Y'X = U D^{-1} U' Y'X
+    u, s, _ = robust_svd( YtY, **kwargs )
+    assert np.all( s[...,1:] <= s[...,:-1] ), ("s sv error")
+    assert np.min(s) >= min_abs_ev**2, ("Internal floor error", np.min(s), min_abs_ev**2 )
+    P       = u @ ( ( np.swapaxes( u, -1, -2 ) @ np.swapaxes( XtY, -1, -2 ) ) / s[...,:,np.newaxis] )
+    assert np.all(np.isfinite(P)), ("Infinite P") 
     
-    def project(A):
-        """
-        Compute SVD A = UDU' and return U/sqrt{D} for whereever D>epsilon. The returned matrix has only valid dimensions
-        """  
-        assert len(A.shape) == 2 and A.shape[0] == A.shape[1], ("'A' should be square")
-        u, s, vh  = robust_svd( A, total_rel_floor=total_rel_floor, ev0_rel_floor=ev0_rel_floor, min_abs_ev=min_abs_ev, rescale=rescale, cutoff=False )
-        assert len(s.shape) == 1, ("s should be a vector")
-        assert np.max( s[1:] - s[:-1] ) <= 0., ("s sv error")
-        assert u.shape == A.shape and vh.shape == A.shape, ("Bad shapes", A.shape, u.shape, vh.shape )
-        assert np.min(s) >= min_abs_ev**2, ("Internal floor error", np.min(s), min_abs_ev**2 )
-        """
-        cutoff    = max( total_rel_floor**2 * np.sum(s), ev0_rel_floor**2 * s[0], min_abs_ev**2 )
-        ix        = np.searchsorted( -s, -cutoff, side="right" )
-        assert ix > 0 and s[ix-1] >= cutoff and ( ( ix < len(s) and cutoff > s[ix] ) or ( ix ==len(s) ) ) , ("Index issues", ix, s )
-        d         = np.zeros( (A.shape[0], ix))
-        np.fill_diagonal( d, 1./np.sqrt(s[:ix]))
-        """        
-        Q        = u @ np.diag(1./np.sqrt(s))
-        del u, s, vh
-        assert np.all(np.isfinite(Q)), ("Infinite Q") 
-        return Q.astype(A.dtype)
-       
-    Q = project( XtX - XtY @ P )
-    del XtY, YtY, XtX
-    XtoZ = Q
-    YtoZ = -P @ Q
-    assert XtoZ.shape[0] == num_X, ("Shape error", XtoZ.shape, num_X) 
-    assert YtoZ.shape[0] == num_Y, ("Shape error", YtoZ.shape, num_Y)
-    assert XtoZ.dtype == dtype, ("Dtype error", XtoZ.dtype, dtype)
-    assert YtoZ.dtype == dtype, ("Dtype error", YtoZ.dtype, dtype)
+    # Q = U 1/sqrt{D} for R'R = UDU'
+    u, s, _ = robust_svd( XtX - XtY @ P, rank=rank, **kwargs )
+    assert np.all( s[...,1:] <= s[...,:-1] ), ("s sv error")
+    assert np.min(s) >= min_abs_ev**2, ("Internal floor error", np.min(s), min_abs_ev**2 )
+    Q       = u / np.sqrt( s )[...,np.newaxis,:]
+    assert np.all(np.isfinite(Q)), ("Infinite Q") 
+
+    XtoZ = Q.astype(dtype, copy=False)
+    YtoZ = ( -P @ Q ).astype(dtype, copy=False)
+    assert XtoZ.shape[-2] == num_X, ("Shape error", XtoZ.shape, num_X) 
+    assert YtoZ.shape[-2] == num_Y, ("Shape error", YtoZ.shape, num_Y)
     return XtoZ, YtoZ
     
 # ------------------------------------------------
@@ -853,8 +1644,47 @@ def orth_project( XtX, XtY, YtY, * , total_rel_floor : float = 0.001,
 madf = 1.4826
 log2 = math.log(2.)
 nano_y = 1./(255.*24.*60.*60.*1000.*1000.) # a nanosecond in years
-              
-@njit(nogil=True)
+
+@njit(nogil=True, cache=True)
+def _ew_step( xi, loc, dis, w, cutoff, robust ):
+    """
+    One step of rolling_ew_std() if 'robust' is False, or of robust_rolling_ew() otherwise, shared with their 2-D versions.
+    'dis' is the variance in the first case and the robust vol in the second. Returns the new mean, 'dis', and whether 'xi' is an outlier
+    """
+    vol  = ( dis if robust else np.sqrt( dis ) ) + 0.0001 / 255.
+    z_i  = ( xi - loc ) / vol
+    otl  = np.abs( z_i ) > cutoff
+    xx_i = min( float(cutoff), max( -float(cutoff), z_i ) ) * vol + loc
+    l    = loc if otl else (1.-w) * loc + w * xx_i
+    if robust:
+        d = (1.-w) * dis + w * madf * np.abs( xx_i - l )
+    else:
+        d = (1.-w) * dis + w * ( xx_i - l )**2
+    return l, d, otl
+
+@njit(nogil=True, cache=True)
+def _dt_ew_step( xi, dti, wi, loc, dis, cutoff, scale_by_dt ):
+    """
+    One step of robust_rolling_dt_ew() with weight 'wi', shared with robust_rolling_dt_ew_2d().
+    Returns the new mean, vol, and whether 'xi' is an outlier
+    """
+    vol = dis + 0.0001 / 255.
+    if not scale_by_dt:
+        z_i   = ( xi - loc ) / vol
+        otl   = np.abs( z_i ) > cutoff
+        xx_i  = min( float(cutoff), max( -float(cutoff), z_i ) ) * vol + loc
+        l     = loc if otl else (1.-wi) * loc + wi * xx_i
+        d     = (1.-wi) * dis + wi * madf * np.abs( xx_i - loc )
+    else:
+        sqtdt = np.sqrt( dti )
+        z_i   = ( xi - loc*dti ) / ( vol*sqtdt )
+        otl   = np.abs( z_i ) > cutoff
+        xx_i  = min( float(cutoff), max( -float(cutoff), z_i ) ) * vol * sqtdt  + loc * dti
+        l     = loc if otl else (1.-wi) * loc + wi * xx_i / dti
+        d     = (1.-wi) * dis + wi * madf * np.abs( xx_i - l*dti ) / sqtdt
+    return l, d, otl
+
+@njit(nogil=True, cache=True)
 def rolling_ew_std( x : np.ndarray, window, init : int = 10, cutoff : float = 2.5 ):
     """
     Comnputes standard recursive exponential weighted mean and volatility, initialized over 'init' steps.
@@ -887,15 +1717,10 @@ def rolling_ew_std( x : np.ndarray, window, init : int = 10, cutoff : float = 2.
     w            = 1./float(window)
 
     for i in range(init, x.shape[0]):
-        vol    = np.sqrt( dis[i-1] ) + 0.0001 / 255.
-        z_i    = ( x[i] - loc[i-1] ) / vol
-        skip_i = np.abs( z_i ) > cutoff
-        xx_i   = np.minimum( cutoff, np.maximum( -cutoff, ( x[i] - loc[i-1] ) / vol ) ) * vol + loc[i-1]
-        loc[i] = np.where( skip_i, loc[i-1], (1.-w) * loc[i-1] + w * xx_i )
-        dis[i] = (1.-w) * dis[i-1] + w * ( xx_i - loc[i] )**2
+        loc[i], dis[i], _ = _ew_step( x[i], loc[i-1], dis[i-1], w, cutoff, False )
     return loc, np.sqrt( dis )
 
-@njit(nogil=True)
+@njit(nogil=True, cache=True)
 def robust_rolling_ew( x, window, init=10, cutoff=2.5 ):
     """
     Comnputes robust recursive exponential weighted mean and volatility, initialized over 'init' steps using median and MAD, respectively.
@@ -930,15 +1755,10 @@ def robust_rolling_ew( x, window, init=10, cutoff=2.5 ):
     w            = 1./float(window)
 
     for i in range(init, x.shape[0]):
-        vol    = dis[i-1] + 0.0001 / 255.
-        z_i    = ( x[i] - loc[i-1] ) / vol
-        otl[i] = np.abs( z_i ) > cutoff
-        xx_i   = np.minimum( cutoff, np.maximum( -cutoff, ( x[i] - loc[i-1] ) / vol ) ) * vol + loc[i-1]
-        loc[i] = np.where( otl[i], loc[i-1], (1.-w) * loc[i-1] + w * xx_i )
-        dis[i] = (1.-w) * dis[i-1] + w * madf * np.abs( xx_i - loc[i] )
+        loc[i], dis[i], otl[i] = _ew_step( x[i], loc[i-1], dis[i-1], w, cutoff, True )
     return loc, dis, otl
 
-@njit(nogil=True)
+@njit(nogil=True, cache=True)
 def _inner_robust_rolling_dt_ew( *,
         x  : np.ndarray,
         dt : np.ndarray,
@@ -953,33 +1773,33 @@ def _inner_robust_rolling_dt_ew( *,
         normalize_by_dt : bool
         ):
 
+    if scale_by_dt:
+        assert np.min( dt ) >= nano_y, ("Found too smaLL 'dt':", np.min(dt), "which is less than a nanosecond", nano_y )
+    for i in range(init, x.shape[0]):
+        loc[i], dis[i], otl[i] = _dt_ew_step( x[i], dt[i], w[i], loc[i-1], dis[i-1], cutoff, scale_by_dt )
+
     if not scale_by_dt:
-        for i in range(init, x.shape[0]):
-            vol    = dis[i-1] + 0.0001 / 255.
-            z_i    = ( x[i] - loc[i-1] ) / vol
-            otl[i] = np.abs( z_i ) > cutoff
-            xx_i   = np.minimum( cutoff, np.maximum( -cutoff, z_i ) ) * vol + loc[i-1]
-            loc[i] = np.where( otl[i], loc[i-1], (1.-w[i]) * loc[i-1] + w[i] * xx_i )
-            dis[i] = (1.-w[i]) * dis[i-1] + w[i] * madf * np.abs( xx_i - loc[i-1] )
-            
         if normalize_by_dt:
             loc /= dt
             dis /= np.sqrt(dt)
     else:
-        assert np.min( dt ) >= nano_y, ("Found too smaLL 'dt':", np.min(dt), "which is less than a nanosecond", nano_y )
-        for i in range(init, x.shape[0]):
-            vol    = dis[i-1] + 0.0001 / 255.
-            sqtdt  = np.sqrt(dt[i])
-            z_i    = ( x[i] - loc[i-1]*dt[i] ) / ( vol*sqtdt )
-            otl[i] = np.abs( z_i ) > cutoff
-            xx_i   = np.minimum( cutoff, np.maximum( -cutoff, z_i ) ) * vol * sqtdt  + loc[i-1] * dt[i]
-            loc[i] = np.where( otl[i], loc[i-1], (1.-w[i]) * loc[i-1] + w[i] * xx_i / dt[i] )
-            dis[i] = (1.-w[i]) * dis[i-1] + w[i] * madf * np.abs( xx_i - loc[i]*dt[i] ) / sqtdt
         if not normalize_by_dt:
             loc *= dt
             dis *= np.sqrt(dt)
     return loc, dis, otl
 
+def _robust_rolling_dt_ew_init( x : np.ndarray, dt : np.ndarray, w : np.ndarray, scale_by_dt : bool ) -> tuple:
+    """ Initial robust mean and vol of robust_rolling_dt_ew() from the first 'init' elements of 'x', 'dt' and the weights 'w' """
+    q = w / np.sum( w )
+    # TODO: current numba does not support quantiles with weights
+    if not scale_by_dt:
+        loc = np.quantile( x, 0.5, weights=q, method="inverted_cdf" ) 
+        dis = madf *  np.quantile( np.abs(x - loc), 0.5, weights=q, method="inverted_cdf" ) 
+    else:
+        loc = np.quantile( x/dt, 0.5, weights=q, method="inverted_cdf" ) 
+        dis = madf * np.quantile( np.abs(x - loc*dt) / np.sqrt( dt ), 0.5, weights=q, method="inverted_cdf" ) 
+    return loc, dis
+
 def robust_rolling_dt_ew( x  : np.ndarray,
                           dt : np.ndarray,
                           twindow : float = 0.25,
@@ -1026,16 +1846,9 @@ def robust_rolling_dt_ew( x  : np.ndarray,
     dis          = np.zeros_like( x )
     otl          = np.zeros_like( x, dtype=np.bool_ ) 
     w            = - np.expm1( - dt / twindow )
-    q            = w[:init] / np.sum( w[:init] )
-
-    # TODO: current numba does not support quantiles with weights
-    if not scale_by_dt:
-        loc[:init]   = np.quantile( x[:init], 0.5, weights=q, method="inverted_cdf" ) 
-        dis[:init]   = madf *  np.quantile( np.abs(x[:init] - loc[init-1]), 0.5, weights=q, method="inverted_cdf" ) 
-    else:
+    if scale_by_dt:
         assert np.min( dt ) >= nano_y, ("Found too smaLL 'dt':", np.min(dt), "which is less than a nanosecond", nano_y )
-        loc[:init]   = np.quantile( x[:init]/dt[:init], 0.5, weights=q, method="inverted_cdf" ) 
-        dis[:init]   = madf * np.quantile( np.abs(x[:init] - loc[init-1]*dt[:init]) / np.sqrt( dt[:init] ), 0.5, weights=q, method="inverted_cdf" ) 
+    loc[:init], dis[:init] = _robust_rolling_dt_ew_init( x[:init], dt[:init], w[:init], scale_by_dt )
 
     return _inner_robust_rolling_dt_ew( x=x, dt=dt, w=w, loc=loc, dis=dis, otl=otl,
                                        twindow =twindow,
@@ -1044,6 +1857,318 @@ def robust_rolling_dt_ew( x  : np.ndarray,
                                        scale_by_dt =scale_by_dt,
                                        normalize_by_dt=normalize_by_dt )
 
+class RobustRollingDtEW(object):
+    """
+    Online version of robust_rolling_dt_ew() which processes new observations as they arrive:
+
+        ew = RobustRollingDtEW( twindow=0.25, init=10 )
+        for x, dt in ticks:
+            loc, dis, otl = ew.update( x, dt )
+
+    After each update() the values returned for the new observations are the last values which robust_rolling_dt_ew() returns for the
+    entire history so far, in O(batch size). Since robust_rolling_dt_ew() assigns the same initial values to the first 'init' observations,
+    values returned before 'init' observations have been seen are preliminary.
+
+    The object carries its parameters, the current estimates and, until initialization is complete, the initial observations.
+    It can be pickled, for example to a SubDir.
+    """
+
+    def __init__(self, twindow : float = 0.25, init : int = 10, cutoff : float = 2.5, scale_by_dt : bool = False, normalize_by_dt : bool = False ):
+        """
+        Parameters
+        ----------
+            twindow, init, cutoff, scale_by_dt, normalize_by_dt : see robust_rolling_dt_ew()
+        """
+        _log.verify( init > 0, "'init' must be positive. Found %ld", init )
+        self.twindow         = float(twindow)
+        self.init            = int(init)
+        self.cutoff          = float(cutoff)
+        self.scale_by_dt     = bool(scale_by_dt)
+        self.normalize_by_dt = bool(normalize_by_dt)
+        self.count           = 0                         # number of observations
+        self.loc             = None                      # current mean, in the units used for estimation
+        self.dis             = None                      # current vol, in the units used for estimation
+        self._init_x         = np.zeros( (0,) )
+        self._init_dt        = np.zeros( (0,) )
+
+    @property
+    def initialized(self) -> bool:
+        """ Whether 'init' observations have been seen """
+        return self.count >= self.init
+
+    def _output(self, loc : np.ndarray, dis : np.ndarray, dt : np.ndarray ) -> tuple:
+        """ Convert estimates into the units returned by robust_rolling_dt_ew() """
+        if self.normalize_by_dt and not self.scale_by_dt:
+            return loc / dt, dis / np.sqrt(dt)
+        if self.scale_by_dt and not self.normalize_by_dt:
+            return loc * dt, dis * np.sqrt(dt)
+        return loc, dis
+
+    def update(self, x, dt ) -> tuple:
+        """
+        Add new observations.
+
+        Parameters
+        ----------
+            x : float or vector of new observations
+            dt : float or vector of time steps of the new observations
+
+        Returns
+        -------
+            Robust means, vols, and outlier detections for the new observations, each a vector of the length of 'x'
+        """
+        x  = np.asarray( x, dtype=np.float64 ).reshape((-1,))
+        dt = np.asarray( dt, dtype=np.float64 ).reshape((-1,))
+        dt = np.full( x.shape, dt[0] ) if dt.shape == (1,) and x.shape != (1,) else dt
+        _log.verify( dt.shape == x.shape, "'x' and 'dt' must have the same length. Found %ld and %ld", len(x), len(dt) )
+        if self.scale_by_dt and len(dt) > 0:
+            assert np.min( dt ) >= nano_y, ("Found too smaLL 'dt':", np.min(dt), "which is less than a nanosecond", nano_y )
+
+        loc = np.zeros( x.shape )
+        dis = np.zeros( x.shape )
+        otl = np.zeros( x.shape, dtype=np.bool_ )
+        n   = 0
+        if not self.initialized:
+            n             = min( len(x), self.init - self.count )
+            self._init_x  = np.concatenate( [ self._init_x, x[:n] ] )
+            self._init_dt = np.concatenate( [ self._init_dt, dt[:n] ] )
+            self.count   += n
+            if n > 0:
+                w                  = - np.expm1( - self._init_dt / self.twindow )
+                self.loc, self.dis = _robust_rolling_dt_ew_init( self._init_x, self._init_dt, w, self.scale_by_dt )
+                loc[:n], dis[:n]   = self._output( self.loc, self.dis, dt[:n] )
+            if self.initialized:
+                self._init_x  = np.zeros( (0,) )
+                self._init_dt = np.zeros( (0,) )
+        if n == len(x):
+            return loc, dis, otl
+
+        # continue the recursion from the current state, which is passed as the first element
+        xx      = np.concatenate( [ [0.], x[n:] ] )
+        dtt     = np.concatenate( [ [1.], dt[n:] ] )
+        ll      = np.zeros( xx.shape )
+        dd      = np.zeros( xx.shape )
+        oo      = np.zeros( xx.shape, dtype=np.bool_ )
+        ll[0]   = self.loc
+        dd[0]   = self.dis
+        ll, dd, oo = _inner_robust_rolling_dt_ew( x=xx, dt=dtt, w=- np.expm1( - dtt / self.twindow ), loc=ll, dis=dd, otl=oo,
+                                                  twindow=self.twindow,
+                                                  init=1,
+                                                  cutoff=self.cutoff,
+                                                  scale_by_dt=self.scale_by_dt,
+                                                  normalize_by_dt=self.scale_by_dt )   # keep the units used for estimation
+        self.loc    = ll[-1]
+        self.dis    = dd[-1]
+        self.count += len(x) - n
+        loc[n:], dis[n:] = self._output( ll[1:], dd[1:], dt[n:] )
+        otl[n:]     = oo[1:]
+        return loc, dis, otl
+
+# 2-D versions
+# ------------
+# The following functions process the columns of (T,N) matrices in parallel.
+# Per column, they return the same values as the 1-D functions above, except for the handling of NaN observations:
+# the 1-D functions return NaN estimates from the first NaN observation on, while the 2-D versions skip NaN observations:
+# initialization uses the first 'init' valid observations, and estimates are carried forward over NaN gaps.
+# Both share the update of a single step, _ew_step() and _dt_ew_step().
+
+def _column_params( x : np.ndarray, **params ) -> tuple:
+    """ Verify that 'x' is a matrix and broadcast each parameter to a vector with one element per column """
+    x = np.asarray(x)
+    _log.verify( len(x.shape) == 2, "'x' must be a matrix with time in the first coordinate and series in the second. Found shape %s", x.shape )
+    n = x.shape[1]
+    r = []
+    for name, v in params.items():
+        v = np.asarray(v)
+        _log.verify( v.shape in [(), (n,)], "'%s' must be a scalar or a vector with %ld elements. Found shape %s", name, n, v.shape )
+        r.append( np.ascontiguousarray( np.broadcast_to( v, (n,) ) ) )
+    return (x,) + tuple(r)
+
+@njit(nogil=True, cache=True)
+def _init_column( x, dt, j, dj, init ):
+    """
+    Returns the first 'init' valid observations of column 'j' of 'x', the corresponding elements of column 'dj' of 'dt'
+    if 'dt' is not empty, and the time index of the last of them. Returns index -1 if the column has no valid observations.
+    """
+    use_dt = dt.shape[0] > 0
+    buf    = np.empty( (init,), dtype=np.float64 )
+    bdt    = np.empty( (init,), dtype=np.float64 )
+    n      = 0
+    i0     = -1
+    for i in range(x.shape[0]):
+        if n >= init:
+            break
+        if np.isnan( x[i,j] ) or ( use_dt and np.isnan( dt[i,dj] ) ):
+            continue
+        buf[n] = x[i,j]
+        bdt[n] = dt[i,dj] if use_dt else 1.
+        n     += 1
+        i0     = i
+    return buf[:n], bdt[:n], i0
+
+@njit(parallel=True, cache=True)
+def _rolling_ew_2d( x, window, init, cutoff, robust ):
+    """ Kernel for rolling_ew_std_2d() and robust_rolling_ew_2d() """
+    T, N  = x.shape
+    loc   = np.full( (T,N), np.nan )
+    dis   = np.full( (T,N), np.nan )
+    otl   = np.zeros( (T,N), dtype=np.bool_ )
+    nodt  = np.zeros( (0,0) )
+    for j in prange(N):
+        buf, _, i0 = _init_column( x, nodt, j, 0, init[j] )
+        if i0 < 0:
+            continue
+        if robust:
+            l = np.median( buf )
+            d = madf * np.median( np.abs( buf - l ) )
+        else:
+            l = np.mean( buf )
+            d = np.mean( ( buf - l )**2 )
+        for i in range(i0+1):
+            loc[i,j] = l
+            dis[i,j] = d
+        w = 1./float(window[j])
+        for i in range(i0+1, T):
+            xi = x[i,j]
+            if np.isnan( xi ):
+                loc[i,j] = loc[i-1,j]
+                dis[i,j] = dis[i-1,j]
+                continue
+            loc[i,j], dis[i,j], otl[i,j] = _ew_step( xi, loc[i-1,j], dis[i-1,j], w, cutoff[j], robust )
+    return loc, dis, otl
+
+def rolling_ew_std_2d( x : np.ndarray, window, init = 10, cutoff = 2.5 ):
+    """
+    Applies rolling_ew_std() to each column of the matrix 'x' in parallel.
+    NaN observations are skipped: initialization uses the first 'init' valid observations of each column,
+    and estimates are carried forward over NaN gaps.
+
+    Parameters
+    ----------
+        x : matrix with time in the first coordinate and one series per column
+        window, init, cutoff : scalars, or vectors with one element per column. See rolling_ew_std()
+
+    Returns
+    -------
+        Matrices of means and vols
+    """
+    x, window, init, cutoff = _column_params( x, window=window, init=init, cutoff=cutoff )
+    _log.verify( np.all( init > 0 ), "'init' must be positive" )
+    loc, dis, _ = _rolling_ew_2d( x.astype(np.float64, copy=False), window.astype(np.float64), init.astype(np.int64), cutoff.astype(np.float64), False )
+    return loc, np.sqrt( dis )
+
+def robust_rolling_ew_2d( x : np.ndarray, window, init = 10, cutoff = 2.5 ):
+    """
+    Applies robust_rolling_ew() to each column of the matrix 'x' in parallel.
+    NaN observations are skipped: initialization uses the first 'init' valid observations of each column,
+    and estimates are carried forward over NaN gaps where no outliers are reported.
+
+    Parameters
+    ----------
+        x : matrix with time in the first coordinate and one series per column
+        window, init, cutoff : scalars, or vectors with one element per column. See robust_rolling_ew()
+
+    Returns
+    -------
+        Matrices of robust means, vols, and outlier detections
+    """
+    x, window, init, cutoff = _column_params( x, window=window, init=init, cutoff=cutoff )
+    _log.verify( np.all( init > 0 ), "'init' must be positive" )
+    return _rolling_ew_2d( x.astype(np.float64, copy=False), window.astype(np.float64), init.astype(np.int64), cutoff.astype(np.float64), True )
+
+@njit(nogil=True, cache=True)
+def _winverted_cdf_median( v, q ):
+    """ Weighted median with method 'inverted_cdf' as computed by np.quantile() """
+    ixs = np.argsort( v )
+    cdf = np.cumsum( q[ixs] )
+    cdf = cdf / cdf[-1]
+    k   = np.searchsorted( cdf, 0.5, side="left" )
+    return v[ixs[min(k,len(v)-1)]]
+
+@njit(parallel=True, cache=True)
+def _robust_rolling_dt_ew_2d( x, dt, twindow, init, cutoff, scale_by_dt, normalize_by_dt ):
+    """ Kernel for robust_rolling_dt_ew_2d() """
+    T, N  = x.shape
+    loc   = np.full( (T,N), np.nan )
+    dis   = np.full( (T,N), np.nan )
+    otl   = np.zeros( (T,N), dtype=np.bool_ )
+    dstep = 1 if dt.shape[1] > 1 else 0
+    for j in prange(N):
+        dj           = j*dstep
+        buf, bdt, i0 = _init_column( x, dt, j, dj, init[j] )
+        if i0 < 0:
+            continue
+        w  = - np.expm1( - bdt / twindow[j] )
+        q  = w / np.sum( w )
+        if not scale_by_dt:
+            l = _winverted_cdf_median( buf, q )
+            d = madf * _winverted_cdf_median( np.abs( buf - l ), q )
+        else:
+            l = _winverted_cdf_median( buf / bdt, q )
+            d = madf * _winverted_cdf_median( np.abs( buf - l * bdt ) / np.sqrt( bdt ), q )
+        for i in range(i0+1):
+            loc[i,j] = l
+            dis[i,j] = d
+        gap = 0.    # time elapsed over skipped observations, which adds to the decay of the next valid one
+        for i in range(i0+1, T):
+            xi  = x[i,j]
+            dti = dt[i,dj]
+            if np.isnan( xi ) or np.isnan( dti ):
+                loc[i,j] = loc[i-1,j]
+                dis[i,j] = dis[i-1,j]
+                if not np.isnan( dti ):
+                    gap += dti
+                continue
+            wi  = - np.expm1( - ( dti + gap ) / twindow[j] )
+            gap = 0.
+            loc[i,j], dis[i,j], otl[i,j] = _dt_ew_step( xi, dti, wi, loc[i-1,j], dis[i-1,j], cutoff[j], scale_by_dt )
+        if normalize_by_dt != scale_by_dt:
+            for i in range(T):
+                dti = dt[i,dj]
+                if normalize_by_dt:
+                    loc[i,j] /= dti
+                    dis[i,j] /= np.sqrt(dti)
+                else:
+                    loc[i,j] *= dti
+                    dis[i,j] *= np.sqrt(dti)
+    return loc, dis, otl
+
+def robust_rolling_dt_ew_2d( x  : np.ndarray,
+                             dt : np.ndarray,
+                             twindow = 0.25,
+                             init = 10,
+                             cutoff = 2.5,
+                             scale_by_dt : bool = False,
+                             normalize_by_dt : bool = False ):
+    """
+    Applies robust_rolling_dt_ew() to each column of the matrix 'x' in parallel.
+    In contrast to robust_rolling_dt_ew(), which returns NaN estimates from the first NaN observation on, NaN observations in 'x' or 'dt'
+    are skipped: initialization uses the first 'init' valid observations of each column, and estimates are carried forward over NaN gaps.
+    After initialization, the time steps 'dt' of skipped observations are added to the time step used for the weight of the next valid
+    observation, so the decay reflects the time elapsed over the gap; scaling by 'dt' uses the observation's own time step.
+    Estimates which are normalized or scaled by a NaN 'dt' are NaN.
+
+    Parameters
+    ----------
+        x : matrix with time in the first coordinate and one series per column
+        dt : vector of time steps shared by all series, or matrix of the same shape as 'x'
+        twindow, init, cutoff : scalars, or vectors with one element per column. See robust_rolling_dt_ew()
+        scale_by_dt, normalize_by_dt : see robust_rolling_dt_ew()
+
+    Returns
+    -------
+        Matrices of robust means, vols, and outlier detections
+    """
+    x, twindow, init, cutoff = _column_params( x, twindow=twindow, init=init, cutoff=cutoff )
+    _log.verify( np.all( init > 0 ), "'init' must be positive" )
+    dt = np.asarray( dt, dtype=np.float64 )
+    dt = dt[:,np.newaxis] if len(dt.shape) == 1 else dt
+    _log.verify( dt.shape in [ (x.shape[0],1), x.shape ], "'dt' must be a vector of length %ld or a matrix of shape %s. Found shape %s", x.shape[0], x.shape, dt.shape )
+    if scale_by_dt:
+        assert not np.nanmin( dt ) < nano_y, ("Found too smaLL 'dt':", np.nanmin(dt), "which is less than a nanosecond", nano_y )
+    return _robust_rolling_dt_ew_2d( x.astype(np.float64, copy=False), dt, twindow.astype(np.float64), init.astype(np.int64), cutoff.astype(np.float64),
+                                     bool(scale_by_dt), bool(normalize_by_dt) )
+
 # ------------------------------------------------
 # Data management
 # -------------------------------------------------
@@ -1101,4 +2226,70 @@ def pop( data, item, shape, optional = False, dtype : type = None ):
             assert shape is None or x.shape == shape, ("Shape error: does not match expected shape", item, x.shape, shape)
         if not dtype is None:
             assert x.dtype == dtype, ("Dtype error", item, dtype, x.dtype )
-    return x
\ No newline at end of file
+    return x
+
+# ------------------------------------------------
+# Compilation
+# -------------------------------------------------
+
+def warmup( dtypes : tuple = (np.float64, np.float32) ) -> float:
+    """
+    Compiles the numba kernels of this module for inputs of the given float dtypes by calling the respective functions with small inputs.
+
+    All kernels use numba's on-disk cache (cache=True). Hence only the first process compiles them, and every further process,
+    for example JCPool workers, loads them from disk. The cache is kept in the __pycache__ directory of this module or in
+    the directory set with the environment variable NUMBA_CACHE_DIR.
+    Call this function once in the main process before starting a pool of workers to have the kernels compiled only once.
+
+    Returns
+    -------
+        Number of seconds this took.
+    """
+    t0 = time.perf_counter()
+    for dtype in dtypes:
+        x  = np.linspace( -1., 1., 21, dtype=dtype )
+        X  = np.stack( [ x, x[::-1] ], axis=1 )
+        P  = np.full( x.shape, 1./len(x), dtype=dtype )
+        dt = np.full( x.shape, 1./255., dtype=dtype )
+        quantile( P, X, (0.1,0.5), axis=0 )
+        median_mad( P, X, axis=0 )
+        mean_bins( x, 3, P=P )
+        mean_std_bins( x, 3 )
+        flt_wsum( P, x )
+        flt_wsumsqm( P, x, x )
+        rolling_ew_std( x, 5, init=5 )
+        robust_rolling_ew( x, 5, init=5 )
+        robust_rolling_dt_ew( x, dt, init=5 )
+        robust_rolling_dt_ew( x, dt, init=5, scale_by_dt=True )
+        rolling_ew_std_2d( X, 5, init=5 )
+        robust_rolling_ew_2d( X, 5, init=5 )
+        robust_rolling_dt_ew_2d( X, dt, init=5 )
+    price = nb_european( ttm=1., vols=0.2, K=1., cp=1., price_only=True )
+    nb_implied_vol( price=price, ttm=1., K=1., cp=1. )
+    return time.perf_counter() - t0
+
+def startup_benchmark( dtypes : tuple = (np.float64, np.float32) ) -> dict:
+    """
+    Measures the time a fresh python process spends importing this module and calling warmup() for 'dtypes',
+    once with an empty numba cache ('cold') and once loading the kernels from the cache written by the first process ('warm').
+    The cache is kept in a temporary directory.
+
+    Returns
+    -------
+        Dictionary with the seconds spent on 'cold_import', 'cold_warmup', 'warm_import', 'warm_warmup'
+    """
+    code = "import time; t=time.perf_counter(); import numpy as np; import cdxbasics.np as cnp; t=time.perf_counter()-t; " +\
+           "print(t, cnp.warmup((%s)))" % ( "".join( "np.%s," % np.dtype(_).name for _ in dtypes ) )
+    path = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+    r    = PrettyOrderedDict()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict( os.environ, NUMBA_CACHE_DIR=cache_dir, PYTHONPATH=os.pathsep.join( [path, os.environ.get("PYTHONPATH","")] ) )
+        for run in ["cold", "warm"]:
+            out = subprocess.run( [ sys.executable, "-c", code ], env=env, capture_output=True, text=True, check=True ).stdout.split()
+            r[run+"_import"] = float(out[-2])
+            r[run+"_warmup"] = float(out[-1])
+    return r
+
+if __name__ == "__main__":
+    for k, v in startup_benchmark().items():
+        print("%s: %.3fs" % (k, v))
@@ -5,8 +5,19 @@ Hans Buehler 2023
 
 from .logger import Logger
 from .util import fmt_digits
+from . import perf as perf
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from collections.abc import Mapping
 import numpy as np
-import numba as numba
+import os as os
+import io as io
+import json as json
+
+try:
+    import blosc as blosc
+except ModuleNotFoundError:
+    blosc = None
 
 _log = Logger(__file__)
 
@@ -29,71 +40,211 @@ dtype_map = {
     }
 dtype_rev = { v:k for k,v in dtype_map.items() }
 
+NPIO_MAGIC   = 0xFFFF      # first two bytes of a versioned header; version 0 files start with the number of dimensions instead
+NPIO_VERSION = 1           # version written by tofile() without compression
+NPIO_CHUNKED = 2           # version written by tofile() with compression: the array is split into compressed chunks of rows
+NPIO_ALIGN   = 64          # alignment of the array data in files of version 1
+NPIO_CHUNK_BYTES = 1024*1024*4  # default uncompressed size of the chunks of compressed files
+NPIO_THREADS = None        # default number of threads to compress and decompress chunks; None for os.cpu_count()
+
+_CODEC_NONE  = 0
+_CODEC_BLOSC = 1
+
+def _align( pos : int, align : int = NPIO_ALIGN ) -> int:
+    return ( (pos + align - 1) // align ) * align
+
+def _header_fixed( ndim : int ) -> int:
+    """ Size of the version 1 header without padding: magic, version, number of dimensions, shape, dtype, padding length """
+    return 2 + 1 + 2 + 8*ndim + 1 + 2
+
+def header_size( ndim : int, pos : int = 0 ) -> int:
+    """
+    Returns the number of bytes of the header written by tofile() for an array with 'ndim' dimensions
+    if the header starts at position 'pos' of the file.
+    """
+    return _align( pos + _header_fixed(ndim) ) - pos
+
 def _write_int(f,x,lbytes):
     x = int(x).to_bytes(lbytes,"big")
     w = f.write( x )
     if w != len(x):
         raise IOError(f"could only write {w} bytes, not {len(x)}.")
 
-def _tofile(f, array : np.ndarray, dtype_map : dict ):
-    # split into chunks
-    array    = np.asarray( array )
-    dtypec   = np.int8(dtype_map[ str(array.dtype) ] )
-    length   = np.int64( np.product( array.shape, dtype=np.uint64 ) )
-    shape32  = tuple( [np.int32(i) for i in array.shape])
+def _writeheader( f, version : int, shape : tuple, dtypec : int, chunks : bytes = b"" ):
+    """
+    Write header: magic, version, shape and dtype.
+    Version 1 headers end with padding up to the aligned data offset; version 2 headers end with 'chunks'.
+    """
+    header = NPIO_MAGIC.to_bytes(2,"big") + int(version).to_bytes(1,"big") + len(shape).to_bytes(2,"big")   # max 32k dimension
+    header += b"".join( [ int(i).to_bytes(8,"big") for i in shape ] )
+    header += int(dtypec).to_bytes(1,"big")
+    if version == NPIO_VERSION:
+        try:
+            pos = f.tell()
+        except (AttributeError, OSError):
+            pos = 0  # not seekable: align relative to the start of the header
+        pad    = header_size( len(shape), pos ) - _header_fixed( len(shape) )
+        header += pad.to_bytes(2,"big") + bytes(pad)
+    else:
+        header += chunks
+    nw = f.write( header )
+    if nw != len(header):
+        raise IOError(f"could only write {nw} bytes, not {len(header)}.")
+
+def _writedata(f, array : np.ndarray ):
+    """ Write the data of the contiguous 'array' in chunks of at most 1GB """
+    length   = int( np.prod( array.shape, dtype=np.uint64 ) )
     array    = np.reshape( array, (length,) )  # this operation should not reallocate any memory
     dsize    = int(array.itemsize)   
     max_size = int(1024*1024*1024//dsize)
     num      = int(length-1)//max_size+1        
     saved    = 0
-
-    # write shape
-    _write_int( f, len(shape32), 2 )  # max 32k dimension
-    for i in shape32:
-        _write_int(f, i, 4) # max 32 bit resolution
-    # write dtype
-    _write_int(f, dtypec, 1)
-    # write object      
     for j in range(num):
         s   = j*max_size
         e   = min(s+max_size, length)
         bts = array.data[s:e]
         nw  = f.write( bts )
         if nw != (e-s)*dsize:
-            raise IOError(asked= (e-s)*dsize, recevied=nw)
+            raise IOError(f"could only write {fmt_digits(nw)} of {fmt_digits((e-s)*dsize)} bytes.")
         saved += nw
     if saved != length*dsize:
-        return IOError(asked=length*dsize, recevied=saved)
+        raise IOError(f"could only write {fmt_digits(saved)} of {fmt_digits(length*dsize)} bytes.")
+
+def _tofile(f, array : np.ndarray, dtype_map : dict ):
+    array    = np.asarray( array )
+    shape    = tuple( [int(i) for i in array.shape] )
+    dtypec   = np.int8(dtype_map[ str(array.dtype) ] )
+    _writeheader( f, NPIO_VERSION, shape, dtypec )
+    _writedata( f, array )
+
+def _threads( threads : int = None ) -> int:
+    """ Number of threads for compression """
+    threads = threads if not threads is None else NPIO_THREADS
+    return max( 1, int(threads) if not threads is None else ( os.cpu_count() or 1 ) )
+
+def _row_bytes( shape : tuple, itemsize : int ) -> int:
+    """ Number of bytes per row along the first axis, where 0-dimensional arrays count as one row """
+    return int( np.prod( shape[1:], dtype=np.uint64 ) ) * int(itemsize)
+
+def _chunk_rows( shape : tuple, itemsize : int, chunk_rows : int = None ) -> int:
+    """ Number of rows per chunk for an array of 'shape' where 0-dimensional arrays count as one row """
+    if not chunk_rows is None:
+        _log.verify( chunk_rows > 0, "'chunk_rows' must be positive; found %ld", chunk_rows )
+        return int(chunk_rows)
+    return max( 1, NPIO_CHUNK_BYTES // max( _row_bytes( shape, itemsize ), 1 ) )
+
+def _tofile_chunked(f, array : np.ndarray, dtype_map : dict, compression : str, clevel : int, chunk_rows : int, threads : int ):
+    """
+    Write 'array' as a version 2 file: the array is split along its first axis into chunks of 'chunk_rows' rows
+    which are compressed independently with blosc in a pool of 'threads' threads.
+    The header contains the compressed size of each chunk, which allows reading ranges of rows.
+    """
+    array    = np.asarray( array )
+    shape    = tuple( [int(i) for i in array.shape] )
+    dtypec   = dtype_map[ str(array.dtype) ]
+    rows     = np.reshape( array, (1,) ) if array.ndim == 0 else array
+    nrows    = rows.shape[0]
+    itemsize = int(array.itemsize)
+    nchunks  = ( nrows + chunk_rows - 1 ) // chunk_rows
+
+    def compress(j):
+        data = rows[j*chunk_rows:(j+1)*chunk_rows].reshape((-1,)).view(np.uint8)
+        return blosc.compress( data, typesize=itemsize, clevel=clevel, shuffle=blosc.SHUFFLE, cname=compression )
+    def chunks( sizes ):
+        return _CODEC_BLOSC.to_bytes(1,"big") + chunk_rows.to_bytes(8,"big") + nchunks.to_bytes(8,"big") + np.asarray( sizes, dtype=">u8" ).tobytes()
+    def write( block ):
+        nw = f.write( block )
+        if nw != len(block):
+            raise IOError(f"could only write {nw} bytes, not {len(block)}.")
+        perf.count("npio.compressed_bytes_written", nw)
+        return nw
+
+    try:
+        seekable = f.seekable()
+    except AttributeError:
+        seekable = False
+    with ThreadPoolExecutor( max_workers=threads ) as pool:
+        if not seekable:
+            blocks = list( pool.map( compress, range(nchunks) ) )
+            _writeheader( f, NPIO_CHUNKED, shape, dtypec, chunks( [ len(b) for b in blocks ] ) )
+            for block in blocks:
+                write( block )
+            return
+
+        # write header with an empty index, then stream chunks in order while compressing ahead; finally write the index
+        start = f.tell()
+        _writeheader( f, NPIO_CHUNKED, shape, dtypec, chunks( np.zeros((nchunks,)) ) )
+        sizes   = []
+        pending = []
+        for j in range(nchunks):
+            pending.append( pool.submit( compress, j ) )
+            if len(pending) > 2*threads:
+                sizes.append( write( pending.pop(0).result() ) )
+        for job in pending:
+            sizes.append( write( job.result() ) )
+        end = f.tell()
+        f.seek( start )
+        _writeheader( f, NPIO_CHUNKED, shape, dtypec, chunks( sizes ) )
+        f.seek( end )
 
 def tofile( file,
             array        : np.ndarray, *,
-            buffering    : int = -1
+            buffering    : int = -1,
+            compression  : str = None,
+            clevel       : int = 5,
+            chunk_rows   : int = None,
+            threads      : int = None
             ):
     """
     Write 'array' into file using a binary format.
     This function will work for unbuffered files exceeding 2GB which is the usual unbuffered write() limitation on Linux.
     This function will only work with the types contained in 'dtype_map'
+
+    If 'compression' is specified, the array is split along its first axis into chunks which are compressed
+    independently using https://www.blosc.org/python-blosc/ in a pool of threads.
+    npio does not change global blosc settings: the threads compress chunks concurrently only if the application
+    called blosc.set_releasegil(True), typically together with blosc.set_nthreads(1). Otherwise, the pool overlaps
+    compression with writing, and blosc.set_nthreads() controls the threads blosc uses for each chunk.
+    Use fromfile(rows=...) to read ranges of rows without decompressing the entire file.
+    Compressed files cannot be memory mapped.
     
     Parameters
     ----------
         file  : file name passed to open() or an open file handle
         array : numpy or sharedarray
         buffering : see open(). Use 0 to turn off buffering.
+        compression : None for raw data, or the name of a blosc compressor, e.g. 'zstd', 'lz4', 'blosclz'. See blosc.compressor_list().
+        clevel : compression level from 0 to 9.
+        chunk_rows : number of rows per compressed chunk. The default uses chunks of about NPIO_CHUNK_BYTES bytes.
+        threads : number of threads used for compression. The default is NPIO_THREADS, or the number of CPUs if that is None.
     """
     if isinstance(file, str):
         with open( file, "wb", buffering=buffering ) as f:
-            return tofile(f, array, buffering=buffering)
+            return tofile(f, array, buffering=buffering, compression=compression, clevel=clevel, chunk_rows=chunk_rows, threads=threads)
     f = file
     del file
     
     if not array.data.contiguous:
         _log.warn("Array is not 'contiguous'. Is that an issue??")
         array    = np.ascontiguousarray( array, dtype=array.dtype ) if not array.data.contiguous else array
-        
-    try:
-        _tofile(f, array=array, dtype_map=dtype_map )
-    except IOError as e:
-        _log.throw(f"Could not write all {fmt_digits(array.nbytes)} bytes to {f.name}: {str(e)}.")
+
+    if not compression is None:
+        if blosc is None: _log.throw("Package 'blosc' not found. Please pip install")
+        _log.verify( compression in blosc.compressor_list(), "Unknown compression '%s'. Use one of: %s", compression, blosc.compressor_list() )
+        chunk_rows = _chunk_rows( array.shape, array.itemsize, chunk_rows )
+        _log.verify( chunk_rows * _row_bytes( array.shape, array.itemsize ) <= blosc.MAX_BUFFERSIZE,
+                     "'chunk_rows' %ld is too large: blosc cannot compress more than %s bytes at once", chunk_rows, fmt_digits(blosc.MAX_BUFFERSIZE) )
+        try:
+            _tofile_chunked(f, array=array, dtype_map=dtype_map, compression=compression, clevel=clevel, chunk_rows=chunk_rows, threads=_threads(threads) )
+        except IOError as e:
+            _log.throw(f"Could not write all {fmt_digits(array.nbytes)} bytes to {f.name}: {str(e)}.")
+    else:
+        try:
+            _tofile(f, array=array, dtype_map=dtype_map )
+        except IOError as e:
+            _log.throw(f"Could not write all {fmt_digits(array.nbytes)} bytes to {f.name}: {str(e)}.")
+    perf.count("npio.arrays_written")
+    perf.count("npio.bytes_written", array.nbytes)
 
 def _read_int(f, lbytes) -> int:
     x = f.read(lbytes)
@@ -105,7 +256,7 @@ def _read_int(f, lbytes) -> int:
 def _readfromfile( f, array ):
     # split into chunks
     shape    = array.shape
-    length   = int( np.product( array.shape, dtype=np.uint64 ) )
+    length   = int( np.prod( array.shape, dtype=np.uint64 ) )
     array    = np.reshape( array, (length,) )
     dsize    = int(array.itemsize)
     max_size = int(1024*1024*1024//dsize)
@@ -123,21 +274,163 @@ def _readfromfile( f, array ):
         raise IOError(f"could only read {fmt_digits(read)} of {fmt_digits(length*dsize)} bytes.")
     return np.reshape( array, shape )  # no copy
 
-def _readheader(f):
+NPIO_PARALLEL_MIN_BYTES = 1024*1024*64   # minimum number of bytes per thread when reading raw files in parallel
+
+def _readparallel( f, array, threads : int ):
+    """
+    Read raw data into 'array' with up to 'threads' threads, each reading a separate range of the file with os.preadv().
+    Falls back to _readfromfile() if the file has no file descriptor or the platform does not support os.preadv().
+    """
+    try:
+        fd = f.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        fd = None
+    nbytes = int(array.nbytes)
+    num    = min( threads, nbytes // NPIO_PARALLEL_MIN_BYTES )
+    if fd is None or not hasattr(os, "preadv") or num <= 1:
+        return _readfromfile( f, array )
+    assert array.flags.c_contiguous, ("Target array must be contiguous")
+    base   = f.tell()
+    data   = np.reshape( array, (-1,) ).view(np.uint8)
+    block  = ( nbytes + num - 1 ) // num
+
+    def read( s ):
+        e  = min( s+block, nbytes )
+        mv = memoryview( data[s:e] )
+        while s < e:
+            nr = os.preadv( fd, [ mv[:1024*1024*1024] ], base+s )
+            if nr <= 0:
+                raise IOError(f"could only read {fmt_digits(s)} of {fmt_digits(e)} bytes.")
+            mv = mv[nr:]
+            s += nr
+    with ThreadPoolExecutor( max_workers=num ) as pool:
+        for job in [ pool.submit( read, s ) for s in range(0, nbytes, block) ]:
+            job.result()
+    f.seek( base + nbytes )
+    return array
+
+def _readheader_chunks(f):
     """
-    Read shape, dtype
+    Read shape, dtype and, for compressed files, the chunk index (codec, chunk_rows, sizes); the latter is None for raw files.
+    Leaves 'f' positioned at the start of the array data.
+    Handles files written before the header carried a version (version 0) which start with the number of dimensions
+    and store each dimension with 4 bytes.
     """
     shape_len  = _read_int(f,2)
-    shape      = tuple( [ int(_read_int(f,4)) for _ in range(shape_len) ] )
+    if shape_len != NPIO_MAGIC:
+        shape  = tuple( [ int(_read_int(f,4)) for _ in range(shape_len) ] )
+        dtype  = dtype_rev[_read_int(f,1)]
+        return shape, dtype, None
+    version    = _read_int(f,1)
+    if version > NPIO_CHUNKED:
+        raise IOError(f"file format version {version} is not supported; upgrade cdxbasics to read it (supported up to version {NPIO_CHUNKED}).")
+    shape_len  = _read_int(f,2)
+    shape      = tuple( [ int(_read_int(f,8)) for _ in range(shape_len) ] )
     dtype      = dtype_rev[_read_int(f,1)]
+    if version == NPIO_CHUNKED:
+        codec      = _read_int(f,1)
+        chunk_rows = _read_int(f,8)
+        nchunks    = _read_int(f,8)
+        sizes      = f.read(8*nchunks)
+        if len(sizes) != 8*nchunks:
+            raise IOError("could only read part of the chunk index.")
+        if codec != _CODEC_BLOSC:
+            raise IOError(f"unknown compression codec {codec}.")
+        return shape, dtype, ( codec, chunk_rows, np.frombuffer( sizes, dtype=">u8" ).astype(np.int64) )
+    pad        = _read_int(f,2)
+    if pad > 0 and len(f.read(pad)) != pad:
+        raise IOError("could only read header padding.")
+    return shape, dtype, None
+
+def _readheader(f):
+    """
+    Read shape, dtype and leave 'f' positioned at the start of the array data.
+    """
+    shape, dtype, _ = _readheader_chunks(f)
     return shape, dtype
 
+def _skip(f):
+    """
+    Skip the array at the current position of 'f', leaving 'f' positioned after the array data.
+    """
+    shape, dtype, chunks = _readheader_chunks(f)
+    if chunks is None:
+        nbytes = int( np.prod( shape, dtype=np.uint64 ) ) * np.dtype(dtype).itemsize
+    else:
+        nbytes = int( np.sum( chunks[2] ) )
+    f.seek( nbytes, os.SEEK_CUR )
+
+def _row_range( rows : slice, shape : tuple ) -> tuple:
+    """ Returns start and stop of 'rows' for an array of 'shape', or (0, shape[0]) if 'rows' is None """
+    if rows is None:
+        return 0, ( shape[0] if len(shape) > 0 else 1 )
+    _log.verify( len(shape) > 0, "Cannot read 'rows' of a 0-dimensional array" )
+    _log.verify( isinstance(rows, slice), "'rows' must be a slice; found %s", type(rows).__name__ )
+    start, stop, step = rows.indices( shape[0] )
+    _log.verify( step == 1, "'rows' must have step 1; found %ld", step )
+    return start, max( start, stop )
+
+def _chunk_offsets( f, chunks : tuple ) -> np.ndarray:
+    """ Positions of the compressed chunks and of the end of the data, for 'f' positioned at the start of the compressed data """
+    return f.tell() + np.concatenate( [ [0], np.cumsum( chunks[2] ) ] )
+
+def _readchunked( f, array : np.ndarray, shape : tuple, chunks : tuple, start : int, threads : int, offsets : np.ndarray = None ):
+    """
+    Read rows start:start+len(array) of a compressed array of 'shape' into 'array', decompressing chunks in a pool of 'threads' threads.
+    'f' must be positioned at the start of the compressed data unless 'offsets' computed with _chunk_offsets() are given.
+    'f' is left positioned at the end of the compressed data.
+    """
+    _, chunk_rows, sizes = chunks
+    offsets  = _chunk_offsets( f, chunks ) if offsets is None else offsets
+    rows     = np.reshape( array, (1,) ) if len(shape) == 0 else array
+    nrows    = shape[0] if len(shape) > 0 else 1
+    stop     = start + rows.shape[0]
+    row_size = _row_bytes( shape, array.itemsize )
+    assert rows.flags.c_contiguous, ("Target array must be contiguous")
+
+    def decompress( j, block ):
+        s = j*chunk_rows
+        e = min( s+chunk_rows, nrows )
+        if row_size*(e-s) == 0:
+            return
+        if s >= start and e <= stop:
+            target = rows[s-start:e-start]
+        else:
+            target = np.empty( (e-s,)+rows.shape[1:], dtype=rows.dtype )
+        nr = blosc.decompress_ptr( block, target.ctypes.data )
+        if nr != target.nbytes:
+            raise IOError(f"chunk {j} has {fmt_digits(nr)} bytes, not {fmt_digits(target.nbytes)}.")
+        if not ( s >= start and e <= stop ):
+            a = max( s, start )
+            b = min( e, stop )
+            rows[a-start:b-start] = target[a-s:b-s]
+
+    if stop > start:
+        c0 = start // chunk_rows
+        c1 = ( stop - 1 ) // chunk_rows + 1
+        f.seek( int(offsets[c0]) )
+        with ThreadPoolExecutor( max_workers=threads ) as pool:
+            pending = []
+            for j in range(c0, c1):
+                block = f.read( int(sizes[j]) )
+                if len(block) != sizes[j]:
+                    raise IOError(f"could only read {fmt_digits(len(block))} of {fmt_digits(int(sizes[j]))} bytes of chunk {j}.")
+                perf.count("npio.compressed_bytes_read", len(block))
+                pending.append( pool.submit( decompress, j, block ) )
+                if len(pending) > 2*threads:
+                    pending.pop(0).result()
+            for job in pending:
+                job.result()
+    f.seek( int(offsets[-1]) )
+
 def readfromfile( file, 
                   target         : np.ndarray, *, 
                   read_only      : bool = False,
                   buffering      : int  = -1,
                   validate_dtype : type = None,
-                  validate_shape : tuple = None
+                  validate_shape : tuple = None,
+                  rows           : slice = None,
+                  threads        : int = None
                   ) -> np.ndarray:
     """
     Read array from disk into an existing array or into a new array.
@@ -153,6 +446,11 @@ def readfromfile( file,
         buffering : see open(); -1 is the default, 0 for no buffering.
         validate_dtype: if specified, check that the array has the specified dtype
         validate_shape: if specified, check that the array has the specified shape
+        rows      : if specified, a slice with step 1 of the rows along the first axis to read, e.g. slice(100,200).
+                    For compressed files only the chunks containing these rows are decompressed.
+        threads   : number of threads used to decompress compressed files. The default is NPIO_THREADS, or the number of CPUs if that is None.
+                    Raw files are read with a single thread by default; if 'threads' is larger than one, large raw files are read with os.preadv()
+                    in parallel ranges of at least NPIO_PARALLEL_MIN_BYTES bytes.
         
     Returns
     -------
@@ -164,17 +462,24 @@ def readfromfile( file,
                                  read_only=read_only,
                                  buffering=buffering,
                                  validate_dtype=validate_dtype,
-                                 validate_shape=validate_shape )
+                                 validate_shape=validate_shape,
+                                 rows=rows,
+                                 threads=threads )
     f = file
     del file
         
     # read shape
-    shape, dtype = _readheader(f)
+    try:
+        file_shape, dtype, chunks = _readheader_chunks(f)
+    except IOError as e:
+        _log.throw(f"Cannot read from {f.name}: {str(e)}")
 
     if not validate_dtype is None and validate_dtype != dtype:
         _log.throw(f"Failed to read {f.name}: found type {dtype} expected {validate_dtype}.")
-    if not validate_shape is None and validate_shape != shape:
-        _log.throw(f"Failed to read {f.name}: found type {shape} expected {validate_shape}.")
+    if not validate_shape is None and validate_shape != file_shape:
+        _log.throw(f"Failed to read {f.name}: found type {file_shape} expected {validate_shape}.")
+    start, stop = _row_range( rows, file_shape )
+    shape       = file_shape if rows is None else (stop-start,)+file_shape[1:]
 
     # handle array
     if isinstance(target, np.ndarray):
@@ -190,9 +495,25 @@ def readfromfile( file,
     del target
 
     try:
-        _readfromfile(f, array)
+        if not chunks is None:
+            if blosc is None: _log.throw("Package 'blosc' not found. Please pip install")
+            _readchunked(f, array, file_shape, chunks, start, _threads(threads) )
+        else:
+            row_size = _row_bytes( file_shape, array.itemsize )
+            nrows    = file_shape[0] if len(file_shape) > 0 else 1
+            data     = f.tell()
+            if start > 0:
+                f.seek( data + start*row_size )
+            if not threads is None and threads > 1:
+                _readparallel(f, array, threads)
+            else:
+                _readfromfile(f, array)
+            if stop < nrows:
+                f.seek( data + nrows*row_size )
     except IOError as e:
         _log.throw(f"Cannot read from {f.name}: {str(e)}")
+    perf.count("npio.arrays_read")
+    perf.count("npio.bytes_read", array.nbytes)
     if read_only:
         array.flags.writeable  = False
 
@@ -234,7 +555,39 @@ def readinto( file, array : np.ndarray, *, read_only : bool = False, buffering :
     """
     return readfromfile( file, target = array, read_only=read_only, buffering=buffering )
 
-def fromfile( file, *, validate_dtype = None, validate_shape = None, read_only : bool = False, buffering : int = -1  ) -> np.ndarray:
+def _memmap( f, read_only : bool, validate_dtype, validate_shape, rows : slice ) -> np.ndarray:
+    """
+    Map the array at the current position of the open file 'f' into memory.
+    Leaves 'f' positioned after the array data.
+    """
+    try:
+        shape, dtype, chunks = _readheader_chunks(f)
+    except IOError as e:
+        _log.throw(f"Cannot read from {f.name}: {str(e)}")
+    if not validate_dtype is None and validate_dtype != dtype:
+        _log.throw(f"Failed to read {f.name}: found type {dtype} expected {validate_dtype}.")
+    if not validate_shape is None and validate_shape != shape:
+        _log.throw(f"Failed to read {f.name}: found type {shape} expected {validate_shape}.")
+    _log.verify( chunks is None, "Cannot memory map %s: the array is compressed", f.name )
+
+    data     = f.tell()
+    row_size = _row_bytes( shape, np.dtype(dtype).itemsize )
+    nbytes   = int( np.prod( shape, dtype=np.uint64 ) ) * np.dtype(dtype).itemsize
+    start, stop = _row_range( rows, shape )
+    if not rows is None:
+        shape = (stop-start,)+shape[1:]
+    if int( np.prod( shape, dtype=np.uint64 ) ) == 0:
+        # np.memmap cannot map zero bytes
+        array = np.empty( shape=shape, dtype=dtype )
+    else:
+        array = np.memmap( f.name, dtype=dtype, mode="r" if read_only else "c", offset=data + start*row_size, shape=shape )
+    f.seek( data + nbytes )
+    perf.count("npio.arrays_mapped")
+    if read_only:
+        array.flags.writeable = False
+    return array
+
+def fromfile( file, *, validate_dtype = None, validate_shape = None, read_only : bool = False, buffering : int = -1, mmap : bool = False, rows : slice = None, threads : int = None ) -> np.ndarray:
     """
     Read array from disk into a new numpy array.
     Use sharedarray.shared_fromfile() to create a shared array
@@ -246,17 +599,439 @@ def fromfile( file, *, validate_dtype = None, validate_shape = None, read_only :
         validate_dtype: if specified, check that the array has the specified dtype
         validate_shape: if specified, check that the array has the specified shape
         buffering : see open(); -1 is the default, 0 for no buffering.
+        mmap     : if True, do not read the data but return an np.memmap of the array in the file.
+                   The map is read-only if 'read_only' is True, and copy-on-write otherwise, i.e. changes to the array are not written back to the file.
+                   Processes mapping the same file share its pages through the operating system's page cache.
+                   Files written by tofile() align the data to NPIO_ALIGN bytes; older files can be mapped, too, but their data may not be aligned.
+                   Compressed files cannot be mapped.
+        rows     : if specified, a slice with step 1 of the rows along the first axis to read, e.g. slice(100,200).
+                   For compressed files only the chunks containing these rows are decompressed.
+        threads  : number of threads used to decompress compressed files. The default is NPIO_THREADS, or the number of CPUs if that is None.
+                   Raw files are read with a single thread unless 'threads' is larger than one; see readfromfile().
 
     Returns
     -------
-        Newly created numpy array
+        Newly created numpy array, or np.memmap
     """
+    if mmap:
+        if isinstance(file, str):
+            with open( file, "rb", buffering=buffering ) as f:
+                return _memmap( f, read_only=read_only, validate_dtype=validate_dtype, validate_shape=validate_shape, rows=rows )
+        return _memmap( file, read_only=read_only, validate_dtype=validate_dtype, validate_shape=validate_shape, rows=rows )
     return readfromfile( file,
                          target=lambda shape, dtype : np.empty( shape=shape, dtype=dtype ),
                          read_only = read_only, 
                          validate_dtype=validate_dtype, 
                          validate_shape=validate_shape,
-                         buffering=buffering )
-        
+                         buffering=buffering,
+                         rows=rows,
+                         threads=threads )
+
+def iterchunks( file, chunk_rows : int = None, *, buffering : int = -1, threads : int = None ):
+    """
+    Iterate through an array on disk in chunks of rows along its first axis, without reading the entire array into memory.
+
+        for x in npio.iterchunks( "paths.bin", 10000 ):
+            ...
+
+    Parameters
+    ----------
+        file       : file name passed to open(), or an open file
+        chunk_rows : number of rows per chunk. The default for compressed files is the number of rows of their compressed chunks,
+                     and chunks of about NPIO_CHUNK_BYTES bytes otherwise.
+        buffering  : see open(); -1 is the default, 0 for no buffering.
+        threads    : number of threads used to decompress compressed files.
+
+    Returns
+    -------
+        Generator of newly created numpy arrays. If 'file' is an open file, it is positioned after the array once the generator is exhausted.
+    """
+    if isinstance(file, str):
+        with open( file, "rb", buffering=buffering ) as f:
+            yield from iterchunks( f, chunk_rows, threads=threads )
+        return
+    f = file
+    del file
+
+    try:
+        shape, dtype, chunks = _readheader_chunks(f)
+    except IOError as e:
+        _log.throw(f"Cannot read from {f.name}: {str(e)}")
+    _log.verify( len(shape) > 0, "Cannot iterate through a 0-dimensional array in %s", f.name )
+    if chunk_rows is None:
+        chunk_rows = chunks[1] if not chunks is None else _chunk_rows( shape, np.dtype(dtype).itemsize )
+    _log.verify( chunk_rows > 0, "'chunk_rows' must be positive; found %ld", chunk_rows )
+    # the header and chunk index are read only once
+    data     = f.tell()
+    row_size = _row_bytes( shape, np.dtype(dtype).itemsize )
+    if not chunks is None:
+        if blosc is None: _log.throw("Package 'blosc' not found. Please pip install")
+        offsets = _chunk_offsets( f, chunks )
+        end     = int(offsets[-1])
+    else:
+        end     = data + shape[0]*row_size
+    for i in range(0, shape[0], chunk_rows):
+        array = np.empty( shape=(min(chunk_rows, shape[0]-i),)+shape[1:], dtype=dtype )
+        try:
+            if not chunks is None:
+                _readchunked( f, array, shape, chunks, i, _threads(threads), offsets=offsets )
+            else:
+                f.seek( data + i*row_size )
+                if not threads is None and threads > 1:
+                    _readparallel( f, array, threads )
+                else:
+                    _readfromfile( f, array )
+        except IOError as e:
+            _log.throw(f"Cannot read from {f.name}: {str(e)}")
+        perf.count("npio.arrays_read")
+        perf.count("npio.bytes_read", array.nbytes)
+        yield array
+    f.seek( end )   # position 'f' after the array
+
+class ArrayWriter(object):
+    """
+    Writes an array into a file in chunks of rows along its first axis, for arrays which are too large
+    to be held in memory or which grow over time.
+
+        with npio.ArrayWriter( "paths.bin" ) as w:
+            for batch in simulation():
+                w.write( batch )
+
+    The header of the file is updated with the number of rows written when flush() or close() are called.
+    Until then, readers see the rows written before the last update.
+    Use mode 'a' to append rows to an existing file written by tofile() or ArrayWriter.
+    Files are not compressed; use iterchunks() or fromfile(rows=...) to read them in chunks.
+    """
+
+    def __init__(self, file : str, mode : str = "w", *, dtype = None, row_shape : tuple = None, buffering : int = -1 ):
+        """
+        Open a file for writing.
+
+        Parameters
+        ----------
+            file : file name
+            mode : 'w' to create a new file, 'a' to append rows to an existing file or to create a new one.
+            dtype : dtype of the array. If None, the dtype of the first chunk written is used.
+            row_shape : shape of each row, i.e. the shape of the array without its first axis. If None, the shape of the first chunk written is used.
+            buffering : see open()
+        """
+        _log.verify( mode in ['w', 'a'], "'mode' must be 'w' or 'a'; found '%s'", mode )
+        if mode == 'a' and not os.path.exists(file):
+            mode = 'w'
+        self.name      = file
+        self.dtype     = np.dtype(dtype) if not dtype is None else None
+        self.row_shape = tuple( [int(i) for i in row_shape] ) if not row_shape is None else None
+        self.rows      = 0
+        self._header   = False
+        self._f        = open( file, "wb" if mode == 'w' else "r+b", buffering=buffering )
+        if mode == 'w':
+            return
+        try:
+            self._open_append()
+        except:
+            self._f.close()
+            raise
+
+    def _open_append(self):
+        """ Read the header of an existing file and position the file at the end of its data """
+        f = self._f
+        try:
+            magic = _read_int(f,2)
+            f.seek(0)
+            shape, dtype, chunks = _readheader_chunks(f)
+        except IOError as e:
+            _log.throw(f"Cannot append to {f.name}: {str(e)}")
+        _log.verify( magic == NPIO_MAGIC and chunks is None, "Cannot append to %s: can only append to files which are not compressed and were written with format version %ld", f.name, NPIO_VERSION )
+        _log.verify( len(shape) > 0, "Cannot append to %s: the array is 0-dimensional", f.name )
+        _log.verify( self.dtype is None or self.dtype == np.dtype(dtype), "Cannot append to %s: file has dtype %s, not %s", f.name, dtype, self.dtype )
+        _log.verify( self.row_shape is None or self.row_shape == shape[1:], "Cannot append to %s: file has rows of shape %s, not %s", f.name, shape[1:], self.row_shape )
+        self.dtype     = np.dtype(dtype)
+        self.row_shape = shape[1:]
+        self.rows      = shape[0]
+        self._header   = True
+        end = f.tell() + self.rows * _row_bytes( shape, self.dtype.itemsize )
+        _log.verify( f.seek(0, os.SEEK_END) == end, "Cannot append to %s: the file does not end with the array data", f.name )
+
+    @property
+    def shape(self) -> tuple:
+        """ Shape of the array written so far """
+        return (self.rows,) + ( self.row_shape if not self.row_shape is None else () )
+
+    def _write_header(self):
+        """ Write the header for the current number of rows at the start of the file """
+        end = self._f.tell()
+        self._f.seek(0)
+        _writeheader( self._f, NPIO_VERSION, self.shape, dtype_map[ str(self.dtype) ] )
+        if end > 0:
+            self._f.seek(end)
+        self._header = True
+
+    def write(self, chunk : np.ndarray ):
+        """ Append 'chunk' to the array. 'chunk' must have at least one dimension, and its rows must have shape 'row_shape'. """
+        _log.verify( not self._f.closed, "ArrayWriter for %s is closed", self.name )
+        chunk = np.asarray( chunk )
+        _log.verify( chunk.ndim > 0, "Cannot write a 0-dimensional array" )
+        if self.dtype is None:
+            self.dtype = chunk.dtype
+        if self.row_shape is None:
+            self.row_shape = tuple( [int(i) for i in chunk.shape[1:]] )
+        _log.verify( str(self.dtype) in dtype_map, "Cannot write dtype %s", self.dtype )
+        _log.verify( chunk.shape[1:] == self.row_shape, "Cannot write chunk of shape %s: rows must have shape %s", chunk.shape, self.row_shape )
+        chunk = np.ascontiguousarray( chunk, dtype=self.dtype )
+        if not self._header:
+            self._write_header()
+        try:
+            _writedata( self._f, chunk )
+        except IOError as e:
+            _log.throw(f"Could not write all {fmt_digits(chunk.nbytes)} bytes to {self.name}: {str(e)}.")
+        self.rows += chunk.shape[0]
+        perf.count("npio.bytes_written", chunk.nbytes)
+
+    def extend(self, chunks ):
+        """ Write all chunks from an iterable, e.g. a generator """
+        for chunk in chunks:
+            self.write( chunk )
+
+    def flush(self):
+        """ Update the header with the number of rows written and flush the file """
+        _log.verify( not self._f.closed, "ArrayWriter for %s is closed", self.name )
+        _log.verify( not self.dtype is None, "Cannot write %s: no dtype was specified and no data was written", self.name )
+        self._write_header()
+        self._f.flush()
+
+    def close(self):
+        """ Update the header and close the file """
+        if self._f.closed:
+            return
+        try:
+            self.flush()
+            perf.count("npio.arrays_written")
+        finally:
+            self._f.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *kargs, **kwargs):
+        self.close()
+        return False
+
+# -------------------------------------------------
+# Archives of named arrays
+# -------------------------------------------------
+
+ARCHIVE_MAGIC   = b"#npioarc"
+ARCHIVE_VERSION = 1
+
+class Archive(Mapping):
+    """
+    File of named arrays, similar to numpy's .npz but without zip overhead.
+
+    The file starts with ARCHIVE_MAGIC and a version byte, followed by the arrays written with tofile(), i.e. raw and
+    aligned such that they can be memory mapped, or compressed. The file ends with a JSON index of names,
+    offsets, shapes and dtypes, followed by the offset of the index and ARCHIVE_MAGIC.
+    Opening an archive reads only the index; arrays are read when accessed.
+
+        with npio.Archive( "data.npa", "w" ) as arc:
+            arc['x'] = x
+            arc.write( 'y', y, compression="zstd" )
+
+        with npio.Archive( "data.npa" ) as arc:
+            x = arc['x']
+            y = arc.read( 'y', rows=slice(0,100) )
+            z = arc.read( 'x', mmap=True )
+
+    In mode 'a' new arrays are written after the existing index, and close() writes a new index at the end of the file.
+    If the process fails before close(), the archive can still be read with the arrays it contained before.
+    The space of the previous index is not reused.
+    """
+
+    def __init__(self, file : str,
+                       mode : str = "r", *,
+                       compression : str = None,
+                       clevel      : int = 5,
+                       threads     : int = None,
+                       buffering   : int = -1 ):
+        """
+        Open an archive.
+
+        Parameters
+        ----------
+            file : file name
+            mode : 'r' to read, 'w' to create a new archive, 'a' to append arrays to an existing archive or to create a new one.
+            compression : default compression for write(); see tofile().
+            clevel : default compression level for write().
+            threads : number of threads for compression and decompression; see tofile().
+            buffering : see open()
+        """
+        _log.verify( mode in ['r', 'w', 'a'], "'mode' must be 'r', 'w', or 'a'; found '%s'", mode )
+        if mode == 'a' and not os.path.exists(file):
+            mode = 'w'
+        self.name        = file
+        self.mode        = mode
+        self.compression = compression
+        self.clevel      = clevel
+        self.threads     = threads
+        self._index      = OrderedDict()
+        self._modified   = False
+        self._f          = open( file, { 'r' : "rb", 'w' : "w+b", 'a' : "r+b" }[mode], buffering=buffering )
+        try:
+            if mode == 'w':
+                self._f.write( ARCHIVE_MAGIC + ARCHIVE_VERSION.to_bytes(1,"big") )
+                self._end      = self._f.tell()
+                self._modified = True
+            else:
+                self._read_index()
+        except:
+            self._f.close()
+            raise
+
+    def _read_index(self):
+        """
+        Read the index from the end of the file.
+        If the file does not end with an index, for example because the process appending to it failed before close(),
+        then the last complete index in the file is used.
+        """
+        f = self._f
+        magic = f.read( len(ARCHIVE_MAGIC)+1 )
+        _log.verify( magic[:-1] == ARCHIVE_MAGIC, "File %s is not an archive", self.name )
+        _log.verify( magic[-1] <= ARCHIVE_VERSION, "Archive %s has version %ld; upgrade cdxbasics to read it (supported up to version %ld)", self.name, magic[-1], ARCHIVE_VERSION )
+        self._end = f.seek( 0, os.SEEK_END )
+        if not self._load_index( self._end-8-len(ARCHIVE_MAGIC) ):
+            _log.verify( self._find_index(), "Archive %s has no index. Was it closed?", self.name )
+
+    def _load_index(self, footer : int) -> bool:
+        """ Read the index whose footer starts at 'footer'. Returns False if there is no valid index at 'footer' """
+        f    = self._f
+        head = len(ARCHIVE_MAGIC)+1
+        if footer < head:
+            return False
+        f.seek( footer )
+        magic = f.read( 8+len(ARCHIVE_MAGIC) )
+        if magic[8:] != ARCHIVE_MAGIC:
+            return False
+        start = int.from_bytes( magic[:8], "big" )
+        if start < head or start > footer:
+            return False
+        f.seek( start )
+        try:
+            index = [ ( name, ( int(offset), tuple(shape), str(dtype), bool(compressed) ) )
+                      for name, offset, shape, dtype, compressed in json.loads( f.read( footer - start ).decode("utf-8") ) ]
+        except (ValueError, TypeError):
+            return False
+        self._index = OrderedDict( index )
+        return True
+
+    def _find_index(self) -> bool:
+        """ Search the file backwards for the last complete index. Returns False if there is none """
+        f     = self._f
+        block = 1024*1024
+        pos   = self._end
+        while pos > 0:
+            start = max( 0, pos-block )
+            f.seek( start )
+            data  = f.read( pos-start+len(ARCHIVE_MAGIC)-1 )
+            i     = data.rfind( ARCHIVE_MAGIC )
+            while i >= 0:
+                if self._load_index( start+i-8 ):
+                    return True
+                i = data.rfind( ARCHIVE_MAGIC, 0, i )
+            pos = start
+        return False
+
+    def _write_index(self):
+        """ Write the index after the last array """
+        f = self._f
+        f.seek( self._end )
+        index = [ [ name, offset, list(shape), dtype, compressed ] for name, ( offset, shape, dtype, compressed ) in self._index.items() ]
+        f.write( json.dumps( index ).encode("utf-8") )
+        f.write( self._end.to_bytes(8,"big") + ARCHIVE_MAGIC )
+        f.truncate()
+        self._modified = False
+
+    # Mapping
+    # -------
+
+    def __getitem__(self, name : str) -> np.ndarray:
+        return self.read(name)
+    def __iter__(self):
+        return iter( self._index )
+    def __len__(self) -> int:
+        return len( self._index )
+    def __contains__(self, name : str) -> bool:
+        return name in self._index
+    def __setitem__(self, name : str, array : np.ndarray):
+        self.write( name, array )
+
+    # Reading and writing
+    # -------------------
+
+    def shape_dtype(self, name : str) -> tuple:
+        """ Returns shape and dtype of the array 'name' without reading it """
+        _log.verify( name in self._index, "Array '%s' not found in archive %s", name, self.name )
+        _, shape, dtype, _ = self._index[name]
+        return shape, dtype
+
+    def read(self, name : str, *, mmap : bool = False, read_only : bool = False, rows : slice = None) -> np.ndarray:
+        """
+        Read the array 'name'.
+
+        Parameters
+        ----------
+            name : name of the array
+            mmap : if True, return an np.memmap of the array in the file; see fromfile(). Compressed arrays cannot be mapped.
+            read_only : if True, clears the 'writable' flag for the returned array. Maps are then read-only, too.
+            rows : if specified, a slice with step 1 of the rows along the first axis to read.
+
+        Returns
+        -------
+            Newly created numpy array, or np.memmap
+        """
+        _log.verify( not self._f.closed, "Archive %s is closed", self.name )
+        _log.verify( name in self._index, "Array '%s' not found in archive %s", name, self.name )
+        offset, _, _, _ = self._index[name]
+        self._f.flush()
+        self._f.seek( offset )
+        return fromfile( self._f, read_only=read_only, mmap=mmap, rows=rows, threads=self.threads )
+
+    def write(self, name : str, array : np.ndarray, *, compression : str = "default", clevel : int = None ):
+        """
+        Append the array 'name' to the archive.
+
+        Parameters
+        ----------
+            name : name of the array. Names must be unique.
+            array : numpy array
+            compression : compression; see tofile(). By default uses the compression the archive was opened with.
+            clevel : compression level. By default uses the level the archive was opened with.
+        """
+        _log.verify( not self._f.closed, "Archive %s is closed", self.name )
+        _log.verify( self.mode != 'r', "Cannot write to archive %s: opened for reading", self.name )
+        _log.verify( isinstance(name, str) and len(name) > 0, "'name' must be a non-empty string" )
+        _log.verify( not name in self._index, "Array '%s' already exists in archive %s", name, self.name )
+        compression = self.compression if compression == "default" else compression
+        clevel      = self.clevel if clevel is None else clevel
+        array       = np.asarray( array )
+        self._f.seek( self._end )
+        self._modified = True
+        tofile( self._f, array, compression=compression, clevel=clevel, threads=self.threads )
+        self._index[name] = ( self._end, tuple( int(i) for i in array.shape ), str(array.dtype), not compression is None )
+        self._end         = self._f.tell()
+
+    def close(self):
+        """ Write the index if arrays were written, and close the file """
+        if self._f.closed:
+            return
+        try:
+            if self._modified:
+                self._write_index()
+        finally:
+            self._f.close()
 
+    def __enter__(self):
+        return self
+    def __exit__(self, *kargs, **kwargs):
+        self.close()
+        return False
 
+    def __repr__(self) -> str:
+        return "Archive(" + self.name + ")"
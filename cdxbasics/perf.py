@@ -0,0 +1,264 @@
+"""
+Global performance counters and histograms.
+
+Registry of named counters and histograms which cdxbasics modules update on their hot paths, for example
+    subdir.files_read, subdir.bytes_read, subdir.files_written, subdir.bytes_written, subdir.read_seconds, subdir.write_seconds
+    cache.hits, cache.misses, cache.hash_seconds, cache.compute_seconds
+    filelock.acquired, filelock.failed, filelock.wait_seconds
+    jcpool.tasks, jcpool.time_to_result_seconds (time from submitting the jobs of a parallel() call until each result is consumed)
+    npio.arrays_read, npio.bytes_read, npio.arrays_written, npio.bytes_written, npio.arrays_mapped,
+    npio.compressed_bytes_read, npio.compressed_bytes_written
+
+Recording is disabled by default, in which case all functions return immediately.
+Usage:
+
+    from cdxbasics import perf
+    perf.enable()
+    before = perf.snapshot()
+    ... do something ...
+    print( perf.snapshot() - before )
+
+Values recorded in other processes, e.g. jcpool workers, are not collected.
+
+Hans Buehler 2023
+"""
+
+from .logger import Logger
+from .util import fmt_digits
+from collections import OrderedDict
+from collections.abc import Callable
+import threading as threading
+import time as time
+import math as math
+_log = Logger(__file__)
+
+_enabled     = False
+_lock        = threading.Lock()
+_counters    = OrderedDict()
+_histograms  = OrderedDict()
+_subscribers = ()
+
+def enable( on : bool = True ):
+    """ Enable (or disable) recording """
+    global _enabled
+    _enabled = bool(on)
+
+def disable():
+    """ Disable recording """
+    enable(False)
+
+def is_enabled() -> bool:
+    """ Whether recording is enabled """
+    return _enabled
+
+def reset():
+    """ Clear all counters and histograms """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+# -------------------------------------------------
+# Recording
+# -------------------------------------------------
+
+class Histogram(object):
+    """
+    Histogram of observed values.
+    Keeps count, total, minimum and maximum, and counts per power of two:
+    bucket 'e' counts positive values 'x' with 2**(e-1) <= x < 2**e. Values which are not positive are counted in bucket None.
+    """
+
+    def __init__(self):
+        self.count   = 0
+        self.total   = 0.
+        self.min     = None
+        self.max     = None
+        self.buckets = {}
+
+    def add(self, value : float ):
+        """ Add 'value' """
+        value = float(value)
+        e     = math.frexp(value)[1] if value > 0. else None
+        self.count += 1
+        self.total += value
+        self.min   = value if self.min is None else min(self.min, value)
+        self.max   = value if self.max is None else max(self.max, value)
+        self.buckets[e] = self.buckets.get(e, 0) + 1
+
+    @property
+    def mean(self) -> float:
+        """ Average of all observed values, or None """
+        return self.total / self.count if self.count > 0 else None
+
+    def copy(self):
+        """ Returns a copy """
+        r = Histogram()
+        r.count   = self.count
+        r.total   = self.total
+        r.min     = self.min
+        r.max     = self.max
+        r.buckets = dict(self.buckets)
+        return r
+
+    def __sub__(self, other):
+        """
+        Returns the histogram of values observed since 'other' was copied from the same histogram.
+        Minimum and maximum cannot be recovered from the difference and are None unless 'other' is empty.
+        """
+        r = self.copy()
+        if other.count > 0:
+            r.min = None
+            r.max = None
+        r.count -= other.count
+        r.total -= other.total
+        for e, n in other.buckets.items():
+            n = r.buckets.get(e, 0) - n
+            if n != 0:
+                r.buckets[e] = n
+            else:
+                r.buckets.pop(e, None)
+        return r
+
+    def __str__(self) -> str:
+        if self.count == 0:
+            return "count 0"
+        if self.min is None:
+            return "count %ld, total %g, mean %g" % ( self.count, self.total, self.mean )
+        return "count %ld, total %g, mean %g, min %g, max %g" % ( self.count, self.total, self.mean, self.min, self.max )
+
+    def __repr__(self) -> str:
+        return "Histogram(" + str(self) + ")"
+
+def count( name : str, value : int = 1 ):
+    """ Add 'value' to the counter 'name' if recording is enabled """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+    for subscriber in _subscribers:
+        subscriber( "count", name, value )
+
+def observe( name : str, value : float ):
+    """ Add 'value' to the histogram 'name' if recording is enabled """
+    if not _enabled:
+        return
+    with _lock:
+        h = _histograms.get(name, None)
+        if h is None:
+            h = Histogram()
+            _histograms[name] = h
+        h.add(value)
+    for subscriber in _subscribers:
+        subscriber( "observe", name, value )
+
+class _Timed(object):
+    """ Context manager for timed() """
+    def __init__(self, name : str ):
+        self._name = name
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+    def __exit__(self, *kargs, **kwargs):
+        observe( self._name, time.perf_counter() - self._start )
+        return False
+
+class _NotTimed(object):
+    """ Context manager for timed() if recording is disabled """
+    def __enter__(self):
+        return self
+    def __exit__(self, *kargs, **kwargs):
+        return False
+
+_not_timed = _NotTimed()
+
+def timed( name : str ):
+    """
+    Returns a context manager which adds the number of seconds spent in a 'with' block to the histogram 'name'
+    if recording is enabled:
+
+        with perf.timed("myjob.seconds"):
+            ...
+    """
+    return _Timed(name) if _enabled else _not_timed
+
+# -------------------------------------------------
+# Hooks
+# -------------------------------------------------
+
+def subscribe( callback : Callable ):
+    """
+    Register 'callback' to be called for each recorded value while recording is enabled:
+        callback( kind : str, name : str, value )
+    where 'kind' is "count" or "observe".
+    Callbacks are called synchronously by the thread recording the value, hence should be fast.
+    """
+    global _subscribers
+    with _lock:
+        if not callback in _subscribers:
+            _subscribers = _subscribers + (callback,)
+
+def unsubscribe( callback : Callable ):
+    """ Remove a 'callback' registered with subscribe() """
+    global _subscribers
+    with _lock:
+        _subscribers = tuple( s for s in _subscribers if not s is callback )
+
+# -------------------------------------------------
+# Snapshots
+# -------------------------------------------------
+
+class Snapshot(object):
+    """
+    Copy of all counters and histograms at a point in time.
+    Subtract two snapshots to obtain the values recorded in between.
+    The histograms of the difference have no minimum and maximum unless they were empty in the earlier snapshot:
+
+        before = perf.snapshot()
+        ...
+        diff   = perf.snapshot() - before
+        print( diff )
+    """
+
+    def __init__(self, counters : dict, histograms : dict ):
+        self.counters   = counters
+        self.histograms = histograms
+
+    def __sub__(self, before ):
+        counters   = OrderedDict()
+        histograms = OrderedDict()
+        for name, value in self.counters.items():
+            value = value - before.counters.get(name, 0)
+            if value != 0:
+                counters[name] = value
+        for name, h in self.histograms.items():
+            b = before.histograms.get(name, None)
+            h = h - b if not b is None else h.copy()
+            if h.count != 0:
+                histograms[name] = h
+        return Snapshot( counters, histograms )
+
+    def diff(self, before ):
+        """ Returns the values recorded since 'before'. Same as self - before """
+        return self - before
+
+    def as_dict(self) -> dict:
+        """ Returns a plain dictionary of all values, for example to write into a report """
+        r = OrderedDict()
+        for name, value in self.counters.items():
+            r[name] = value
+        for name, h in self.histograms.items():
+            r[name] = dict( count=h.count, total=h.total, mean=h.mean, min=h.min, max=h.max )
+        return r
+
+    def __str__(self) -> str:
+        lines = [ "%s: %s" % ( name, fmt_digits(value) if isinstance(value, int) else str(value) ) for name, value in self.counters.items() ]
+        lines += [ "%s: %s" % ( name, str(h) ) for name, h in self.histograms.items() ]
+        return "\n".join(lines)
+
+    def __repr__(self) -> str:
+        return "Snapshot(" + str( dict( self.as_dict() ) ) + ")"
+
+def snapshot() -> Snapshot:
+    """ Returns a Snapshot of all current counters and histograms """
+    with _lock:
+        return Snapshot( OrderedDict(_counters), OrderedDict( (name, h.copy()) for name, h in _histograms.items() ) )
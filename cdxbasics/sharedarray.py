@@ -6,13 +6,295 @@ Hans Buehler 2023
 from .logger import Logger
 from .version import version
 from .verbose import Context
-from .util import fmt_digits
+from .util import fmt_digits, fmt_big_byte_number
+from collections import OrderedDict
 import numpy as np
 import gc as gc
-from multiprocessing import shared_memory
+import sys as sys
+import os as os
+import atexit as atexit
+import mmap as mmap
+import pickle as pickle
+import uuid as uuid
+import time as time
+from multiprocessing import shared_memory, resource_tracker
+try:
+    import pandas as pd
+except ModuleNotFoundError:
+    pd = None
+if os.name == "posix":
+    import _posixshmem
+try:
+    import fcntl as fcntl
+except ModuleNotFoundError:
+    fcntl = None
 _log = Logger(__file__)
 
-@version("0.0.1")
+SHM_DIR  = "/dev/shm"   # directory which lists shared memory blocks on Linux
+
+_created_sizes = {}     # sizes of blocks created by this process which were not yet unlinked
+_tracked       = set()  # blocks created by this process which are registered with the resource tracker
+
+class _UntrackedSharedMemory( shared_memory.SharedMemory ):
+    """
+    POSIX shared memory block which is not registered with the resource tracker.
+    Mirrors SharedMemory.__init__() without its call to resource_tracker.register(); all other methods are inherited.
+    """
+
+    def __init__(self, name : str, create : bool, size : int ):
+        self._name  = "/" + name
+        self._flags = os.O_CREAT | os.O_EXCL | os.O_RDWR if create else os.O_RDWR
+        self._fd    = _posixshmem.shm_open( self._name, self._flags, mode=self._mode )
+        try:
+            if create and size:
+                os.ftruncate( self._fd, size )
+            self._size = os.fstat( self._fd ).st_size
+            self._mmap = mmap.mmap( self._fd, self._size )
+        except OSError:
+            os.close( self._fd )
+            self._fd = -1
+            if create:
+                _posixshmem.shm_unlink( self._name )
+            raise
+        self._buf = memoryview( self._mmap )
+
+def _shared_memory( shared_id : str, create : bool, size : int, track : bool ) -> shared_memory.SharedMemory:
+    """
+    Create or attach to a shared memory block, and register it with the resource tracker only if 'track' is True.
+    Before Python 3.13 attaching registers a block with the resource tracker of the attaching process, which unlinks it when
+    that process exits, e.g. when a worker finishes. Processes started with 'spawn' or 'fork' also share the resource tracker of their parent,
+    hence unregistering after the fact would remove the registration of the creator, too.
+    """
+    if track or os.name != "posix":
+        shared = shared_memory.SharedMemory(name=shared_id, create=create, size=size )
+        if track and os.name == "posix":
+            _tracked.add( shared_id )
+        return shared
+    if sys.version_info >= (3,13):
+        return shared_memory.SharedMemory(name=shared_id, create=create, size=size, track=False )
+    return _UntrackedSharedMemory( shared_id, create=create, size=size )
+
+def _attach( shared_id : str, size : int = 0 ) -> shared_memory.SharedMemory:
+    """ Attach to an existing shared memory block without registering it with the resource tracker """
+    return _shared_memory( shared_id, create=False, size=size, track=False )
+
+def _untrack( shared : shared_memory.SharedMemory, shared_id : str ):
+    """ Unregister a block created by this process from the resource tracker, if it was registered """
+    if shared_id in _tracked:
+        resource_tracker.unregister( shared._name, "shared_memory" )
+        _tracked.discard( shared_id )
+
+def _unlink_shared( shared : shared_memory.SharedMemory, shared_id : str ):
+    """ Unlink 'shared' """
+    _untrack( shared, shared_id )
+    if os.name == "posix":
+        _posixshmem.shm_unlink( shared._name )
+    _created_sizes.pop( shared_id, None )
+
+def _unlink( shared_id : str ) -> bool:
+    """ Unlink the shared block 'shared_id' if it exists. Returns whether it existed """
+    try:
+        shared = _attach( shared_id )
+    except FileNotFoundError:
+        return False
+    shared.close()
+    try:
+        _unlink_shared( shared, shared_id )
+    except FileNotFoundError:
+        return False
+    return True
+
+def shared_blocks( prefix : str ) -> OrderedDict:
+    """
+    Returns a dictionary of names and sizes of all shared blocks whose name starts with 'prefix', including blocks created by other processes.
+    Requires a system which lists shared memory blocks in SHM_DIR such as Linux; otherwise, only blocks created by this process are returned.
+    """
+    prefix = str(prefix)
+    _log.verify( len(prefix) > 0, "'prefix' cannot be empty" )
+    if os.path.isdir( SHM_DIR ):
+        names = sorted( [ name for name in os.listdir( SHM_DIR ) if name.startswith(prefix) ] )
+        sizes = OrderedDict()
+        for name in names:
+            try:
+                sizes[name] = os.path.getsize( os.path.join( SHM_DIR, name ) )
+            except FileNotFoundError:
+                pass
+        return sizes
+    return OrderedDict( [ (name, _created_sizes[name]) for name in sorted(_created_sizes) if name.startswith(prefix) ] )
+
+def sweep( prefix : str, verbose : Context = None ) -> list:
+    """
+    Unlink all shared blocks whose name starts with 'prefix', for example blocks left behind by processes which crashed.
+    See shared_blocks() for which blocks can be found.
+
+    Returns
+    -------
+        List of names of unlinked blocks
+    """
+    swept = []
+    for name in shared_blocks( prefix ):
+        if _unlink( name ):
+            swept.append( name )
+    if len(swept) > 0 and not verbose is None:
+        verbose.write("Unlinked %ld shared memory blocks with prefix '%s'", len(swept), prefix)
+    return swept
+
+_registries    = []     # stack of active SharedMemoryRegistry objects
+
+class _Reservation( object ):
+    """
+    Context manager returned by SharedMemoryRegistry.reserve().
+    Holds an exclusive lock on 'filename', if not None, until the block is created.
+    """
+
+    def __init__(self, filename : str = None ):
+        self._fd = None
+        if not filename is None:
+            self._fd = os.open( filename, os.O_CREAT | os.O_RDWR, 0o600 )
+            fcntl.flock( self._fd, fcntl.LOCK_EX )
+
+    def release(self):
+        """ Release the lock """
+        if not self._fd is None:
+            fcntl.flock( self._fd, fcntl.LOCK_UN )
+            os.close( self._fd )
+            self._fd = None
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *kargs, **kwargs):
+        self.release()
+        return False
+
+class SharedMemoryRegistry( object ):
+    """
+    Manages the lifetime of shared memory blocks created by a process tree.
+
+    While a registry is active, each ndsharedarray created in this process is named with the registry's 'prefix',
+    and the total size of all blocks with this prefix is limited to 'budget' bytes.
+    On systems which list shared memory blocks in SHM_DIR and support file locks, such as Linux, the budget covers the blocks of
+    all processes using the prefix, and checking it and creating a block is atomic across processes. Elsewhere, the budget only
+    covers the blocks created by the current process.
+    When the registry is closed in the process which created it, all blocks with its prefix are unlinked, including
+    those created by worker processes. The registry can be passed to workers; when they activate it, their blocks
+    are named with the same prefix, but closing it there does not unlink anything.
+    Blocks named with the prefix of the active registry are not registered with Python's resource tracker, i.e. the registry
+    alone manages their lifetime.
+
+        with SharedMemoryRegistry( "mcengine_", budget=1024**3, sweep=True ) as registry:
+            paths = sharedarray( "paths", (10000, 252), create=True )
+            ...
+            print( registry )
+
+    Use 'sweep' or sharedarray.sweep() with a fixed prefix to remove blocks left behind by a previous process which crashed.
+    Pass the registry to JCPool to unlink its blocks when the pool is terminated.
+    """
+
+    def __init__(self, prefix  : str = None,
+                       budget  : int = None, *,
+                       sweep   : bool = False,
+                       verbose : Context = None ):
+        """
+        Parameters
+        ----------
+            prefix  : prefix for the names of shared blocks. The default is unique for this process.
+            budget  : if not None, maximum total number of bytes of all blocks with 'prefix'
+            sweep   : if True, unlink all existing blocks with 'prefix' when the registry is activated
+            verbose : None or a Context for reporting
+        """
+        self.prefix  = str(prefix) if not prefix is None else "cdx%ld_" % os.getpid()
+        self.budget  = int(budget) if not budget is None else None
+        self.sweep   = sweep
+        self.verbose = verbose
+        self._pid    = os.getpid()
+        _log.verify( len(self.prefix) > 0, "'prefix' cannot be empty" )
+        _log.verify( self.budget is None or self.budget > 0, "'budget' must be positive; found %ld", self.budget if not self.budget is None else 0 )
+
+    def __getstate__(self):
+        return dict( prefix=self.prefix, budget=self.budget, sweep=False, verbose=None, _pid=self._pid )
+
+    @property
+    def is_root(self) -> bool:
+        """ Whether this is the process which created the registry. Only this process unlinks blocks when the registry is closed """
+        return os.getpid() == self._pid
+
+    def blocks(self) -> OrderedDict:
+        """ Returns names and sizes of all shared blocks with 'prefix'. See shared_blocks() """
+        return shared_blocks( self.prefix )
+
+    def usage(self) -> int:
+        """ Total size in bytes of all shared blocks with 'prefix' """
+        return int( sum( self.blocks().values() ) )
+
+    @property
+    def _lock_file(self) -> str:
+        """ File locked while the budget is checked and a block is created, or None if the budget cannot be checked across processes """
+        if fcntl is None or not os.path.isdir( SHM_DIR ):
+            return None
+        return os.path.join( SHM_DIR, "." + self.prefix + "lock" )
+
+    def reserve(self, shared_id : str, size : int ) -> _Reservation:
+        """
+        Called before a block of 'size' bytes is created. Raises MemoryError if the budget would be exceeded.
+        Returns a context manager which is to be held until the block was created:
+
+            with registry.reserve( shared_id, size ):
+                ... create block ...
+
+        If there is a budget, this lists all blocks with 'prefix' and serializes the creation of blocks with 'prefix' across processes.
+        """
+        if self.budget is None:
+            return _Reservation()
+        reservation = _Reservation( self._lock_file )
+        try:
+            usage = self.usage()
+            if usage + size > self.budget:
+                raise MemoryError(f"Cannot create shared block '{shared_id}' of {fmt_big_byte_number(size,True)}: the budget of {fmt_big_byte_number(self.budget,True)} for prefix '{self.prefix}' would be exceeded; current usage is {fmt_big_byte_number(usage,True)}")
+        except:
+            reservation.release()
+            raise
+        return reservation
+
+    def activate(self):
+        """ Make this registry the active one """
+        if self.sweep and self.is_root:
+            sweep( self.prefix, verbose=self.verbose )
+        _registries.append( self )
+        if self.is_root:
+            atexit.register( self.close )
+        return self
+
+    def close(self):
+        """ Deactivate the registry. In the process which created it, unlink all blocks with 'prefix' """
+        if self in _registries:
+            _registries.remove( self )
+        if self.is_root:
+            atexit.unregister( self.close )
+            sweep( self.prefix, verbose=self.verbose )
+            if not self._lock_file is None and os.path.exists( self._lock_file ):
+                try:
+                    os.remove( self._lock_file )
+                except FileNotFoundError:
+                    pass
+
+    def __enter__(self):
+        return self.activate()
+    def __exit__(self, *kargs, **kwargs):
+        self.close()
+        return False
+
+    def __str__(self) -> str:
+        blocks = self.blocks()
+        s = "%s: %ld blocks, %s" % ( self.prefix, len(blocks), fmt_big_byte_number( sum( blocks.values() ), True ) )
+        return s if self.budget is None else s + " of " + fmt_big_byte_number( self.budget, True )
+    def __repr__(self) -> str:
+        return "SharedMemoryRegistry(" + str(self) + ")"
+
+def active_registry() -> SharedMemoryRegistry:
+    """ Returns the active SharedMemoryRegistry, or None """
+    return _registries[-1] if len(_registries) > 0 else None
+
+@version("0.0.3")
 class ndsharedarray( object ):
     """
     Wrapper around https://docs.python.org/3/library/multiprocessing.shared_memory.html
@@ -30,6 +312,8 @@ class ndsharedarray( object ):
                        dtype   = np.float32, 
                        full    = 0.,
                        *,
+                       pickle_by_value : bool = False,
+                       prefix  : str = None,
                        verbose : Context = None ):
         """
         Create a new shared memory array.
@@ -48,28 +332,38 @@ class ndsharedarray( object ):
             create  : whether to create a new shared memory block or not.
             dtype   : numpy dtype
             full    : if not None: value used to fill newly created array. Not used when create is False
+            pickle_by_value : if False, pickling transmits only name, shape and dtype, and unpickling attaches to the existing block.
+                      If True, pickling transmits the data, and unpickling creates a new block with this data. See pickle_by_value.
+            prefix  : prefix for the name of the shared memory. The default is the prefix of the active SharedMemoryRegistry, if any.
             verbose : None or a Context. If the latter is present, the object provides logging information on when objects are created/delted
         """
-        dtype         = dtype() if isinstance(dtype, type) else dtype
-        size          = int( np.uint64( dtype.itemsize ) * np.product( [ np.uint64(i) for i in shape ], dtype=np.uint64 ) + 32 )
-        shape         = tuple(shape)
+        dtype         = np.dtype(dtype)
+        shape         = tuple( [int(i) for i in shape] )
+        size          = int( np.uint64( dtype.itemsize ) * np.prod( [ np.uint64(i) for i in shape ], dtype=np.uint64 ) + 32 )
+        registry      = active_registry()
+        self._prefix  = str(prefix) if not prefix is None else ( registry.prefix if not registry is None else "" )
         self._name    = name
-        self._id      = name + str(shape) + "[" + str(type(dtype).__name__) + "]"
+        self._id      = self._prefix + name + str(shape) + "[" + dtype.name + "]"
         self._serial  = ndsharedarray.serial_number   # for debugging purposes
         self._verbose = verbose
+        self._owner   = bool(create)
+        self.pickle_by_value = pickle_by_value
         ndsharedarray.serial_number += 1
 
         assert size>0, "Cannot have zero size"
 
         if create:
-            self._shared = shared_memory.SharedMemory(name=self._id, create=True, size=size )
+            managed = not registry is None and self._prefix == registry.prefix
+            with registry.reserve( self._id, size ) if managed else _Reservation():
+                self._shared = _shared_memory( self._id, create=True, size=size, track=not managed )   # the registry manages the lifetime of its blocks
+            _created_sizes[self._id] = size
             self._array  = np.ndarray( shape, dtype=dtype, buffer = self._shared.buf )
             assert self._array.dtype == dtype, ("Dtype mismatch", self._array.dtype , dtype )
             assert self._array.nbytes < size, ("size mismatch", self._array.nbytes , size )
             if not full is None:
                 self._array[:] = full
         else:
-            self._shared = shared_memory.SharedMemory(name=self._id, create=False, size=size )
+            self._shared = _attach( self._id, size )
             self._array  = np.ndarray( shape, dtype=dtype, buffer = self._shared.buf )
             assert self.array.dtype == dtype, ("Dtype mismatch", self.array.dtype , dtype )
             assert self._array.nbytes < size, ("size mismatch", self._array.nbytes , size )
@@ -86,8 +380,11 @@ class ndsharedarray( object ):
         Closes the shared memory file. 
         Optionally calls unlink()
         NOTE: unlink destroys the file and should be called after all procssess called close() ... don't ask.
+        Only the object which created the block may unlink it; see owner.
         c.f. https://docs.python.org/3/library/multiprocessing.shared_memory.html
         """
+        if unlink and '_shared' in self.__dict__:
+            _log.verify( self._owner, "Cannot unlink %s: only the object which created the shared block can unlink it", self._id )
         self._array = None
         if '_shared' in self.__dict__:
             if not self._verbose is None:
@@ -98,7 +395,7 @@ class ndsharedarray( object ):
                 pass
             if unlink:
                 try:
-                    self._shared.unlink()
+                    _unlink_shared( self._shared, self._id )
                 except FileNotFoundError:
                     pass
             del self._shared
@@ -114,6 +411,10 @@ class ndsharedarray( object ):
         """ User-specified name, without shape and dtype qualification. Use shared_id() for the latter """
         return self._name
     @property
+    def prefix(self) -> str:
+        """ Prefix of the name of the shared memory; see SharedMemoryRegistry """
+        return self._prefix
+    @property
     def shared_id(self) -> str:
         """ Return fully qualified name of shared memory, e.g. including dtype and shape information """
         return self._id
@@ -122,6 +423,10 @@ class ndsharedarray( object ):
         """ Return fully qualified name of shared memory, e.g. including dtype and shape information """
         return self._shared.size
     @property
+    def owner(self) -> bool:
+        """ Whether this object created the shared block, and therefore controls when it is unlinked """
+        return self._owner
+    @property
     def shared_buf(self):
         """ binary buffer of the shared stream """
         return self._shared.buf
@@ -171,20 +476,33 @@ class ndsharedarray( object ):
 
     @staticmethod
     def from_state( state ):
-        """ Restore object from disk """
-        return ndsharedarray( name=state['name'], shape=state['shape'], create=True, dtype=state['dtype'], full=state['data'] )
+        """ Restore object from disk: creates a new shared block with the pickled data """
+        return ndsharedarray( name=state['name'], shape=state['shape'], create=True, dtype=state['dtype'], full=state['data'], pickle_by_value=True, prefix=state.get('prefix',None) )
+
+    @staticmethod
+    def from_name( name : str, shape : tuple, dtype, prefix : str = "" ):
+        """ Restore object by attaching to the existing shared block """
+        return ndsharedarray( name=name, shape=shape, create=False, dtype=dtype, full=None, prefix=prefix )
 
     def __reduce__(self):
         """
         Pickling this object explicitly
         See https://docs.python.org/3/library/pickle.html#object.__reduce__
+        
+        By default only name, shape and dtype are pickled, and unpickling attaches to the existing shared block.
+        This allows passing shared arrays to worker processes without copying their data. The receiving object
+        does not own the block, i.e. it cannot unlink it.
+        If 'pickle_by_value' is True, the data are pickled and unpickling creates a new block, for example to write a shared array to disk.
         """
+        if not self.pickle_by_value:
+            return (ndsharedarray.from_name, (self._name, self.shape, self.dtype, self._prefix) )
         state = dict( name=self._name, 
-                      dtype=self._dtype,
+                      prefix=self._prefix,
+                      dtype=self.dtype,
                       shape=self.shape,
                       data=self._array
                     )
-        return (self.from_state, (state,) )
+        return (ndsharedarray.from_state, (state,) )
 
 
 @version("0.0.1", dependencies=[ndsharedarray] )
@@ -195,6 +513,7 @@ def sharedarray( name   : str,
                  full   = None,
                  *,
                  raiseOnError : bool = False,
+                 pickle_by_value : bool = False,
                  verbose      : Context = None ):
     """
     Create a new shared memory array.
@@ -221,6 +540,8 @@ def sharedarray( name   : str,
         full    : If not None, fill a newly created object with this data.
                   Ignored if a shared object is used.
         raiseOnError : if False, fail by returning None, else throw FileExistsError or FileNotFoundError, respectively
+        pickle_by_value : if False, pickling transmits only name, shape and dtype, and unpickling attaches to the existing block.
+                  If True, pickling transmits the data. See ndsharedarray.__reduce__
         verbose : None or a Context. If the latter is present, the object provides logging information on when objects are created/delted
 
     Returns
@@ -239,7 +560,7 @@ def sharedarray( name   : str,
 
     if create is None or create:
         try:
-            array = ndsharedarray( name=name, shape=shape, create=True, dtype=dtype, full=full, verbose=verbose )
+            array = ndsharedarray( name=name, shape=shape, create=True, dtype=dtype, full=full, pickle_by_value=pickle_by_value, verbose=verbose )
             if not create is None:
                 return array
             else:
@@ -251,7 +572,7 @@ def sharedarray( name   : str,
                 return None
 
     try:
-        array = ndsharedarray( name=name, shape=shape, create=False, dtype=dtype, full=None, verbose=verbose )
+        array = ndsharedarray( name=name, shape=shape, create=False, dtype=dtype, full=None, pickle_by_value=pickle_by_value, verbose=verbose )
         if not create is None:
             return array
         else:
@@ -265,21 +586,495 @@ def sharedarray( name   : str,
     raise Exception("Cannot create or read shared memory block '%s'", name) 
         
 from .npio import *
-def shared_fromfile( file, name, dtype=np.float32 ):
+from . import npio as npio
+
+def shared_fromfile( file, 
+                     name           : str, *,
+                     validate_dtype = None,
+                     validate_shape : tuple = None,
+                     read_only      : bool = False,
+                     rows           : slice = None,
+                     threads        : int = None,
+                     buffering      : int = -1,
+                     verbose        : Context = None ) -> ndsharedarray:
     """
-    Read array from disk into a new named sharedarray.
+    Read array from disk directly into a new named sharedarray, without intermediate copies.
+    
+    If a shared block with the same name, shape and dtype already exists, for example because another process
+    already loaded the file, then this function attaches to that block and does not read the file.
+    In either case an open file 'file' is left positioned after the array.
+    Callers must ensure that the process which loads the file has finished before other processes use the data,
+    for example by loading the file before starting workers which then call this function with the same arguments.
 
     Parameters
     ----------
-        file  : file name passed to open()
-        name  : memory name
-        dtype : target dtype
+        file      : file name passed to open(), or an open file. See npio.tofile().
+        name      : memory name; see sharedarray()
+        validate_dtype: if specified, check that the array has the specified dtype
+        validate_shape: if specified, check that the array has the specified shape
+        read_only : if True, clears the 'writable' flag of the returned array
+        rows      : if specified, a slice with step 1 of the rows along the first axis to read; see npio.fromfile().
+        threads   : number of threads for reading; see npio.readfromfile(). Use this to read large raw files in parallel chunks.
+        buffering : see open(); -1 is the default, 0 for no buffering.
+        verbose   : None or a Context; see sharedarray()
 
     Returns
     -------
-        Newly created numpy array
+        ndsharedarray
+    """
+    if isinstance(file, str):
+        with open( file, "rb", buffering=buffering ) as f:
+            return shared_fromfile( f, name, validate_dtype=validate_dtype, validate_shape=validate_shape, read_only=read_only, rows=rows, threads=threads, buffering=buffering, verbose=verbose )
+    f = file
+    del file
+
+    start        = f.tell()
+    shape, dtype = npio.read_shape_dtype( f )
+    f.seek( start )
+    if not validate_dtype is None and validate_dtype != dtype:
+        _log.throw(f"Failed to read {f.name}: found type {dtype} expected {validate_dtype}.")
+    if not validate_shape is None and validate_shape != shape:
+        _log.throw(f"Failed to read {f.name}: found type {shape} expected {validate_shape}.")
+    if not rows is None:
+        rstart, rstop = npio._row_range( rows, shape )
+        shape = (rstop-rstart,) + shape[1:]
+
+    array, created = sharedarray( name, shape, create=None, dtype=dtype, verbose=verbose )
+    if created:
+        try:
+            npio.readfromfile( f, array.array, rows=rows, threads=threads )
+        except:
+            array.close(unlink=True)
+            raise
+    else:
+        # leave 'f' positioned after the array, as if it had been read
+        try:
+            npio._skip( f )
+        except IOError as e:
+            _log.throw(f"Cannot read from {f.name}: {str(e)}")
+    if read_only:
+        array.array.flags.writeable = False
+    return array
+
+# -------------------------------------------------
+# Shared objects
+# -------------------------------------------------
+
+SHARED_OBJECT_ALIGN = 64
+
+def _map_readonly( shared_id : str, size : int ):
+    """
+    Map the shared block 'shared_id' read-only.
+    The map stays valid for as long as objects refer to it, even if the block is unlinked.
     """
-    def construct(shape):
-        return ndsharedarray( name=name, shape=shape, dtype=dtype, create=True, raiseOnError=True )
-    return _fromfile( file, construct=construct )
+    shared = _attach( shared_id, size )
+    try:
+        if os.name == "nt":
+            return mmap.mmap( -1, shared.size, tagname=shared_id, access=mmap.ACCESS_READ )
+        return mmap.mmap( shared._fd, shared.size, access=mmap.ACCESS_READ )
+    finally:
+        shared.close()
+
+class SharedObject( object ):
+    """
+    Places an arbitrary Python object into shared memory, for example a dictionary of numpy arrays, a pandas DataFrame or a PrettyOrderedDict.
+    The object is serialized with pickle protocol 5. Out-of-band buffers such as the data of numpy arrays are copied once
+    into a shared block, and get() returns an object whose arrays are read-only views into that block.
+    The SharedObject itself is a small handle which can be pickled and passed to other processes:
+
+        def f( x ):
+            result = dict( paths=np.random.normal(size=(100000,252)), info="..." )
+            return SharedObject( result, transfer=True )
+
+        for handle in pool.parallel( pool.delayed(f)( x ) for x in ... ):
+            result = handle.get( unlink=True )
+
+    The shared block follows the conventions of ndsharedarray, i.e. it is named with the prefix of the active SharedMemoryRegistry.
+    """
+
+    def __init__(self, obj, name : str = None, *, transfer : bool = False, verbose : Context = None ):
+        """
+        Serialize 'obj' into a new shared block.
+
+        Parameters
+        ----------
+            obj      : object to share
+            name     : name of the shared block; see sharedarray(). By default a unique name is used.
+            transfer : if False, this object owns the shared block; see ndsharedarray.owner.
+                       If True, the creating process gives up ownership, i.e. the block is not unlinked when it exits,
+                       and the receiver is expected to call get(unlink=True). Use this to return results from worker processes.
+            verbose  : None or a Context; see sharedarray()
+        """
+        buffers = []
+        data    = pickle.dumps( obj, protocol=5, buffer_callback=buffers.append )
+        buffers = [ b.raw() for b in buffers ]
+        offsets = []
+        size    = len(data)
+        for b in buffers:
+            size = ( (size + SHARED_OBJECT_ALIGN - 1) // SHARED_OBJECT_ALIGN ) * SHARED_OBJECT_ALIGN
+            offsets.append( (size, b.nbytes) )
+            size += b.nbytes
+
+        block = ndsharedarray( name=name if not name is None else "obj" + uuid.uuid4().hex, shape=(size,), create=True, dtype=np.uint8, full=None, verbose=verbose )
+        array = block.array
+        array[:len(data)] = np.frombuffer( data, dtype=np.uint8 )
+        for b, ( offset, nbytes ) in zip( buffers, offsets ):
+            array[offset:offset+nbytes] = np.frombuffer( b, dtype=np.uint8 )
+        del array, buffers, data
+
+        self._shared_id = block.shared_id
+        self._size      = block.shared_size
+        self._pickled   = offsets[0][0] if len(offsets) > 0 else size
+        self._offsets   = offsets
+        self.nbytes     = size
+        if transfer:
+            block._owner = False
+            _untrack( block._shared, self._shared_id )
+            _created_sizes.pop( self._shared_id, None )
+            block.close()
+            block = None
+        self._block     = block
+
+    def __getstate__(self):
+        """ Pickle the handle, but not the block """
+        state = dict( self.__dict__ )
+        state['_block'] = None
+        return state
+
+    @property
+    def shared_id(self) -> str:
+        """ Name of the shared block """
+        return self._shared_id
+    @property
+    def owner(self) -> bool:
+        """ Whether this object owns the shared block """
+        return not self._block is None
+
+    def get(self, unlink : bool = False ):
+        """
+        Returns the object. Arrays are read-only views into shared memory.
+        If 'unlink' is True, the block is unlinked; the returned object remains valid, and the memory is released once it is no longer used.
+        """
+        mm   = _map_readonly( self._shared_id, self._size )
+        view = memoryview( mm )
+        obj  = pickle.loads( view[:self._pickled], buffers=[ view[offset:offset+nbytes] for offset, nbytes in self._offsets ] )
+        del view
+        if unlink:
+            self.unlink()
+        return obj
+
+    def unlink(self):
+        """ Unlink the shared block. Objects returned by get() remain valid """
+        if not self._block is None:
+            self._block.close(unlink=True)
+            self._block = None
+        else:
+            _unlink( self._shared_id )
+
+    def __repr__(self) -> str:
+        return "SharedObject(" + self._shared_id + ";" + fmt_big_byte_number( self.nbytes, True ) + ")"
+
+# -------------------------------------------------
+# Ring buffer
+# -------------------------------------------------
+
+RING_POLL_MIN = 1E-5     # initial sleep in seconds when blocking calls of SharedRingBuffer wait
+RING_POLL_MAX = 1E-2     # maximum sleep in seconds when blocking calls of SharedRingBuffer wait
+
+def _ring_wait( deadline : float, wait : float ) -> float:
+    """ Sleep with exponential backoff. Returns the next waiting time, or None if 'deadline' has passed """
+    if not deadline is None and time.time() >= deadline:
+        return None
+    time.sleep( wait )
+    return min( wait*2., RING_POLL_MAX )
+
+class SharedRingBuffer( object ):
+    """
+    Single-producer/multi-consumer ring buffer of records with a fixed dtype in shared memory.
+    Every consumer receives every record; the producer waits until the slowest consumer has read a record before overwriting it.
+
+        ring = SharedRingBuffer( "ticks", capacity=1024*1024, dtype=[('time', 'f8'), ('price', 'f8')], consumers=2 )
+
+        def analytics( ring, consumer ):
+            for batch in ring.batches( consumer ):
+                ...
+
+        pool.parallel( pool.delayed(analytics)( ring, i ) for i in range(2) )   # in a thread, or before the producer starts
+        for batch in replay():
+            ring.put( batch )
+        ring.finish()
+
+    Records and sequence counters are ndsharedarray's, hence the ring buffer follows their naming and lifetime conventions and
+    is pickled by name: consumers in other processes attach to the same memory.
+    Each counter is written by a single process only. This relies on aligned 64 bit stores being atomic and not reordered with
+    other stores, which holds on x86 but is not guaranteed by Python.
+    """
+
+    def __init__(self, name      : str,
+                       capacity  : int,
+                       dtype,
+                       consumers : int = 1, *,
+                       verbose   : Context = None ):
+        """
+        Create a new ring buffer.
+
+        Parameters
+        ----------
+            name      : name; the shared blocks are named name + '.data' and name + '.seq'
+            capacity  : maximum number of records in the buffer
+            dtype     : dtype of the records, e.g. a structured dtype
+            consumers : number of consumers
+            verbose   : None or a Context; see sharedarray()
+        """
+        capacity  = int(capacity)
+        consumers = int(consumers)
+        _log.verify( capacity > 0, "'capacity' must be positive; found %ld", capacity )
+        _log.verify( consumers > 0, "'consumers' must be positive; found %ld", consumers )
+        self._data = ndsharedarray( name + ".data", (capacity,), create=True, dtype=dtype, full=None, verbose=verbose )
+        # sequence counters, each on its own cache line: number of records written, finished flag, number of records read by each consumer
+        self._seq  = ndsharedarray( name + ".seq", (2+consumers,8), create=True, dtype=np.int64, full=0, verbose=verbose )
+
+    @property
+    def capacity(self) -> int:
+        """ Maximum number of records in the buffer """
+        return self._data.shape[0]
+    @property
+    def consumers(self) -> int:
+        """ Number of consumers """
+        return self._seq.shape[0]-2
+    @property
+    def dtype(self):
+        """ Dtype of the records """
+        return self._data.dtype
+    @property
+    def written(self) -> int:
+        """ Total number of records written """
+        return int( self._seq.array[0,0] )
+    @property
+    def finished(self) -> bool:
+        """ Whether the producer called finish() """
+        return bool( self._seq.array[1,0] )
+
+    def available(self, consumer : int = 0 ) -> int:
+        """ Number of records which 'consumer' can read """
+        return int( self._seq.array[0,0] - self._seq.array[2+consumer,0] )
+
+    def _copy(self, seq : int, out : np.ndarray, write : bool ):
+        """ Copy 'out' into the buffer starting at sequence number 'seq', or vice versa """
+        data = self._data.array
+        cap  = len(data)
+        s    = seq % cap
+        n1   = min( len(out), cap-s )
+        if write:
+            data[s:s+n1]        = out[:n1]
+            data[:len(out)-n1]  = out[n1:]
+        else:
+            out[:n1]            = data[s:s+n1]
+            out[n1:]            = data[:len(out)-n1]
+
+    def put(self, records : np.ndarray, *, block : bool = True, timeout : float = None ) -> int:
+        """
+        Append 'records' to the buffer. Only one process may call put().
+
+        Parameters
+        ----------
+            records : array of records with 'dtype', or anything which can be converted into one
+            block   : if True, wait until all records were written. If False, write as many records as fit into the buffer.
+            timeout : if not None, maximum number of seconds to wait
+
+        Returns
+        -------
+            Number of records written. This is less than len(records) only if 'block' is False or the timeout expired.
+        """
+        _log.verify( not self.finished, "Cannot put records into ring buffer %s: finish() was called", self._data.name )
+        records  = np.asarray( records, dtype=self.dtype ).reshape((-1,))
+        seq      = self._seq.array
+        deadline = time.time() + timeout if not timeout is None else None
+        wait     = RING_POLL_MIN
+        done     = 0
+        while done < len(records):
+            w    = int( seq[0,0] )
+            free = self.capacity - ( w - int( seq[2:,0].min() ) )
+            if free == 0:
+                wait = _ring_wait( deadline, wait ) if block else None
+                if wait is None:
+                    break
+                continue
+            n = min( free, len(records)-done )
+            self._copy( w, records[done:done+n], write=True )
+            seq[0,0] = w + n    # publish after the records were written
+            done += n
+            wait  = RING_POLL_MIN
+        return done
+
+    def get(self, consumer : int = 0, max_records : int = None, *, block : bool = True, timeout : float = None ) -> np.ndarray:
+        """
+        Read the next records for 'consumer'. Each consumer index must be used by one process only.
+
+        Parameters
+        ----------
+            consumer    : index of the consumer, from 0 to consumers-1
+            max_records : maximum number of records to return
+            block       : if True, wait until at least one record is available, or until the producer called finish()
+            timeout     : if not None, maximum number of seconds to wait
+
+        Returns
+        -------
+            New array of records. The array is empty if no records were available, or if the producer called finish() and all records were read.
+        """
+        _log.verify( consumer >= 0 and consumer < self.consumers, "'consumer' must be from 0 to %ld; found %ld", self.consumers-1, consumer )
+        seq      = self._seq.array
+        deadline = time.time() + timeout if not timeout is None else None
+        wait     = RING_POLL_MIN
+        r        = int( seq[2+consumer,0] )
+        while True:
+            finished = bool( seq[1,0] )     # read before the number of records written
+            n        = int( seq[0,0] ) - r
+            if n > 0 or finished or not block:
+                break
+            wait = _ring_wait( deadline, wait )
+            if wait is None:
+                break
+        n   = min( n, max_records ) if not max_records is None else n
+        out = np.empty( (max(n,0),), dtype=self.dtype )
+        if n > 0:
+            self._copy( r, out, write=False )
+            seq[2+consumer,0] = r + n   # release after the records were read
+        return out
+
+    def batches(self, consumer : int = 0, max_records : int = None ):
+        """ Generator of batches of records for 'consumer' until the producer called finish() and all records were read """
+        while True:
+            out = self.get( consumer, max_records )
+            if len(out) == 0:
+                return
+            yield out
+
+    def finish(self):
+        """ Mark the end of the stream. Consumers receive the remaining records, and then empty arrays """
+        self._seq.array[1,0] = 1
+
+    def close(self, unlink : bool = False):
+        """ Close the shared blocks; see ndsharedarray.close() """
+        self._data.close(unlink=unlink)
+        self._seq.close(unlink=unlink)
+
+# -------------------------------------------------
+# DataFrames
+# -------------------------------------------------
+
+class SharedDataFrame( object ):
+    """
+    Places a pandas DataFrame into shared memory such that other processes can use it without copying.
+
+    Each column with a numpy dtype (bool, integers, floats, complex, datetime64, timedelta64) is placed into its own ndsharedarray
+    named name + '.' + column position. A RangeIndex is stored as start, stop and step; other indices with a numpy dtype are
+    placed into the block name + '.index'. All other columns and indices, e.g. strings or categoricals, are shared with a SharedObject.
+    The SharedDataFrame itself is a small handle which can be pickled and passed to other processes, where get() returns
+    a read-only DataFrame backed by the shared blocks:
+
+        shared = SharedDataFrame( df, "prices" )
+
+        def f( shared ):
+            df = shared.get()
+            ...
+
+        pool.parallel( pool.delayed(f)( shared ) for _ in range(10) )
+        shared.unlink()
+
+    The blocks follow the conventions of ndsharedarray, i.e. they are named with the prefix of the active SharedMemoryRegistry,
+    and only the object which created them can unlink them.
+    """
+
+    def __init__(self, df, name : str, *, verbose : Context = None ):
+        """
+        Copy 'df' into shared memory.
+
+        Parameters
+        ----------
+            df      : pandas DataFrame
+            name    : name; see sharedarray()
+            verbose : None or a Context; see sharedarray()
+        """
+        if pd is None: _log.throw("Package 'pandas' not found. Please pip install")
+        _log.verify( isinstance(df, pd.DataFrame), "'df' must be a DataFrame; found %s", type(df).__name__ )
+        def shareable( dtype ):
+            return isinstance( dtype, np.dtype ) and dtype.kind in "biufcmM"
+        def share( key, values ):
+            block = ndsharedarray( name + "." + key, (len(values),), create=True, dtype=values.dtype, full=values, verbose=verbose )
+            self._blocks.append( block )
+            return ( block.shared_id, block.shared_size, block.dtype, len(values) )
+
+        self._blocks  = []
+        self._columns = []
+        rest          = {}
+        for j, ( _, series ) in enumerate( df.items() ):
+            if shareable( series.dtype ):
+                self._columns.append( share( str(j), series.to_numpy() ) )
+            else:
+                self._columns.append( None )
+                rest[j] = series.reset_index(drop=True)
+        index = df.index
+        self._index_freq = None
+        if isinstance( index, pd.RangeIndex ):
+            self._index = ( index.start, index.stop, index.step )
+        elif not isinstance( index, pd.MultiIndex ) and shareable( index.dtype ):
+            self._index      = share( "index", index.to_numpy() )
+            self._index_freq = getattr( index, "freq", None )
+        else:
+            self._index = None
+            rest['index'] = index
+        self._labels     = df.columns
+        self._index_name = df.index.names if isinstance( index, pd.MultiIndex ) else df.index.name
+        self._rest       = SharedObject( rest, name + ".rest", verbose=verbose ) if len(rest) > 0 else None
+        self.shape       = df.shape
+
+    def __getstate__(self):
+        """ Pickle the handle, but not the blocks """
+        state = dict( self.__dict__ )
+        state['_blocks'] = []
+        return state
+
+    @property
+    def owner(self) -> bool:
+        """ Whether this object owns the shared blocks """
+        return len(self._blocks) > 0 or ( not self._rest is None and self._rest.owner )
+
+    def get(self):
+        """ Returns a read-only DataFrame backed by the shared blocks """
+        def attach( spec ):
+            shared_id, size, dtype, n = spec
+            return np.frombuffer( _map_readonly( shared_id, size ), dtype=dtype, count=n )
+        rest    = self._rest.get() if not self._rest is None else {}
+        columns = { j : attach( spec ) if not spec is None else rest[j] for j, spec in enumerate( self._columns ) }
+        if isinstance( self._index, tuple ) and len( self._index ) == 3:
+            index = pd.RangeIndex( *self._index )
+        elif not self._index is None:
+            values = attach( self._index )
+            if self._index_freq is None:
+                index = pd.Index( values, copy=False )
+            elif values.dtype.kind == "M":
+                index = pd.DatetimeIndex( values, freq=self._index_freq, copy=False )
+            else:
+                index = pd.TimedeltaIndex( values, freq=self._index_freq, copy=False )
+        else:
+            index = rest['index']
+        df = pd.DataFrame( columns, copy=False )
+        df.index   = index
+        df.columns = self._labels
+        if isinstance( index, pd.MultiIndex ):
+            df.index.names = self._index_name
+        else:
+            df.index.name  = self._index_name
+        return df
+
+    def unlink(self):
+        """ Unlink all shared blocks. DataFrames returned by get() remain valid """
+        for block in self._blocks:
+            block.close(unlink=True)
+        self._blocks = []
+        if not self._rest is None and self._rest.owner:
+            self._rest.unlink()
 
+    def __repr__(self) -> str:
+        return "SharedDataFrame(" + str(self.shape) + ")"
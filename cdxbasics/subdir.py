@@ -5,17 +5,19 @@ Hans Buehler 2020
 """
 
 from .logger import Logger
-from .util import CacheMode, uniqueHash48, plain, fmt_list, fmt_filename, uniqueLabelExt, namedUniqueHashExt, DEF_FILE_NAME_MAP
+from .util import CacheMode, uniqueHash48, json_plain_dump, json_plain_load, fmt_list, fmt_filename, uniqueLabelExt, namedUniqueHashExt, DEF_FILE_NAME_MAP
 _log = Logger(__file__)
 
 import os
 import os.path
+import io
 import uuid
 import threading
 import pickle
 import tempfile
 import shutil
 import datetime
+import time
 import inspect
 from collections.abc import Collection, Mapping, Callable
 from enum import Enum
@@ -25,6 +27,7 @@ from functools import update_wrapper
 from .prettydict import pdct
 from .verbose import Context
 from .version import Version
+from . import perf as perf
 
 try:
     import numpy as np
@@ -35,6 +38,11 @@ except ModuleNotFoundError:
     np = None
     jsonpickle = None
 
+try:
+    from . import npio as npio
+except ModuleNotFoundError:
+    npio = None
+
 try:
     import blosc as blosc
     BLOSC_MAX_BLOCK = 2147483631
@@ -108,6 +116,112 @@ class CacheTracker(object):
 class InitCacheInfo(object):
     pass
 
+# -------------------------------------------------
+# Binary section for numpy arrays in JSON_PICKLE files
+# -------------------------------------------------
+
+NPIO_HEADER = b"#npio "
+NPIO_ALIGN  = 64            # alignment of the binary section; npio.tofile() aligns the array data within it
+
+def _npio_align( pos : int ) -> int:
+    return ( (pos + NPIO_ALIGN - 1) // NPIO_ALIGN ) * NPIO_ALIGN
+
+class _NPIOWriter(object):
+    """
+    Collects numpy arrays which jsonpickle should not encode as text.
+    Arrays are later written with npio.tofile() into the binary section after the JSON text.
+    Each array record starts at the offset returned by add(), such that its data is aligned to NPIO_ALIGN bytes.
+    """
+    def __init__(self, threshold : int):
+        self.threshold = int(threshold)
+        self.arrays    = []
+        self.size      = 0
+
+    def accept(self, array) -> bool:
+        """ Whether 'array' should be written to the binary section """
+        return array.size > 0 and array.nbytes >= self.threshold and str(array.dtype) in npio.dtype_map
+
+    def add(self, array) -> int:
+        """ Register 'array' and return the offset of its record relative to the start of the binary section """
+        offset = self.size
+        self.arrays.append( (offset, np.ascontiguousarray(array)) )
+        self.size = offset + npio.header_size( array.ndim, offset ) + array.nbytes
+        return offset
+
+    def write(self, f):
+        """ Write the binary section into 'f', which must be positioned at its start """
+        base = f.tell()
+        for offset, array in self.arrays:
+            pad = base + offset - f.tell()
+            assert pad >= 0, ("Internal error: negative padding", pad)
+            f.write( bytes(pad) )
+            npio.tofile( f, array )
+
+class _NPIOReader(object):
+    """ Reads arrays written by _NPIOWriter from the binary section starting at 'base' in 'f' """
+    def __init__(self, f, base : int, mmap : bool):
+        self.f    = f
+        self.base = base
+        self.mmap = mmap
+
+    def get(self, offset : int):
+        self.f.seek( self.base + offset )
+        return npio.fromfile( self.f, mmap=self.mmap )
+
+if not jsonpickle is None:
+    class _NumpyNPIOHandler(jsonpickle_numpy.NumpyNDArrayHandlerView):
+        """
+        jsonpickle handler for numpy arrays which writes large arrays into the binary section of a JSON_PICKLE file.
+        If the jsonpickle context does not carry an '_npio' writer or reader, this handler behaves like the default one.
+        The class is registered rather than an instance, hence each jsonpickle Pickler or Unpickler uses its own handler and context.
+        """
+        def __init__(self, context = None):
+            super().__init__()  # same defaults as jsonpickle_numpy.register_handlers()
+            self.context = context
+
+        def flatten(self, obj, data):
+            sidecar = getattr(self.context, "_npio", None)
+            if sidecar is None or not sidecar.accept(obj):
+                return super().flatten(obj, data)
+            data['npio'] = sidecar.add(obj)
+            return data
+
+        def restore(self, data):
+            if not 'npio' in data:
+                return super().restore(data)
+            sidecar = getattr(self.context, "_npio", None)
+            if sidecar is None: raise IOError("Cannot restore numpy array: JSON refers to a binary section but none was found")
+            return sidecar.get( data['npio'] )
+
+_npio_handler_lock  = threading.Lock()
+_npio_handler_users = 0     # number of encodings or decodings which currently use _NumpyNPIOHandler
+_npio_handler_prev  = None  # handler registered for numpy arrays before _NumpyNPIOHandler
+
+class _NPIOHandlerScope(object):
+    """
+    Registers _NumpyNPIOHandler for numpy arrays while SubDir encodes or decodes a JSON_PICKLE file with a binary section.
+    The previous handler is restored when the last such operation finishes, hence other users of jsonpickle are not affected.
+    """
+    def __enter__(self):
+        global _npio_handler_users, _npio_handler_prev
+        with _npio_handler_lock:
+            if _npio_handler_users == 0:
+                _npio_handler_prev = jsonpickle.handlers.registry.get(np.ndarray)
+                jsonpickle.handlers.register(np.ndarray, _NumpyNPIOHandler, base=True)
+            _npio_handler_users += 1
+        return self
+
+    def __exit__(self, *kargs, **kwargs):
+        global _npio_handler_users, _npio_handler_prev
+        with _npio_handler_lock:
+            _npio_handler_users -= 1
+            if _npio_handler_users == 0:
+                jsonpickle.handlers.unregister(np.ndarray)
+                if not _npio_handler_prev is None:
+                    jsonpickle.handlers.register(np.ndarray, _npio_handler_prev, base=True)
+                _npio_handler_prev = None
+        return False
+
 class CacheInfo(object):
     pass
     
@@ -185,13 +299,17 @@ class SubDir(object):
             SubDir.PICKLE:
                 Use pickle
             SubDir.JSON_PLAIN:
-                Uses cdxbasics.util.plain() to convert data into plain Python objects and writes
-                this to disk as text. Loading back such files will result in plain Python objects,
-                but *not* the original objects
+                Uses cdxbasics.util.json_plain_dump() to convert data into plain Python objects as
+                cdxbasics.util.plain() does, and streams this to disk as text. Loading back such files will result
+                in plain Python objects, but *not* the original objects
             SubDir.JSON_PICKLE:
                 Uses the jsonpickle package to load/write data in somewhat readable text formats.
                 Data can be loaded back from such a file, but files may not be readable (e.g. numpy arrays
                 are written in compressed form).
+                Set SubDir.JSON_PICKLE_NPIO_THRESHOLD to a number of bytes to instead write numpy arrays of at least
+                that size in binary with cdxbasics.npio into a section after the JSON text. Set SubDir.JSON_PICKLE_NPIO_MMAP
+                to True to memory map such arrays when reading; on Windows, a file cannot be deleted or overwritten while
+                arrays mapped from it are alive.
             SubDir.BLOSC:
                 Uses https://www.blosc.org/python-blosc/ to compress data on-the-fly.
                 BLOSC is much faster than GZIP or ZLIB but is limited to 2GB data, sadly.
@@ -231,6 +349,9 @@ class SubDir(object):
 
     MAX_VERSION_BINARY_LEN = 128
 
+    JSON_PICKLE_NPIO_THRESHOLD = None   # if not None, numpy arrays with at least this many bytes are written in binary into JSON_PICKLE files
+    JSON_PICKLE_NPIO_MMAP = False       # whether to memory map such arrays when reading (copy-on-write)
+
     VER_NORMAL   = 0
     VER_CHECK    = 1
     VER_RETURN   = 2
@@ -735,7 +856,14 @@ class SubDir(object):
         # read content
         # delete existing files upon read error
         try:
-            return reader( key, fullFileName, default )
+            if not perf.is_enabled():
+                return reader( key, fullFileName, default )
+            size = os.path.getsize(fullFileName)
+            with perf.timed("subdir.read_seconds"):
+                r = reader( key, fullFileName, default )
+            perf.count("subdir.files_read")
+            perf.count("subdir.bytes_read", size)
+            return r
         except EOFError as e:
             try:
                 os.remove(fullFileName)
@@ -825,16 +953,19 @@ class SubDir(object):
                         return data
 
             elif fmt in [Format.JSON_PLAIN, Format.JSON_PICKLE]:
-                with open(fullFileName,"rt",encoding="utf-8") as f:
+                # JSON_PICKLE files may carry a binary section, hence read in binary
+                with open(fullFileName,"rb") as f:
                     # handle versioning
                     ok      = True
                     if not version is None:
-                        test_version = f.readline()
+                        test_version = f.readline().decode("utf-8")
                         if test_version[:2] != "# ":
                             raise EnvironmentError("Error reading '%s': file does not appear to contain a version (it should start with '# ')" % fullFileName)
                         test_version = test_version[2:]
                         if test_version[-1:] == "\n":
                             test_version = test_version[:-1]
+                        if test_version[-1:] == "\r":
+                            test_version = test_version[:-1]
                         if handle_version == SubDir.VER_RETURN:
                             return test_version
                         ok = (version == "*" or test_version == version)
@@ -844,10 +975,18 @@ class SubDir(object):
                         # read
                         if fmt == Format.JSON_PICKLE:
                             if jsonpickle is None: raise ModuleNotFoundError("jsonpickle")
-                            return jsonpickle.decode( f.read() )
+                            line = f.readline()
+                            if line[:len(NPIO_HEADER)] != NPIO_HEADER:
+                                return jsonpickle.decode( (line + f.read()).decode("utf-8") )
+                            if npio is None: raise ModuleNotFoundError("numpy")
+                            text    = f.read( int(line[len(NPIO_HEADER):]) ).decode("utf-8")
+                            context = jsonpickle.Unpickler()
+                            context._npio = _NPIOReader( f, _npio_align(f.tell()), mmap=self.JSON_PICKLE_NPIO_MMAP )
+                            with _NPIOHandlerScope():
+                                return jsonpickle.decode( text, context=context )
                         else:
                             assert fmt == Format.JSON_PLAIN, ("Internal error: unknown Format", fmt)
-                            return json.loads( f.read() )
+                            return json_plain_load( io.TextIOWrapper( f, encoding="utf-8" ) )
             else:
                 _log.throw("Unknown format '%s'", fmt )
 
@@ -1087,8 +1226,9 @@ class SubDir(object):
                 raise RuntimeError("Failed to generate temporary file for writing '%s': too many temporary files found. For example, this file already exists: '%s'" % ( fullFileName, fullTmpFile ) )
 
         # write
-        if not writer( key, fullTmpFile, obj ):
-            return False
+        with perf.timed("subdir.write_seconds"):
+            if not writer( key, fullTmpFile, obj ):
+                return False
         assert os.path.exists(fullTmpFile), ("Internal error: file does not exist ...?", fullTmpFile, fullFileName)
         try:
             if os.path.exists(fullFileName):
@@ -1099,6 +1239,9 @@ class SubDir(object):
             if raiseOnError:
                 raise e
             return False
+        if perf.is_enabled():
+            perf.count("subdir.files_written")
+            perf.count("subdir.bytes_written", os.path.getsize(fullFileName))
         return True
 
     def write( self, key : str,
@@ -1212,6 +1355,24 @@ class SubDir(object):
                             f.write(version_)
                         pickle.dump(obj,f,-1)
 
+                elif fmt == Format.JSON_PICKLE and not self.JSON_PICKLE_NPIO_THRESHOLD is None:
+                    if jsonpickle is None: raise ModuleNotFoundError("jsonpickle")
+                    if npio is None: raise ModuleNotFoundError("numpy")
+                    context       = jsonpickle.Pickler()
+                    context._npio = _NPIOWriter( self.JSON_PICKLE_NPIO_THRESHOLD )
+                    with _NPIOHandlerScope():
+                        text      = jsonpickle.encode( obj, context=context ).encode("utf-8")
+                    with open(fullFileName,"wb") as f:
+                        if not version is None:
+                            f.write( ("# " + version + "\n").encode("utf-8") )
+                        if len(context._npio.arrays) == 0:
+                            f.write( text )
+                        else:
+                            f.write( NPIO_HEADER + str(len(text)).encode("utf-8") + b"\n" )
+                            f.write( text )
+                            f.write( bytes( _npio_align(f.tell()) - f.tell() ) )
+                            context._npio.write( f )
+
                 elif fmt in [Format.JSON_PLAIN, Format.JSON_PICKLE]:
                     with open(fullFileName,"wt",encoding="utf-8") as f:
                         if not version is None:
@@ -1221,7 +1382,7 @@ class SubDir(object):
                             f.write( jsonpickle.encode(obj) )
                         else:
                             assert fmt == Format.JSON_PLAIN, ("Internal error: invalid Format", fmt)
-                            f.write( json.dumps( plain(obj, sorted_dicts=True, native_np=True, dt_to_str=True ), default=str ) )
+                            json_plain_dump( obj, f, sorted_dicts=True, dt_to_str=True )
 
                 else:
                     _log.throw("Internal error: invalid format '%s'", fmt)
@@ -2166,6 +2327,7 @@ class CacheCallable(object):
             # determine unique id_ for this function call
             # -------------------------------------------
             
+            hash_start = time.perf_counter() if perf.is_enabled() else None
             id_ = None
             if isinstance(self.id, str) and self.unique:
                 # if 'id' does not contain formatting codes, and the result is 'unique' then do not bother collecting
@@ -2232,6 +2394,9 @@ class CacheCallable(object):
                 else:
                     filename = uniqueNamedFileName( id_, name=name, **arguments )
 
+            if not hash_start is None:
+                perf.observe("cache.hash_seconds", time.perf_counter() - hash_start )
+
             # determine version, cache mode
             # ------------------
 
@@ -2260,11 +2425,14 @@ class CacheCallable(object):
                     if not track_cached_files is None:
                         track_cached_files += self.fullFileName(filename)
                     execute.cache_info.last_cached = True 
+                    perf.count("cache.hits")
                     if not self.debug_verbose is None:
                         self.debug_verbose.write(f"cache_callable({name}): read '{id_}' version 'version {version_}' from cache '{self.subdir.path+filename}'.")
                     return r
             
-            r = F(*args, **kwargs)
+            perf.count("cache.misses")
+            with perf.timed("cache.compute_seconds"):
+                r = F(*args, **kwargs)
             
             if override_cache_mode.write:
                 self.subdir.write(filename,r,version=version_)      
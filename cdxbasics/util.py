@@ -9,10 +9,16 @@ from functools import wraps
 import hashlib as hashlib
 import inspect as inspect
 import psutil as psutil
-from collections.abc import Mapping, Collection, Sequence
+from collections.abc import Mapping, Collection, Sequence, Callable
 from .prettydict import PrettyDict, OrderedDict
 import sys as sys
 import time as time
+import os as os
+import threading as threading
+import itertools as itertools
+import json as json
+import re as re
+import mmap as mmap
 from sortedcontainers import SortedDict
 from collections.abc import Mapping, Collection
 
@@ -106,47 +112,188 @@ def isFloat( o ):
 # python basics
 # =============================================================================
 
-def _get_recursive_size(obj, seen=None):
+_SIZEOF_ATOMIC = (int,float,bool,complex,str,bytes,type(None))
+
+def _slot_names( obj ) -> list:
+    """ Returns the names of all __slots__ members along the MRO of 'obj' """
+    names = []
+    for cls in type(obj).__mro__:
+        slots = cls.__dict__.get("__slots__", None)
+        if slots is None:
+            continue
+        slots = (slots,) if isinstance(slots, str) else slots
+        names += [ s for s in slots if not s in ["__dict__", "__weakref__"] ]
+    return names
+
+def _np_root( obj ) -> tuple:
     """
-    Recursive helper for sizeof
+    Returns the id of the object holding the memory of the numpy array 'obj', the size of the array at the root of 'obj',
+    and whether that memory is shared or memory mapped.
+    """
+    base = obj
+    while isinstance( base.base, np.ndarray ):
+        base = base.base
+    if base.flags.owndata or base.base is None:
+        return id(base), base.nbytes, False
+    # foreign buffer, e.g. bytes, mmap or shared memory
+    buffer = base.base
+    mapped = isinstance( buffer.obj if isinstance(buffer, memoryview) else buffer, mmap.mmap )
+    return id(buffer), base.nbytes, mapped
+
+def _sizeof_np( obj, seen : set, shared : bool ) -> int:
+    """
+    Size of a numpy array. The memory of the root buffer of a view is only counted once.
+    Memory of shared memory blocks or memory mapped files is only counted if 'shared' is True.
+    Note that sys.getsizeof() already includes the data of an array which owns its memory.
     """
-    if seen is None:
-        seen = set()  # Keep track of seen objects to avoid double-counting
-
-    # Get the size of the current object
     size = sys.getsizeof(obj)
+    if obj.flags.owndata:
+        return size
+    key, nbytes, mapped = _np_root(obj)
+    if not key in seen:
+        seen.add(key)
+        size += nbytes if shared or not mapped else 0
+    return size
 
-    # Avoid counting the same object twice
+def _pd_arrays( obj ) -> list:
+    """ Returns the numpy arrays holding the data of the pandas object 'obj' which can be accessed without copying """
+    parts = [ obj.iloc[:,i] for i in range(obj.shape[1]) ] if isinstance(obj, pd.DataFrame) else [ obj ] if isinstance(obj, pd.Series) else []
+    parts.append( obj if isinstance(obj, pd.Index) else obj.index )
+    return [ x.to_numpy(copy=False) for x in parts if isinstance(x.dtype, np.dtype) and x.dtype != object and not isinstance(x, (pd.RangeIndex, pd.MultiIndex)) ]
+
+def _sizeof_pd( obj, seen : set, shared : bool ) -> int:
+    """
+    Size of a pandas object using memory_usage(deep=True).
+    Numpy data already counted for other objects is not counted again, and data in shared memory only if 'shared' is True.
+    """
+    mem  = obj.memory_usage(deep=True)
+    size = int( mem if isinstance(mem, (int,np.integer)) else mem.sum() )
+    keys = set()
+    for x in _pd_arrays(obj):
+        key, _, mapped = _np_root(x)
+        if key in seen or ( mapped and not shared ):
+            size -= x.nbytes
+        keys.add(key)
+    seen.update(keys)
+    return size
+
+def _get_recursive_size(obj, seen : set = None, *, sample : bool = False, sample_size : int = 100, sample_threshold : int = 1000, shared : bool = True ) -> int:
+    """
+    Recursive helper for getsizeof()
+    """
+    if seen is None:
+        seen = set()  # Keep track of seen objects to avoid double-counting
     if id(obj) in seen:
         return 0
     seen.add(id(obj))
 
-    if isinstance( obj, np.ndarray ):
-        size += obj.nbytes
-    elif isinstance(obj, Mapping):
+    # atomic
+    if isinstance(obj, _SIZEOF_ATOMIC):
+        return sys.getsizeof(obj)
+
+    def rec(x):
+        if type(x) in _SIZEOF_ATOMIC:
+            # fast path for the elements of large containers
+            if id(x) in seen:
+                return 0
+            seen.add(id(x))
+            return sys.getsizeof(x)
+        return _get_recursive_size(x, seen, sample=sample, sample_size=sample_size, sample_threshold=sample_threshold, shared=shared)
+
+    # numpy
+    if not np is None and isinstance( obj, np.ndarray ):
+        return _sizeof_np(obj, seen, shared)
+    # pandas
+    if not pd is None and isinstance( obj, (pd.DataFrame, pd.Series, pd.Index) ):
+        return _sizeof_pd(obj, seen, shared)
+    # shared memory
+    if type(obj).__name__ == "ndsharedarray":
+        return sys.getsizeof(obj) + ( obj.shared_size if shared else 0 )
+    if type(obj).__name__ == "SharedMemory":
+        return sys.getsizeof(obj) + ( obj.size if shared else 0 )
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, Mapping):
+        n = len(obj)
+        if sample and n > sample_threshold:
+            step  = n // sample_size
+            items = list( itertools.islice( obj.items(), 0, step*sample_size, step ) )
+            if _is_homogeneous( [ k for k, _ in items ] ) and _is_homogeneous( [ v for _, v in items ] ):
+                smpl = sum( rec(k) + rec(v) for k, v in items )
+                return size + int( float(smpl) * float(n) / float(len(items)) )
         for key, value in obj.items():
-            size += _get_recursive_size(key, seen)
-            size += _get_recursive_size(value, seen)
-    elif isinstance(obj, Collection):
+            size += rec(key)
+            size += rec(value)
+        return size
+    if isinstance(obj, Collection):
+        n = len(obj)
+        if sample and n > sample_threshold:
+            step  = n // sample_size
+            items = [ obj[i] for i in range(0, step*sample_size, step) ] if isinstance(obj, Sequence) else list( itertools.islice( obj, 0, step*sample_size, step ) )
+            if _is_homogeneous( items ):
+                smpl = sum( rec(x) for x in items )
+                return size + int( float(smpl) * float(n) / float(len(items)) )
         for item in obj:
-            size += _get_recursive_size(item, seen)
-    else:
-        try:
-            size += _get_recursive_size( obj.__dict__, seen )
-        except:
-            pass
+            size += rec(item)
+        return size
+
+    # objects
+    dct = getattr(obj, "__dict__", None)
+    if not dct is None:
+        size += rec(dct)
+    for name in _slot_names(obj):
         try:
-            size += _get_recursive_size( obj.__slots__, seen )
-        except:
-            pass
+            size += rec( getattr(obj, name) )
+        except AttributeError:
+            pass # unassigned slot
     return size
 
-def getsizeof(obj):
+def _is_homogeneous( items : list ) -> bool:
+    """ Whether all 'items' are of the same type. Used to decide whether sampling is reasonable """
+    if len(items) == 0:
+        return False
+    tp = type(items[0])
+    return all( type(x) is tp for x in items )
+
+def getsizeof(obj, *, mode : str = "exact", sample_size : int = 100, sample_threshold : int = 1000, shared : bool = True ) -> int:
     """
-    Approximates the size of 'obj'.
-    In addition to sys.getsizeof this function also iterates through embedded containers.
+    Approximates the size of 'obj' in bytes.
+    In addition to sys.getsizeof this function also iterates through embedded containers and objects.
+
+    The following are handled explicitly:
+        numpy arrays: the buffer of views is attributed to the base array, and counted only once.
+        pandas: uses memory_usage(deep=True). Numpy data shared with arrays or other pandas objects is counted only once.
+        objects: both __dict__ and the values of __slots__ members are included.
+        shared memory: ndsharedarray and SharedMemory blocks are counted with the size of their shared block, see 'shared'.
+
+    Parameters
+    ----------
+        obj :
+            Object to assess.
+        mode : str
+            'exact' visits every element of every container.
+            'sample' estimates the size of containers with more than 'sample_threshold' elements from
+                     'sample_size' evenly spaced elements if the sampled elements all have the same type.
+                     This bounds the time spent on large homogeneous containers such as a dict of a million floats.
+        sample_size : int
+            Number of elements to sample in 'sample' mode.
+        sample_threshold : int
+            Minimum size of a container to be sampled in 'sample' mode.
+        shared : bool
+            Whether to include the memory held in shared memory blocks, including numpy arrays and pandas objects viewing
+            shared memory or memory mapped files. Set to False to only count process-private memory.
+
+    Returns
+    -------
+        Size in bytes.
     """
-    return _get_recursive_size(obj,None)    
+    mode = str(mode)
+    assert mode in ["exact", "sample"], ("'mode' must be 'exact' or 'sample'", mode)
+    sample_size      = int(sample_size)
+    sample_threshold = int(sample_threshold)
+    assert sample_size > 0, ("'sample_size' must be positive", sample_size)
+    assert sample_threshold >= sample_size, ("'sample_threshold' must not be less than 'sample_size'", sample_threshold, sample_size)
+    return _get_recursive_size(obj, None, sample=mode=="sample", sample_size=sample_size, sample_threshold=sample_threshold, shared=shared )
 
 # =============================================================================
 # string formatting
@@ -541,6 +688,310 @@ def plain( inn, *, sorted_dicts : bool = False,
     # nothing we can do
     raise TypeError(fmt("Cannot handle type %s", type(inn)))
 
+# =============================================================================
+# Streaming JSON for plain() data
+# =============================================================================
+
+JSON_CHUNK_SIZE = 1024*64       # number of numpy array elements converted to text at once
+JSON_BUFFER_SIZE = 1024*1024    # number of characters read at once
+_JSON_SCALAR_END = re.compile(r"[,\]}\s]")
+_JSON_OPEN       = re.compile(r"[\[{]")
+
+def _json_key( k ) -> str:
+    """ Encodes a dictionary key the way json.dumps() does """
+    if isinstance(k, str):
+        return json.dumps(k)
+    if k is None or isinstance(k, (bool,int,float)):
+        return json.dumps( json.dumps(k) )
+    if not np is None and isinstance(k, np.integer):
+        return json.dumps( str(int(k)) )
+    if not np is None and isinstance(k, np.floating):
+        return json.dumps( json.dumps(float(k)) )
+    raise TypeError(fmt("keys must be str, int, float, bool or None, not %s", type(k).__name__))
+
+def _json_write_np( f, array, chunk_size : int ):
+    """ Writes a numeric numpy array as nested JSON lists in chunks of at most 'chunk_size' elements """
+    if array.ndim == 0:
+        f.write( json.dumps( array.item() ) )
+    elif array.size <= chunk_size:
+        f.write( json.dumps( array.tolist() ) )
+    elif array.ndim == 1:
+        f.write("[")
+        for s in range(0, array.shape[0], chunk_size):
+            if s > 0:
+                f.write(", ")
+            f.write( json.dumps( array[s:s+chunk_size].tolist() )[1:-1] )
+        f.write("]")
+    else:
+        f.write("[")
+        for i in range(array.shape[0]):
+            if i > 0:
+                f.write(", ")
+            _json_write_np( f, array[i], chunk_size )
+        f.write("]")
+
+def json_plain_dump( obj, f, *, sorted_dicts : bool = True,
+                                dt_to_str    : bool = True,
+                                chunk_size   : int = JSON_CHUNK_SIZE ):
+    """
+    Writes 'obj' as JSON into the text file 'f' as if calling
+        f.write( json.dumps( plain( obj, sorted_dicts=sorted_dicts, native_np=True, dt_to_str=dt_to_str ), default=str ) )
+    but without first creating a converted copy of 'obj' or the full JSON string.
+
+    Numeric numpy arrays are encoded directly in chunks of 'chunk_size' elements, and dictionary keys are sorted
+    without materializing SortedDicts. In contrast to plain(), numpy integer and floating point scalars are written as numbers.
+
+    Parameters
+    ----------
+        obj          : object to write
+        f            : text file opened for writing, or any object with a write() function
+        sorted_dicts : whether to write dictionaries with sorted keys
+        dt_to_str    : whether to convert date times to strings
+        chunk_size   : number of numpy array elements converted to text at once
+
+    """
+    chunk_size = int(chunk_size)
+    assert chunk_size > 0, ("'chunk_size' must be positive", chunk_size)
+
+    def write( inn ):
+        # basics
+        if inn is None:
+            f.write("null")
+            return
+        if isinstance(inn, (str,bool,int,float)):
+            f.write( json.dumps(inn) )
+            return
+        if not np is None and isinstance(inn, np.generic):
+            if isinstance(inn, np.bool_):
+                inn = bool(inn)
+            elif isinstance(inn, np.integer):
+                inn = int(inn)
+            elif isinstance(inn, np.floating):
+                inn = float(inn)
+            f.write( json.dumps( inn, default=str ) )
+            return
+        if type(inn) is datetime.date:
+            f.write( json.dumps( str(inn) ) )
+            return
+        if isinstance(inn,(datetime.time,datetime.date,datetime.datetime)):
+            f.write( json.dumps( fmt_datetime(inn) if dt_to_str else str(inn) ) )
+            return
+        if not np is None and isinstance(inn,np.ndarray):
+            if inn.dtype.kind in "biuf":
+                _json_write_np( f, inn, chunk_size )
+            else:
+                write( inn.tolist() )
+            return
+        # can't handle functions --> None
+        if isFunction(inn) or isinstance(inn,property):
+            f.write("null")
+            return
+        # dictionaries
+        if isinstance(inn,Mapping):
+            keys  = sorted(inn) if sorted_dicts else inn
+            first = True
+            f.write("{")
+            for k in keys:
+                v = inn[k]
+                if isFunction(v) or isinstance(v,property):
+                    continue
+                if not first:
+                    f.write(", ")
+                first = False
+                f.write( _json_key(k) )
+                f.write(": ")
+                write(v)
+            f.write("}")
+            return
+        # pandas: see plain()
+        if not pd is None and isinstance(inn,pd.DataFrame):
+            f.write("null")
+            return
+        # lists, tuples and everything which looks like it --> lists
+        if isinstance(inn,Collection):
+            f.write("[")
+            for i, k in enumerate(inn):
+                if i > 0:
+                    f.write(", ")
+                write(k)
+            f.write("]")
+            return
+        # handle objects as dictionaries, removing all functions
+        if not getattr(inn,"__dict__",None) is None:
+            write(inn.__dict__)
+            return
+        # nothing we can do
+        raise TypeError(fmt("Cannot handle type %s", type(inn)))
+
+    write(obj)
+
+class _JSONStreamReader(object):
+    """
+    Incremental JSON parser for json_plain_load().
+    Reads 'f' in blocks; innermost lists and dictionaries are decoded in one go by the json package.
+    """
+
+    def __init__(self, f, buffer_size : int ):
+        self._f   = f
+        self._bs  = buffer_size
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._dec = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        """ Reads the next block. Returns False at the end of the file """
+        if self._eof:
+            return False
+        chunk = self._f.read(self._bs)
+        if len(chunk) == 0:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _error(self, msg : str ):
+        return json.JSONDecodeError(msg, self._buf, self._pos)
+
+    def _peek(self) -> str:
+        """ Skips white space and returns the next character, or "" at the end of the file """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in " \t\n\r":
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def _find_flat(self, close : str ) -> int:
+        """
+        Finds the 'close' which ends the list or dictionary at the current position if it contains no nested lists or dictionaries.
+        Reads further blocks only until 'close' or a nested '[' or '{' is found. Returns -1 if the list or dictionary is not flat
+        """
+        text, start, offset = self._buf, self._pos+1, -self._pos    # 'offset' is the position of text[0] relative to self._pos
+        parts = None
+        while True:
+            k = text.find( close, start )
+            m = _JSON_OPEN.search( text, start, k if k >= 0 else len(text) )
+            if not m is None or k >= 0 or self._eof:
+                break
+            chunk = self._f.read(self._bs)
+            if len(chunk) == 0:
+                self._eof = True
+                break
+            if parts is None:
+                parts = [ self._buf[self._pos:] ]
+            parts.append(chunk)
+            offset     += len(text)
+            text, start = chunk, 0
+        if not parts is None:
+            self._buf = "".join(parts)
+            self._pos = 0
+        return self._pos + offset + k if m is None and k >= 0 else -1
+
+    def _scalar(self):
+        """ Decodes a string, number, or constant """
+        if self._buf[self._pos] != '"':
+            # make sure numbers are not cut off at the end of the buffer
+            while _JSON_SCALAR_END.search(self._buf, self._pos) is None and self._fill():
+                pass
+        while True:
+            try:
+                value, self._pos = self._dec.raw_decode(self._buf, self._pos)
+                return value
+            except json.JSONDecodeError as e:
+                if not self._fill():
+                    raise e
+
+    def _flat(self, close : str ):
+        """
+        Attempts to decode the list or dictionary at the current position in one go if it contains no nested lists or dictionaries.
+        The buffer therefore never holds more than one such innermost list or dictionary, plus one block.
+        """
+        i = self._find_flat(close)
+        if i < 0:
+            return False, None
+        try:
+            value     = json.loads( self._buf[self._pos:i+1] )
+            self._pos = i+1
+            return True, value
+        except json.JSONDecodeError:
+            return False, None
+
+    def value(self):
+        """ Decodes the next value """
+        c = self._peek()
+        if c == "":
+            raise self._error("Expecting value")
+        if c == "[":
+            ok, value = self._flat("]")
+            return value if ok else self._array()
+        if c == "{":
+            ok, value = self._flat("}")
+            return value if ok else self._object()
+        return self._scalar()
+
+    def _array(self) -> list:
+        self._pos += 1
+        r = []
+        if self._peek() == "]":
+            self._pos += 1
+            return r
+        while True:
+            r.append( self.value() )
+            c = self._peek()
+            self._pos += 1
+            if c == "]":
+                return r
+            if c != ",":
+                raise self._error("Expecting ',' delimiter")
+
+    def _object(self) -> dict:
+        self._pos += 1
+        r = {}
+        if self._peek() == "}":
+            self._pos += 1
+            return r
+        while True:
+            if self._peek() != '"':
+                raise self._error("Expecting property name enclosed in double quotes")
+            k = self._scalar()
+            if self._peek() != ":":
+                raise self._error("Expecting ':' delimiter")
+            self._pos += 1
+            r[k] = self.value()
+            c = self._peek()
+            self._pos += 1
+            if c == "}":
+                return r
+            if c != ",":
+                raise self._error("Expecting ',' delimiter")
+
+def json_plain_load( f, *, buffer_size : int = JSON_BUFFER_SIZE ):
+    """
+    Reads one JSON value from the text file 'f', for example one written with json_plain_dump().
+    In contrast to json.loads( f.read() ) the file is read incrementally in blocks of 'buffer_size' characters,
+    so the text of the file is not held in memory in its entirety: at any time, at most one innermost list or dictionary
+    (one without nested lists or dictionaries, e.g. an array written by json_plain_dump()) and one block are buffered.
+
+    Parameters
+    ----------
+        f           : text file opened for reading, or any object with a read() function
+        buffer_size : number of characters read at once
+
+    Returns
+    -------
+        Plain Python object
+    """
+    buffer_size = int(buffer_size)
+    assert buffer_size > 0, ("'buffer_size' must be positive", buffer_size)
+    reader = _JSONStreamReader( f, buffer_size )
+    r      = reader.value()
+    if reader._peek() != "":
+        raise reader._error("Extra data")
+    return r
+
 # =============================================================================
 # Hashing / unique representatives
 # =============================================================================
@@ -1185,6 +1636,9 @@ class TrackTiming(object):
         else:
             self._tracked[text] = dt
         self._current = now
+        profiler = active_profiler()
+        if not profiler is None:
+            profiler.record( text, int(dt*1E9) )
         return self
 
     def __str__(self):
@@ -1229,9 +1683,16 @@ class Timer(object):
         print(f"This took {t}.")
     """
     
-    def __init__(self):
-        self.time = time.time()
-        self.intv = None
+    def __init__(self, label : str = None):
+        """
+        Start the timer.
+        If 'label' is not None and a Profiler is active, then using the timer in a 'with' statement
+        also records a span named 'label' with that profiler.
+        """
+        self.time  = time.time()
+        self.intv  = None
+        self.label = label
+        self._span = None
         
     def reset(self):
         self.time = time.time()
@@ -1239,6 +1700,10 @@ class Timer(object):
         
     def __enter__(self):
         self.reset()
+        profiler = active_profiler() if not self.label is None else None
+        if not profiler is None:
+            self._span = profiler.span(self.label)
+            self._span.__enter__()
         return self
     
     def __str__(self):
@@ -1284,10 +1749,292 @@ class Timer(object):
         return self.minutes / 60.
 
     def __exit__(self, *kargs, **wargs):
+        if not self._span is None:
+            self._span.__exit__(*kargs)
+            self._span = None
         return False
 
+# =============================================================================
+# Profiling
+# =============================================================================
+
+_active_profilers = threading.local()
+
+def _active_stack() -> list:
+    """ Returns the stack of profilers activated in the current thread """
+    stack = getattr(_active_profilers, "stack", None)
+    if stack is None:
+        stack = []
+        _active_profilers.stack = stack
+    return stack
+
+def active_profiler():
+    """ Returns the Profiler active in the current thread, or None. See Profiler.activate() """
+    stack = _active_stack()
+    return stack[-1] if len(stack) > 0 else None
+
+class _ProfilerSpan(object):
+    """ Context manager for Profiler.span() """
+
+    def __init__(self, profiler, label : str, root : tuple = None ):
+        self._profiler = profiler
+        self._label    = str(label)
+        self._root     = root
+
+    def __enter__(self):
+        stack = self._profiler._stack()
+        base  = stack[-1][0] if len(stack) > 0 else ( self._root if not self._root is None else () )
+        stack.append( ( base + (self._label,), time.perf_counter_ns() ) )
+        return self
+
+    def __exit__(self, *kargs, **kwargs):
+        end   = time.perf_counter_ns()
+        stack = self._profiler._stack()
+        path, start = stack.pop()
+        self._profiler._add( path, end-start, start )
+        return False
+
+class Profiler(object):
+    """
+    Hierarchical profiler.
+    Records nested spans with perf_counter_ns() and keeps call count, total, minimum and maximum time per span.
+    Spans are identified by their path, i.e. the labels of all enclosing spans in the same thread.
+
+    Usage:
+
+        profiler = Profiler(trace=True)
+
+        with profiler.span("load"):
+            with profiler.span("parse"):
+                ...
+
+        @profiler.profile
+        def f(x):
+            ...
+
+        print( profiler.tree() )
+        profiler.write_chrome_trace("trace.json")   # open with chrome://tracing or https://ui.perfetto.dev
+
+    Activate a profiler with 'with profiler.activate():' to also record
+        - timed messages of verbose.Context.write_t() used in a 'with' statement,
+        - items tracked with TrackTiming,
+        - jobs executed with jcpool.JCPool, including spans recorded inside worker processes.
+
+    The profiler is thread safe. Spans started in a thread without enclosing span are recorded at the top level.
+    Use state() and merge() to aggregate profiles from other processes.
+    """
+
+    def __init__(self, *, trace : bool = False, max_events : int = 1000000 ):
+        """
+        Create a new profiler.
+
+        Parameters
+        ----------
+            trace : bool
+                Whether to keep all individual spans for write_chrome_trace(). Otherwise only statistics are kept.
+            max_events : int
+                Maximum number of individual spans kept if 'trace' is True.
+        """
+        self._lock       = threading.Lock()
+        self._local      = threading.local()
+        self._trace      = bool(trace)
+        self._max_events = int(max_events)
+        self.reset()
+
+    def reset(self):
+        """ Clear all statistics and events """
+        with self._lock:
+            self._stats  = OrderedDict()
+            self._events = []
+
+    def _stack(self) -> list:
+        """ Returns the span stack of the current thread """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = []
+            self._local.stack = stack
+        return stack
+
+    def _add(self, path : tuple, ns : int, start : int, pid : int = None, tid : int = None ):
+        """ Add a completed span """
+        with self._lock:
+            s = self._stats.get(path, None)
+            if s is None:
+                self._stats[path] = [ 1, ns, ns, ns ]
+            else:
+                s[0] += 1
+                s[1] += ns
+                s[2] = min(s[2], ns)
+                s[3] = max(s[3], ns)
+            if self._trace and len(self._events) < self._max_events:
+                self._events.append( ( path, start, ns,
+                                       os.getpid() if pid is None else pid,
+                                       threading.get_ident() if tid is None else tid ) )
+
+    # recording
+    # ---------
+
+    @property
+    def path(self) -> tuple:
+        """ Path of the current span in the current thread """
+        stack = self._stack()
+        return stack[-1][0] if len(stack) > 0 else ()
+
+    def span(self, label : str ):
+        """
+        Returns a context manager which records the time spent in a 'with' block as a span named 'label'
+        nested in the current span of the calling thread.
+        """
+        return _ProfilerSpan( self, label )
 
+    def _span(self, label : str, root : tuple ):
+        """ Returns a span named 'label' which is nested in 'root' if the calling thread has no current span """
+        return _ProfilerSpan( self, label, root )
 
+    def record(self, label : str, ns : int ):
+        """ Record an already completed span of 'ns' nanoseconds named 'label' nested in the current span of the calling thread """
+        ns = int(ns)
+        self._add( self.path + (str(label),), ns, time.perf_counter_ns() - ns )
+
+    def profile(self, F : Callable = None, *, label : str = None ):
+        """
+        Decorator which records each call to 'F' as a span.
+        By default the span is named after the qualified name of the function.
 
+            @profiler.profile
+            def f(x):
+                ...
 
+            @profiler.profile(label="g")
+            def g(x):
+                ...
+        """
+        def decorate(F):
+            l = label if not label is None else getattr(F, "__qualname__", type(F).__name__)
+            @wraps(F)
+            def wrapper(*args, **kwargs):
+                with _ProfilerSpan( self, l ):
+                    return F(*args, **kwargs)
+            return wrapper
+        return decorate if F is None else decorate(F)
+
+    # activation
+    # ----------
+
+    def activate(self):
+        """
+        Activate this profiler in the current thread until the returned context manager exits. Usage:
+
+            with profiler.activate():
+                ...
+        """
+        return _ProfilerActivation(self)
+
+    # aggregation
+    # -----------
+
+    def state(self) -> dict:
+        """ Returns a pickle'able copy of the recorded statistics and events. See merge() """
+        with self._lock:
+            return dict( stats=OrderedDict( (k, list(v)) for k, v in self._stats.items() ),
+                         events=list(self._events) )
+
+    def merge(self, state : dict, prefix : tuple = () ):
+        """
+        Merge the 'state' of another profiler into this one, for example one recorded in a worker process.
+        All paths of 'state' are prefixed by 'prefix'.
+        """
+        prefix = tuple(prefix)
+        with self._lock:
+            for path, (count, total, mn, mx) in state['stats'].items():
+                path = prefix + tuple(path)
+                s = self._stats.get(path, None)
+                if s is None:
+                    self._stats[path] = [ count, total, mn, mx ]
+                else:
+                    s[0] += count
+                    s[1] += total
+                    s[2] = min(s[2], mn)
+                    s[3] = max(s[3], mx)
+            if self._trace:
+                for path, start, ns, pid, tid in state['events']:
+                    if len(self._events) >= self._max_events:
+                        break
+                    self._events.append( ( prefix + tuple(path), start, ns, pid, tid ) )
+
+    # reporting
+    # ---------
 
+    @property
+    def stats(self) -> OrderedDict:
+        """
+        Returns a dictionary which maps the path of each span to a dictionary with entries 'count',
+        and 'total', 'min', 'max' in seconds.
+        """
+        with self._lock:
+            return OrderedDict( ( path, dict( count=count, total=total*1E-9, min=mn*1E-9, max=mx*1E-9 ) ) for path, (count, total, mn, mx) in self._stats.items() )
+
+    def tree(self, indent : int = 2 ) -> str:
+        """
+        Returns a text tree of all spans with their count, total, minimum and maximum time.
+        Children are listed in order of decreasing total time.
+        """
+        stats    = self.stats
+        children = {}
+        for path in stats:
+            for i in range(len(path)):
+                lst = children.setdefault( path[:i], [] )
+                if not path[:i+1] in lst:
+                    lst.append( path[:i+1] )
+        rows = []
+        def rec( path, depth ):
+            kids = children.get(path, [])
+            kids = sorted( kids, key=lambda k : -stats[k]['total'] if k in stats else 0. )
+            for k in kids:
+                s = stats.get(k, None)
+                if s is None:
+                    rows.append( ( " "*(indent*depth) + k[-1], "", "", "", "" ) )
+                else:
+                    rows.append( ( " "*(indent*depth) + k[-1], str(s['count']), fmt_seconds(s['total']), fmt_seconds(s['min']), fmt_seconds(s['max']) ) )
+                rec( k, depth+1 )
+        rec( (), 0 )
+        rows   = [ ("span", "count", "total", "min", "max") ] + rows
+        widths = [ max( len(r[i]) for r in rows ) for i in range(5) ]
+        return "\n".join( r[0].ljust(widths[0]) + "".join( "  " + r[i].rjust(widths[i]) for i in range(1,5) ) for r in rows )
+
+    def __str__(self):
+        return self.tree()
+
+    def chrome_trace(self) -> dict:
+        """
+        Returns recorded spans in Chrome trace event format, see https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+        Requires 'trace' to be True.
+        Timestamps of spans recorded in different processes are comparable as perf_counter_ns() uses a system wide clock.
+        """
+        with self._lock:
+            events = list(self._events)
+        t0 = min( e[1] for e in events ) if len(events) > 0 else 0
+        return dict( traceEvents=[ dict( name=path[-1], cat="/".join(path[:-1]), ph="X", ts=(start-t0)*1E-3, dur=ns*1E-3, pid=pid, tid=tid )
+                                   for path, start, ns, pid, tid in events ],
+                     displayTimeUnit="ms" )
+
+    def write_chrome_trace(self, file : str ):
+        """ Write chrome_trace() as JSON to 'file'. The result can be viewed with chrome://tracing or https://ui.perfetto.dev """
+        with open(file, "wt", encoding="utf-8") as f:
+            json.dump( self.chrome_trace(), f )
+
+class _ProfilerActivation(object):
+    """ Context manager for Profiler.activate() """
+
+    def __init__(self, profiler : Profiler ):
+        self._profiler = profiler
+
+    def __enter__(self):
+        _active_stack().append(self._profiler)
+        return self._profiler
+
+    def __exit__(self, *kargs, **kwargs):
+        stack = _active_stack()
+        assert len(stack) > 0 and stack[-1] is self._profiler, ("Profiler activations must be nested")
+        stack.pop()
+        return False
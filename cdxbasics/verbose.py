@@ -5,7 +5,7 @@ Hans Buehler 2022
 """
 
 from multiprocessing import Queue
-from .util import fmt, Timer
+from .util import fmt, Timer, active_profiler
 from .crman import CRMan, Callable
 from .logger import Logger
 _log = Logger(__file__)
@@ -159,9 +159,13 @@ class Context(object):
             with verbose.write_t("Doing something... ", end='') as t:
                 # do something
                 verbose.write("done; this took {t}.", head=False)
+
+        If a util.Profiler is active, then such a 'with' block is also recorded as a span named after the message.
         """
         self.report( 0, message, *args, end=end, head=head, **kwargs )
-        return Timer()
+        if active_profiler() is None:
+            return Timer()
+        return Timer( label=fmt(message, *args, **kwargs).strip() )
 
     def report( self, level : int, message : str, *args, end : str = "\n", head : bool = True, **kwargs ):
         """
@@ -8,6 +8,9 @@ import unittest
 import pickle
 import cdxbasics.util as util
 import cdxbasics.np as cdxnp
+import cdxbasics.npio as npio
+import cdxbasics.sharedarray as sharedarray
+import cdxbasics.jcpool as jcpool
 import cdxbasics.config as config
 import cdxbasics.kwargs as mdl_kwargs
 import cdxbasics.subdir as mdl_subdir
@@ -19,6 +22,8 @@ import datetime as datetime
 import dataclasses as dataclasses
 import numpy as np
 import hashlib as hashlib
+import threading as threading
+import multiprocessing as multiprocessing
 
 if False:
     import importlib as imp
@@ -288,6 +293,171 @@ class CDXBasicsTest(unittest.TestCase):
         self.assertFalse( util.isFunction("str") )
         self.assertFalse( util.isFunction(1.0) )
 
+    def test_getsizeof(self):
+
+        import sys as sys
+        a = np.zeros((1000,))
+        self.assertEqual( util.getsizeof(a), sys.getsizeof(a) )
+        # views share the buffer of their base
+        r = util.getsizeof([a, a[1:], a[2:]])
+        self.assertEqual( r, sys.getsizeof([]) + 3*8 + sys.getsizeof(a) + 2*sys.getsizeof(a[1:]) )
+
+        class S(object):
+            __slots__ = ('x', 'y')
+            def __init__(self):
+                self.x = np.zeros((100,))
+        s = S()
+        self.assertEqual( util.getsizeof(s), sys.getsizeof(s) + sys.getsizeof(s.x) )
+
+        df = pd.DataFrame({'a':a})
+        self.assertEqual( util.getsizeof(df), int(df.memory_usage(deep=True).sum()) )
+        # the data of a column is shared with the frame
+        r = util.getsizeof([df, df['a']])
+        self.assertEqual( r, sys.getsizeof([]) + 2*8 + int(df.memory_usage(deep=True).sum()) + int(df['a'].memory_usage(deep=True)) - a.nbytes )
+
+        # shared memory
+        x  = sharedarray.sharedarray( "test_cdxbasics_sz", (1000,), create=True, dtype=np.float64, full=1. )
+        try:
+            self.assertEqual( util.getsizeof(x.array), sys.getsizeof(x.array) + 8000 )
+            self.assertEqual( util.getsizeof(x.array, shared=False), sys.getsizeof(x.array) )
+            df = pd.DataFrame( x.array, columns=['a'], copy=False )
+            self.assertEqual( util.getsizeof(df, shared=False), int(df.memory_usage(deep=True).sum()) - 8000 )
+        finally:
+            x.close(unlink=True)
+
+        # sampling
+        d  = { i: float(i) for i in range(10000) }
+        e  = util.getsizeof(d)
+        sm = util.getsizeof(d, mode="sample")
+        self.assertLess( abs(sm-e)/e, 0.01 )
+
+    def test_json_plain(self):
+
+        import io as io
+        import json as json
+        x = dict( b=np.arange(1000.).reshape((10,100)), a=[1.5, "a]b}c", {"q":None}, (2,3)], c=datetime.date(2023,1,2), f=np.float32(0.5) )
+        f = io.StringIO()
+        util.json_plain_dump( x, f, chunk_size=7 )
+        txt = f.getvalue()
+        self.assertEqual( txt, json.dumps( util.plain(x, sorted_dicts=True, native_np=True, dt_to_str=True), default=str ).replace('"0.5"', '0.5') )
+        for buffer_size in [1,5,1000]:
+            self.assertEqual( util.json_plain_load( io.StringIO(txt), buffer_size=buffer_size ), json.loads(txt) )
+        with self.assertRaises(json.JSONDecodeError):
+            util.json_plain_load( io.StringIO('[1,2'), buffer_size=1 )
+        # the buffer holds at most one innermost array
+        x = { "x%ld" % i : np.arange(10000.) for i in range(20) }
+        f = io.StringIO()
+        util.json_plain_dump( x, f )
+        class Reader(util._JSONStreamReader):
+            peak = 0
+            def value(self):
+                r = super().value()
+                Reader.peak = max( Reader.peak, len(self._buf) )
+                return r
+        reader = Reader( io.StringIO(f.getvalue()), 4096 )
+        r      = reader.value()
+        self.assertEqual( list(r), sorted(x) )
+        self.assertTrue( np.array_equal( r['x19'], x['x19'] ) )
+        self.assertLess( Reader.peak, len(f.getvalue())/10 )
+
+    def test_profiler(self):
+
+        import time as time
+        profiler = util.Profiler(trace=True)
+        with profiler.activate():
+            ctx = verbose.Context("quiet")
+            with ctx.write_t("outer"):
+                for i in range(3):
+                    with profiler.span("inner"):
+                        time.sleep(0.001)
+                tt = util.TrackTiming()
+                tt += "tracked"
+        self.assertIsNone( util.active_profiler() )
+        stats = profiler.stats
+        self.assertEqual( list(stats), [ ("outer","inner"), ("outer","tracked"), ("outer",) ] )
+        self.assertEqual( stats[("outer","inner")]['count'], 3 )
+        self.assertGreaterEqual( stats[("outer","inner")]['min'], 0.001 )
+        self.assertLessEqual( stats[("outer","inner")]['total'], stats[("outer",)]['total'] )
+        self.assertEqual( len( profiler.chrome_trace()['traceEvents'] ), 5 )
+
+        # activation is per thread
+        with profiler.activate():
+            seen = []
+            t = threading.Thread( target=lambda : seen.append( util.active_profiler() ) )
+            t.start()
+            t.join()
+        self.assertEqual( seen, [None] )
+
+        # jobs run by JCPool in threads and in processes
+        for threads in [True, False]:
+            pprof = util.Profiler()
+            pool     = jcpool.JCPool( 2, threading=threads )
+            with pprof.activate():
+                with pprof.span("pool"):
+                    r = pool.parallel_to_list( [ pool.delayed(_profiled_job)( i ) for i in range(4) ] )
+            pool.terminate()
+            self.assertEqual( sorted(r), [0,1,2,3] )
+            self.assertEqual( pprof.stats[("pool","_profiled_job")]['count'], 4 )
+            self.assertEqual( pprof.stats[("pool","_profiled_job","work")]['count'], 4 )
+
+        merged = util.Profiler()
+        merged.merge( profiler.state(), prefix=("worker",) )
+        merged.merge( profiler.state(), prefix=("worker",) )
+        self.assertEqual( merged.stats[("worker","outer","inner")]['count'], 6 )
+        self.assertEqual( merged.tree().split("\n")[1].split()[0], "worker" )
+        self.assertEqual( merged.tree().split("\n")[2].split()[0], "outer" )
+
+    def test_perf(self):
+
+        import cdxbasics.perf as perf
+        events = []
+        def hook(kind, name, value):
+            events.append( (kind, name) )
+        perf.subscribe(hook)
+        perf.count("test.disabled")
+        self.assertEqual( len(events), 0 )
+        perf.enable()
+        try:
+            perf.observe("test.prior", 1.)
+            before = perf.snapshot()
+            sub = SubDir("!/.tmp_test_for_cdxbasics.perf")
+            sub.write("x", np.zeros((100,)))
+            sub.read("x")
+            perf.count("test.count", 2)
+            perf.observe("test.value", 3.)
+            perf.observe("test.value", 5.)
+            perf.observe("test.prior", 2.)
+            diff = perf.snapshot() - before
+        finally:
+            perf.disable()
+            perf.unsubscribe(hook)
+            sub.eraseEverything(keepDirectory=False)
+        self.assertEqual( diff.counters["subdir.files_written"], 1 )
+        self.assertEqual( diff.counters["subdir.files_read"], 1 )
+        self.assertEqual( diff.counters["subdir.bytes_read"], diff.counters["subdir.bytes_written"] )
+        self.assertEqual( diff.counters["test.count"], 2 )
+        h = diff.histograms["test.value"]
+        self.assertEqual( (h.count, h.total, h.min, h.max, h.mean), (2, 8., 3., 5., 4.) )
+        self.assertEqual( h.buckets, {2:1, 3:1} )
+        h = diff.histograms["test.prior"]
+        self.assertEqual( (h.count, h.total, h.min, h.max), (1, 2., None, None) )
+        self.assertEqual( str(h), "count 1, total 2, mean 2" )
+        self.assertIn( ("observe", "subdir.write_seconds"), events )
+        self.assertEqual( diff.as_dict()["test.count"], 2 )
+
+        # jcpool
+        pool = jcpool.JCPool( 2, threading=True )
+        perf.enable()
+        try:
+            before = perf.snapshot()
+            pool.parallel_to_list( [ pool.delayed(abs)( -i ) for i in range(3) ] )
+            diff = perf.snapshot() - before
+        finally:
+            perf.disable()
+            pool.terminate()
+        self.assertEqual( diff.counters["jcpool.tasks"], 3 )
+        self.assertEqual( diff.histograms["jcpool.time_to_result_seconds"].count, 3 )
+
     def test_fmt(self):
         self.assertEqual(fmt("number %d %d",1,2),"number 1 2")
         self.assertEqual(fmt("number %(two)d %(one)d",one=1,two=2),"number 2 1")
@@ -553,6 +723,46 @@ class CDXBasicsTest(unittest.TestCase):
         r = sub.read("test", None)
         self.assertEqual( list(x), list(r) )
         self.assertEqual(sub.ext, ".jpck")
+        y = dict( a=np.random.normal(size=(100,10)), b=np.arange(3), c=[np.ones((1000,),dtype=np.float32)] )
+        SubDir.JSON_PICKLE_NPIO_THRESHOLD = 1024
+        try:
+            sub.write("test", y, version="1")
+            for mmap in [True, False]:
+                SubDir.JSON_PICKLE_NPIO_MMAP = mmap
+                r = sub.read("test", None, version="1", raiseOnError=True)
+                self.assertTrue( np.all( r['a'] == y['a'] ) )
+                self.assertTrue( np.all( r['b'] == y['b'] ) )
+                self.assertTrue( np.all( r['c'][0] == y['c'][0] ) )
+                self.assertEqual( r['c'][0].dtype, np.float32 )
+            self.assertEqual( sub.get_version("test"), "1" )
+            # concurrent encodings and decodings use their own binary sections
+            import sys as sys
+            def write_read( i ):
+                ok = True
+                for _ in range(5):
+                    z = dict( a=np.full((200,), float(i)), b=[np.arange(300)+i] )
+                    sub.write("t%ld" % i, z)
+                    r = sub.read("t%ld" % i, None, raiseOnError=True)
+                    ok = ok and np.all( r['a'] == z['a'] ) and np.all( r['b'][0] == z['b'][0] )
+                results[i] = bool(ok)
+            results  = [False]*8
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1E-6)
+            try:
+                threads = [ threading.Thread( target=write_read, args=(i,) ) for i in range(8) ]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            finally:
+                sys.setswitchinterval(interval)
+            self.assertEqual( results, [True]*8 )
+        finally:
+            SubDir.JSON_PICKLE_NPIO_THRESHOLD = None
+            SubDir.JSON_PICKLE_NPIO_MMAP = False
+        # the binary section handler is only registered while SubDir encodes or decodes
+        import jsonpickle as jsonpickle
+        self.assertIsNot( jsonpickle.handlers.registry.get(np.ndarray), mdl_subdir._NumpyNPIOHandler )
         sub.eraseEverything()
 
         sub = SubDir("!/.tmp_test_for_cdxbasics.subdir", fmt=SubDir.JSON_PLAIN )
@@ -560,6 +770,13 @@ class CDXBasicsTest(unittest.TestCase):
         r = sub.read("test", None)
         self.assertEqual( list(x), list(r) )
         self.assertEqual(sub.ext, ".json")
+        y = dict( b=np.arange(12.).reshape((3,4)), a=[1, "x]y}", None], d=datetime.datetime(2023,1,2,3,4,5) )
+        sub.write("test", y, version="1")
+        r = sub.read("test", None, version="1")
+        self.assertEqual( list(r), ['a','b','d'] )
+        self.assertEqual( r['a'], y['a'] )
+        self.assertEqual( r['b'], y['b'].tolist() )
+        self.assertEqual( r['d'], util.fmt_datetime(y['d']) )
         sub.eraseEverything()
 
         sub = SubDir("!/.tmp_test_for_cdxbasics.subdir", fmt=SubDir.BLOSC )
@@ -725,6 +942,507 @@ class CDXBasicsTest(unittest.TestCase):
         self.assertEqual(q1, r)
         self.assertEqual(q2, r)
 
+        # quantiles along other axes, and fused median/MAD
+        q5 = cdxnp.quantile( P, x.T, (0.1,0.5,0.7), axis=1 ).tolist()
+        q5 = [ [ round(_, 4) for _ in l ] for l in q5 ]
+        self.assertEqual(q5, [ list(_) for _ in zip(*r) ])
+        def mad_ref( P, x ):
+            med = cdxnp.median( P, x )
+            return 1.4826 * cdxnp.median( P, np.abs( x - med ) )
+        med, mad = cdxnp.median_mad( P, x, axis=0 )
+        self.assertEqual( [ round(_, 4) for _ in med.tolist() ], r1 )
+        for i in range(3):
+            self.assertAlmostEqual( mad[i], mad_ref( P, x[:,i] ) )
+            self.assertAlmostEqual( cdxnp.mad( P, x, axis=0 )[i], mad[i] )
+
+        # binned means
+        y  = np.sort( x[:10,0] )
+        Py = P[:10]
+        m, s = cdxnp.mean_std_bins( y, 3 )
+        self.assertEqual( m.shape, (3,) )
+        for i, (a,b) in enumerate( [(0,3),(3,6),(6,10)] ):
+            self.assertAlmostEqual( m[i], np.mean(y[a:b]) )
+            self.assertAlmostEqual( s[i], np.std(y[a:b]) )
+            self.assertAlmostEqual( cdxnp.mean_bins( y, 3 )[i], m[i] )
+            self.assertAlmostEqual( cdxnp.mean_bins( y, 3, P=Py )[i], np.sum(Py[a:b]*y[a:b])/np.sum(Py[a:b]) )
+        m = cdxnp.mean_bins( y, [2,5,5,7] )
+        self.assertAlmostEqual( m[0], np.mean(y[2:5]) )
+        self.assertTrue( np.isnan(m[1]) )
+        self.assertAlmostEqual( m[2], np.mean(y[5:7]) )
+        m = cdxnp.mean_bins( y, [0,5,10,10] )
+        self.assertAlmostEqual( m[1], np.mean(y[5:]) )
+        self.assertTrue( np.isnan(m[2]) )
+        self.assertTrue( np.allclose( m, cdxnp.mean_std_bins( y, [0,5,10,10] )[0], equal_nan=True ) )
+        m, s = cdxnp.mean_std_bins( x.astype(np.float32), 2, axis=0 )
+        self.assertEqual( m.shape, (2,3) )
+        self.assertEqual( m.dtype, np.float32 )
+        self.assertAlmostEqual( float(s[1,2]), float(np.std(x[50:,2])), places=5 )
+
+        # weighted covariance
+        Pn  = P / np.sum(P)
+        z   = x[:,:2] + 10.
+        C   = cdxnp.wcov( Pn, z, x[:,2:], block_size=31 )
+        R   = np.cov( x.T, aweights=Pn, bias=True )
+        self.assertEqual( C.shape, (3,3) )
+        self.assertTrue( np.allclose( C, R ) )
+        self.assertTrue( np.allclose( cdxnp.wmean( Pn, z, block_size=31 ), np.sum( Pn[:,np.newaxis]*z, axis=0 ) ) )
+        self.assertTrue( np.allclose( cdxnp.wcov( Pn, z, meanX=np.zeros(2) ), ( Pn[:,np.newaxis]*z ).T @ z ) )
+        self.assertEqual( cdxnp.wcov( Pn, z.astype(np.float32) ).dtype, np.float32 )
+        y   = np.concatenate( [ x[:,2:], x[:,:1]**2 ], axis=1 )
+        XtX, XtY, YtY = cdxnp.wcov_blocks( Pn, z, y )
+        R   = np.cov( np.concatenate( [ z, y ], axis=1 ).T, aweights=Pn, bias=True )
+        self.assertTrue( np.allclose( XtX, R[:2,:2] ) and np.allclose( XtY, R[:2,2:] ) and np.allclose( YtY, R[2:,2:] ) )
+        XtoZ, YtoZ = cdxnp.orth_project( XtX, XtY, YtY )
+        self.assertEqual( XtoZ.shape[0], 2 )
+        self.assertEqual( YtoZ.shape[0], 2 )
+        Z   = z @ XtoZ + y @ YtoZ
+        self.assertTrue( np.allclose( cdxnp.wcov( Pn, Z, y )[:2], np.eye(2,4) ) )
+        u, s, vt = cdxnp.robust_svd( XtX, symmetric=True )
+        self.assertTrue( np.allclose( s, cdxnp.robust_svd( XtX )[1] ) )
+        self.assertTrue( np.allclose( u @ np.diag(s) @ vt, XtX ) )
+        stack = cdxnp.orth_project( np.stack( [XtX, 2.*XtX] ), np.stack( [XtY, XtY] ), np.stack( [YtY, YtY] ) )
+        for i, XtXi in enumerate( [XtX, 2.*XtX] ):
+            for A, B in zip( stack, cdxnp.orth_project( XtXi, XtY, YtY ) ):
+                self.assertTrue( np.allclose( A[i], B ) )
+        XtoZ, YtoZ = cdxnp.orth_project( XtX[:1,:1], XtY[:1,:1], YtY[:1,:1] )
+        self.assertEqual( XtoZ.shape, (1,1) )
+
+        # compilation
+        from numba.core.registry import CPUDispatcher
+        self.assertTrue( cdxnp.warmup() >= 0. )
+        kernels  = { n : k for n, k in vars(cdxnp).items() if isinstance(k, CPUDispatcher) }
+        compiled = { n for n, k in kernels.items() if len(k.signatures) > 0 }
+        # kernels loaded from numba's cache contain the code of the kernels they call, which are then not compiled separately
+        cached   = [ k for k in kernels.values() if sum( k.stats.cache_hits.values() ) > 0 ]
+        inlined  = { n for n in kernels if any( n in k.py_func.__code__.co_names for k in cached ) }
+        self.assertEqual( set(kernels) - compiled - inlined, set() )
+
+        # streaming moments
+        acc = cdxnp.Moments( axis=0 )
+        for i in range(0,101,17):
+            acc.add( x[i:i+17], P[i:i+17] )
+        self.assertEqual( acc.count, 101 )
+        self.assertTrue( np.allclose( acc.mean(), cdxnp.mean( P, x, axis=0 ) ) )
+        self.assertTrue( np.allclose( acc.var(), cdxnp.var( P, x, axis=0 ) ) )
+        self.assertTrue( np.allclose( acc.err(keepdims=True), cdxnp.err( P, x, axis=0, keepdims=True ) ) )
+        a1  = cdxnp.Moments( axis=0, cov=True ).add( np.concatenate( [ z, y ], axis=1 )[:40], Pn[:40] )
+        a2  = cdxnp.Moments( axis=0, cov=True ).add( np.concatenate( [ z, y ], axis=1 )[40:], Pn[40:] )
+        acc = a1 + pickle.loads( pickle.dumps( a2 ) )
+        for A, B in zip( acc.cov_blocks(2), (XtX, XtY, YtY) ):
+            self.assertTrue( np.allclose( A, B ) )
+        acc = cdxnp.Moments().add( x )
+        self.assertAlmostEqual( acc.std(), np.std(x) )
+
+        # fused european pricer
+        ttm = np.array([0.,0.5,1.,2.])[:,np.newaxis]
+        K   = np.linspace(0.6,1.4,5)
+        cp  = np.array([1.,-1.,1.,-1.,1.])
+        r   = cdxnp.np_european( ttm=ttm, vols=0.2, K=K, cp=cp, F=1.1 )
+        q   = cdxnp.nb_european( ttm=ttm, vols=0.2, K=K, cp=cp, F=1.1, chunk_size=3 )
+        self.assertEqual( list(q), list(r) )
+        for k in r:
+            self.assertTrue( np.allclose( q[k], r[k] ), k )
+        out = np.zeros( (4,5), dtype=np.float32 )
+        q   = cdxnp.nb_european( ttm=ttm, vols=0.2, K=K, cp=cp, F=1.1, greeks=["fdelta"], dtype=np.float32, out=dict(price=out) )
+        self.assertEqual( list(q), ["price", "fdelta"] )
+        self.assertTrue( q.price is out )
+        self.assertEqual( q.fdelta.dtype, np.float32 )
+        self.assertTrue( np.allclose( q.fdelta, r.fdelta, atol=1E-6 ) )
+        with self.assertRaises(AssertionError):
+            cdxnp.nb_european( ttm=-1., vols=0.2, K=1., cp=1. )
+
+        # implied volatilities
+        vols = np.array([0.5,0.2,0.3,0.8,1.6])
+        p    = cdxnp.np_european( ttm=ttm[1:], vols=vols, K=K, cp=cp, F=1.1, price_only=True )
+        r    = cdxnp.nb_implied_vol( price=p, ttm=ttm[1:], K=K, cp=cp, F=1.1, return_info=True, chunk_size=7 )
+        self.assertTrue( np.all( r.converged ) )
+        self.assertTrue( np.allclose( r.vols, vols[np.newaxis,:] + 0.*ttm[1:] ) )
+        v    = cdxnp.nb_implied_vol( price=[0.,0.1,-1.,2.], ttm=1., K=1., cp=1. )
+        self.assertEqual( v[0], 0. )
+        self.assertAlmostEqual( float( cdxnp.np_european( ttm=1., vols=v[1], K=1., cp=1., price_only=True ) ), 0.1 )
+        self.assertTrue( np.all( np.isnan( v[2:] ) ) )
+
+        # rolling estimators for many series
+        ts  = np.cumsum( x, axis=0 )
+        ts[7,0] += 10.
+        loc, dis, otl = cdxnp.robust_rolling_ew_2d( ts, window=[10,20,30], init=5 )
+        for j, w in enumerate([10,20,30]):
+            l, d, o = cdxnp.robust_rolling_ew( ts[:,j].copy(), w, 5 )
+            self.assertTrue( np.allclose( loc[:,j], l ) and np.allclose( dis[:,j], d ) and np.all( otl[:,j] == o ) )
+        self.assertTrue( otl[7,0] )
+        l, d    = cdxnp.rolling_ew_std( ts[:,1].copy(), 20, 5 )
+        loc, vol = cdxnp.rolling_ew_std_2d( ts, 20, init=5 )
+        self.assertTrue( np.allclose( loc[:,1], l ) and np.allclose( vol[:,1], d ) )
+        dt  = np.linspace(1.,2.,len(ts))/255.
+        l, d, o = cdxnp.robust_rolling_dt_ew( ts[:,2].copy(), dt, 0.1, scale_by_dt=True )
+        loc, dis, otl = cdxnp.robust_rolling_dt_ew_2d( ts, dt, 0.1, scale_by_dt=True )
+        self.assertTrue( np.allclose( loc[:,2], l ) and np.allclose( dis[:,2], d ) and np.all( otl[:,2] == o ) )
+        gap = ts[:,:1].copy()
+        gap[20:30] = np.nan
+        loc, dis, otl = cdxnp.robust_rolling_ew_2d( gap, 20, 5 )
+        l, d, o = cdxnp.robust_rolling_ew( np.concatenate( [ ts[:20,0], ts[30:,0] ] ), 20, 5 )
+        self.assertTrue( np.allclose( np.concatenate( [ loc[:20,0], loc[30:,0] ] ), l ) )
+        self.assertEqual( loc[25,0], loc[19,0] )
+        loc, dis, otl = cdxnp.robust_rolling_dt_ew_2d( gap, dt, 0.1, init=5 )
+        dtg     = np.concatenate( [ dt[:20], [ np.sum( dt[20:31] ) ], dt[31:] ] )      # time elapsed over the gap adds to the next step
+        l, d, o = cdxnp.robust_rolling_dt_ew( np.concatenate( [ ts[:20,0], ts[30:,0] ] ), dtg, 0.1, init=5 )
+        self.assertTrue( np.allclose( np.concatenate( [ loc[:20,0], loc[30:,0] ] ), l ) )
+        self.assertTrue( np.allclose( np.concatenate( [ dis[:20,0], dis[30:,0] ] ), d ) )
+
+        # online robust filter
+        l, d, o = cdxnp.robust_rolling_dt_ew( ts[:,0].copy(), dt, 0.1, init=5, normalize_by_dt=True )
+        ew      = cdxnp.RobustRollingDtEW( 0.1, init=5, normalize_by_dt=True )
+        res     = []
+        for i in range(0,len(ts),3):
+            res.append( ew.update( ts[i:i+3,0], dt[i:i+3] ) )
+            ew = pickle.loads( pickle.dumps( ew ) )
+        self.assertTrue( ew.initialized )
+        self.assertEqual( ew.count, len(ts) )
+        self.assertTrue( np.array_equal( np.concatenate( [ _[0] for _ in res ] )[5:], l[5:] ) )
+        self.assertTrue( np.array_equal( np.concatenate( [ _[1] for _ in res ] )[5:], d[5:] ) )
+        self.assertTrue( np.array_equal( np.concatenate( [ _[2] for _ in res ] ), o ) )
+
+    def test_npio(self):
+
+        sub  = SubDir("!/.tmp_test_for_cdxbasics.npio", eraseEverything=True )
+        sub.createDirectory()
+        file = sub.fullFileName("x", ext="bin")
+        x    = np.random.default_rng(1).normal(size=(7,3,5)).astype(np.float32)
+
+        npio.tofile( file, x )
+        self.assertEqual( npio.read_shape_dtype( file ), ( x.shape, "float32" ) )
+        self.assertTrue( np.array_equal( npio.fromfile( file ), x ) )
+
+        # memory mapped
+        m = npio.fromfile( file, mmap=True, read_only=True )
+        self.assertTrue( isinstance(m, np.memmap) )
+        self.assertTrue( np.array_equal( m, x ) )
+        self.assertFalse( m.flags.writeable )
+        self.assertEqual( m.offset % npio.NPIO_ALIGN, 0 )
+        del m
+        m = npio.fromfile( file, mmap=True, validate_shape=x.shape )
+        m[0,0,0] = 1000.   # copy-on-write
+        self.assertTrue( np.array_equal( npio.fromfile( file ), x ) )
+        del m
+
+        # several arrays in one file
+        with open( file, "wb" ) as f:
+            f.write( b"123" )
+            npio.tofile( f, x )
+            npio.tofile( f, np.arange(3) )
+            npio.tofile( f, np.zeros((0,2)) )
+        with open( file, "rb" ) as f:
+            f.read(3)
+            m = npio.fromfile( f, mmap=True )
+            self.assertEqual( m.offset % npio.NPIO_ALIGN, 0 )
+            self.assertTrue( np.array_equal( m, x ) )
+            self.assertEqual( list(npio.fromfile( f, mmap=True )), [0,1,2] )
+            self.assertEqual( npio.fromfile( f, mmap=True ).shape, (0,2) )
+            del m
+
+        # files without version
+        with open( file, "wb" ) as f:
+            f.write( (2).to_bytes(2,"big") + (2).to_bytes(4,"big") + (3).to_bytes(4,"big") + npio.dtype_map["int64"].to_bytes(1,"big") )
+            f.write( np.arange(6).tobytes() )
+        self.assertTrue( np.array_equal( npio.fromfile( file ), np.arange(6).reshape((2,3)) ) )
+        self.assertTrue( np.array_equal( npio.fromfile( file, mmap=True ), np.arange(6).reshape((2,3)) ) )
+
+        # rows
+        npio.tofile( file, x )
+        self.assertTrue( np.array_equal( npio.fromfile( file, rows=slice(2,5) ), x[2:5] ) )
+        self.assertTrue( np.array_equal( npio.fromfile( file, rows=slice(-2,None), mmap=True ), x[-2:] ) )
+
+        # compressed
+        y = np.cumsum( np.random.default_rng(2).normal(size=(1000,4)), axis=0 ).round(2)
+        for threads in [1,3]:
+            npio.tofile( file, y, compression="zstd", chunk_rows=64, threads=threads )
+            self.assertEqual( npio.read_shape_dtype( file ), ( y.shape, "float64" ) )
+            self.assertTrue( np.array_equal( npio.fromfile( file, threads=threads ), y ) )
+            for rows in [ slice(0,1), slice(63,65), slice(100,700), slice(-3,None), slice(5,5) ]:
+                self.assertTrue( np.array_equal( npio.fromfile( file, rows=rows, threads=threads ), y[rows] ) )
+        with self.assertRaises(Exception):
+            npio.fromfile( file, mmap=True )
+        import blosc as blosc
+        nthreads = blosc.set_nthreads(2)
+        npio.tofile( file, y, compression="zstd", chunk_rows=64, threads=3 )
+        self.assertTrue( np.array_equal( npio.fromfile( file, threads=3 ), y ) )
+        self.assertEqual( blosc.set_nthreads(nthreads), 2 )     # global blosc settings are left alone
+        with open( file, "wb" ) as f:
+            npio.tofile( f, y, compression="lz4" )
+            npio.tofile( f, np.zeros((0,3)), compression="lz4" )
+            npio.tofile( f, x )
+        with open( file, "rb" ) as f:
+            self.assertTrue( np.array_equal( npio.fromfile( f ), y ) )
+            self.assertEqual( npio.fromfile( f ).shape, (0,3) )
+            self.assertTrue( np.array_equal( npio.fromfile( f ), x ) )
+
+        # raw files read in parallel ranges
+        z   = np.arange(1001.)
+        min_bytes = npio.NPIO_PARALLEL_MIN_BYTES
+        npio.NPIO_PARALLEL_MIN_BYTES = 1000
+        try:
+            with open( file, "wb" ) as f:
+                npio.tofile( f, z )
+                npio.tofile( f, x )
+            with open( file, "rb" ) as f:
+                self.assertTrue( np.array_equal( npio.fromfile( f, threads=4 ), z ) )
+                self.assertTrue( np.array_equal( npio.fromfile( f, threads=4 ), x ) )
+            self.assertTrue( np.array_equal( npio.fromfile( file, rows=slice(3,900), threads=4 ), z[3:900] ) )
+        finally:
+            npio.NPIO_PARALLEL_MIN_BYTES = min_bytes
+
+        # archive
+        file = sub.fullFileName("a", ext="npa")
+        with npio.Archive( file, "w" ) as arc:
+            arc['x'] = x
+            arc.write( 'y', y, compression="lz4" )
+            self.assertTrue( np.array_equal( arc['x'], x ) )
+        with npio.Archive( file, "a" ) as arc:
+            self.assertEqual( list(arc), ['x', 'y'] )
+            arc['z'] = np.arange(3)
+            with self.assertRaises(Exception):
+                arc['x'] = x
+            # until close() the archive keeps its previous content
+            arc._f.flush()
+            with npio.Archive( file ) as old:
+                self.assertEqual( list(old), ['x', 'y'] )
+                self.assertTrue( np.array_equal( old['y'], y ) )
+        with npio.Archive( file ) as arc:
+            self.assertEqual( len(arc), 3 )
+            self.assertEqual( arc.shape_dtype('y'), ( y.shape, "float64" ) )
+            self.assertTrue( np.array_equal( arc['y'], y ) )
+            self.assertEqual( list(arc['z']), [0,1,2] )
+            m = arc.read( 'x', mmap=True, read_only=True )
+            self.assertEqual( m.offset % npio.NPIO_ALIGN, 0 )
+            self.assertTrue( np.array_equal( m, x ) )
+            del m
+            self.assertTrue( np.array_equal( arc.read( 'y', rows=slice(10,20) ), y[10:20] ) )
+            with self.assertRaises(Exception):
+                arc['w'] = x
+
+        # an archive survives a failure while appending
+        arc = npio.Archive( file, "a" )
+        arc['w'] = x
+        arc._f.close()
+        with npio.Archive( file, "a" ) as arc:
+            self.assertEqual( list(arc), ['x', 'y', 'z'] )
+            arc['v'] = y
+        with npio.Archive( file ) as arc:
+            self.assertEqual( list(arc), ['x', 'y', 'z', 'v'] )
+            self.assertTrue( np.array_equal( arc['v'], y ) )
+            self.assertTrue( np.array_equal( arc['x'], x ) )
+
+        # streaming
+        file = sub.fullFileName("w", ext="bin")
+        with npio.ArrayWriter( file ) as w:
+            w.extend( y[i:i+300] for i in range(0,600,300) )
+            self.assertEqual( w.shape, (600,4) )
+        self.assertEqual( npio.read_shape_dtype( file ), ( (600,4), "float64" ) )
+        with npio.ArrayWriter( file, "a" ) as w:
+            w.write( y[600:] )
+        self.assertTrue( np.array_equal( npio.fromfile( file ), y ) )
+        self.assertEqual( [ len(_) for _ in npio.iterchunks( file, 300 ) ], [300,300,300,100] )
+        self.assertTrue( np.array_equal( np.concatenate( list( npio.iterchunks( file, 128 ) ) ), y ) )
+        npio.tofile( file, y, compression="zstd", chunk_rows=100 )
+        readheader = npio._readheader_chunks
+        headers    = []
+        npio._readheader_chunks = lambda f : headers.append(1) or readheader(f)
+        try:
+            self.assertTrue( np.array_equal( np.concatenate( list( npio.iterchunks( file, 150 ) ) ), y ) )
+        finally:
+            npio._readheader_chunks = readheader
+        self.assertEqual( len(headers), 1 )     # the chunk index is read only once
+        with open( file, "wb" ) as f:
+            npio.tofile( f, y, compression="zstd", chunk_rows=400 )
+            npio.tofile( f, x )
+        with open( file, "rb" ) as f:
+            self.assertEqual( [ len(_) for _ in npio.iterchunks( f ) ], [400,400,200] )
+            self.assertTrue( np.array_equal( npio.fromfile( f ), x ) )
+        with self.assertRaises(Exception):
+            npio.ArrayWriter( file, "a" )
+
+        sub.eraseEverything()
+
+    def test_sharedarray(self):
+
+        sub  = SubDir("!/.tmp_test_for_cdxbasics.sharedarray", eraseEverything=True )
+        sub.createDirectory()
+        file = sub.fullFileName("x", ext="bin")
+        x    = np.arange(12.).reshape((4,3))
+        npio.tofile( file, x )
+
+        # load file into shared memory, and attach to it
+        a = sharedarray.shared_fromfile( file, "test_cdxbasics_x" )
+        b = sharedarray.shared_fromfile( file, "test_cdxbasics_x", read_only=True )
+        self.assertTrue( np.array_equal( a.array, x ) )
+        a[0,0] = 100.
+        self.assertEqual( b[0,0], 100. )
+        self.assertFalse( b.array.flags.writeable )
+        c = sharedarray.shared_fromfile( file, "test_cdxbasics_y", rows=slice(1,3), threads=2 )
+        self.assertTrue( np.array_equal( c.array, x[1:3] ) )
+        with self.assertRaises(Exception):
+            sharedarray.shared_fromfile( file, "test_cdxbasics_z", validate_dtype="float32" )
+        b.close()
+        a.close(unlink=True)
+        c.close(unlink=True)
+        # attaching to an existing block leaves the file after the array
+        y = np.arange(6.)
+        for compression in [None, "lz4"]:
+            with open( file, "wb" ) as f:
+                npio.tofile( f, x, compression=compression )
+                npio.tofile( f, y )
+            with open( file, "rb" ) as f:
+                a = sharedarray.shared_fromfile( f, "test_cdxbasics_x" )
+                self.assertTrue( np.array_equal( npio.fromfile( f ), y ) )
+            with open( file, "rb" ) as f:
+                b = sharedarray.shared_fromfile( f, "test_cdxbasics_x" )
+                self.assertTrue( np.array_equal( npio.fromfile( f ), y ) )
+            b.close()
+            a.close(unlink=True)
+
+        # pickling by name
+        a = sharedarray.sharedarray( "test_cdxbasics_p", (1000,), create=True, dtype=np.float64, full=1. )
+        s = pickle.dumps(a)
+        self.assertLess( len(s), 1000 )
+        b = pickle.loads(s)
+        b[0] = 2.
+        self.assertEqual( a[0], 2. )
+        self.assertTrue( a.owner )
+        self.assertFalse( b.owner )
+        with self.assertRaises(Exception):
+            b.close(unlink=True)
+        b.close()
+        # pickling by value
+        a.pickle_by_value = True
+        s = pickle.dumps(a)
+        self.assertGreater( len(s), 8000 )
+        a.close(unlink=True)
+        b = pickle.loads(s)
+        self.assertTrue( b.owner )
+        self.assertEqual( b[0], 2. )
+        b.close(unlink=True)
+        # attach from child processes, which share our resource tracker
+        a = sharedarray.sharedarray( "test_cdxbasics_mp", (100,), create=True, dtype=[('x','f8'),('n','i4')], full=None )
+        a.array['x'] = 1.
+        with multiprocessing.get_context("spawn").Pool(2) as pool:
+            self.assertEqual( pool.map( _shared_child_sum, [(a,0),(a,1)] ), [100.,100.] )
+        self.assertEqual( list( a.array['n'][:3] ), [1,2,0] )
+        self.assertEqual( len( sharedarray.shared_blocks( "test_cdxbasics_mp" ) ), 1 )
+        a.close(unlink=True)
+        self.assertEqual( len( sharedarray.shared_blocks( "test_cdxbasics_mp" ) ), 0 )
+
+        # registry
+        with sharedarray.SharedMemoryRegistry( "test_cdxbasics_r_", budget=10000, sweep=True ) as registry:
+            a = sharedarray.sharedarray( "a", (100,), create=True, dtype=np.float64 )
+            self.assertEqual( a.shared_id, "test_cdxbasics_r_a(100,)[float64]" )
+            self.assertIs( sharedarray.active_registry(), registry )
+            self.assertEqual( registry.usage(), a.shared_size )
+            with self.assertRaises(MemoryError):
+                sharedarray.sharedarray( "b", (2000,), create=True, dtype=np.float64 )
+            b = pickle.loads( pickle.dumps( a ) )
+            self.assertEqual( b.shared_id, a.shared_id )
+            b.close()
+        self.assertIsNone( sharedarray.active_registry() )
+        self.assertEqual( len( sharedarray.shared_blocks( "test_cdxbasics_r_" ) ), 0 )
+        a.close(unlink=True)
+        # blocks created by workers count towards the budget, and terminating the pool unlinks them
+        registry = sharedarray.SharedMemoryRegistry( "test_cdxbasics_jc_", budget=3*832+100 )
+        pool     = jcpool.JCPool( 2, shared_registry=registry )
+        ids      = pool.parallel_to_list( [ pool.delayed(_registry_child)( registry, i ) for i in range(6) ] )
+        self.assertEqual( len( [ _ for _ in ids if not _ is None ] ), 3 )
+        self.assertEqual( len( registry.blocks() ), 3 )
+        pool.terminate()
+        self.assertEqual( len( sharedarray.shared_blocks( "test_cdxbasics_jc_" ) ), 0 )
+
+        # objects
+        obj = PrettyOrderedDict( x=np.arange(1000.), y=dict( z=np.ones((3,4),dtype=np.float32), t="text" ), df=pd.DataFrame( dict(a=np.arange(5.)) ) )
+        h   = sharedarray.SharedObject( obj )
+        s   = pickle.dumps( h )
+        self.assertLess( len(s), 1000 )
+        r   = pickle.loads( s ).get()
+        self.assertTrue( np.array_equal( r.x, obj.x ) )
+        self.assertFalse( r.x.flags.writeable )
+        self.assertEqual( r.y['t'], "text" )
+        self.assertTrue( r.df.equals( obj.df ) )
+        h.unlink()
+        self.assertEqual( r.y['z'].sum(), 12. )
+        h   = pickle.loads( pickle.dumps( sharedarray.SharedObject( np.arange(10), transfer=True ) ) )
+        self.assertEqual( list( h.get( unlink=True ) ), list(range(10)) )
+        with self.assertRaises(FileNotFoundError):
+            h.get()
+
+        # ring buffer
+        dtype = [('time','f8'),('price','f4')]
+        ring  = sharedarray.SharedRingBuffer( "test_cdxbasics_ring", 7, dtype, consumers=2 )
+        ticks = np.zeros( (100,), dtype=dtype )
+        ticks['time']  = np.arange(100)
+        ticks['price'] = np.arange(100)*2
+        other = pickle.loads( pickle.dumps( ring ) )
+        self.assertEqual( ring.put( ticks, block=False ), 7 )
+        self.assertEqual( ring.put( ticks[7:], timeout=0.01 ), 0 )
+        self.assertTrue( np.array_equal( other.get( 0, 3 ), ticks[:3] ) )
+        self.assertEqual( ring.put( ticks[7:], block=False ), 0 )     # consumer 1 did not read anything yet
+        self.assertEqual( len( other.get( 1 ) ), 7 )
+        self.assertEqual( ring.put( ticks[7:], block=False ), 3 )
+        self.assertEqual( len( other.get( 1, block=False ) ), 3 )
+        self.assertEqual( len( other.get( 1, block=False ) ), 0 )
+        self.assertEqual( len( other.get( 1, timeout=0.01 ) ), 0 )
+        results = {}
+        def consume( i ):
+            results[i] = np.concatenate( [ ticks[:10] if i == 1 else other.get( 0, 7 ) ] + list( other.batches( i, 5 ) ) )
+        threads = [ threading.Thread( target=consume, args=(i,) ) for i in range(2) ]
+        for t in threads:
+            t.start()
+        for i in range(10,100,13):
+            ring.put( ticks[i:i+13] )
+        ring.finish()
+        for t in threads:
+            t.join()
+        self.assertTrue( np.array_equal( results[0], ticks[3:] ) )
+        self.assertTrue( np.array_equal( results[1], ticks ) )
+        other.close()
+        ring.close(unlink=True)
+        # consumers in other processes
+        ring  = sharedarray.SharedRingBuffer( "test_cdxbasics_ring_mp", 7, dtype, consumers=2 )
+        with multiprocessing.get_context("spawn").Pool(2) as pool:
+            results = pool.map_async( _ring_consume, [(ring,0),(ring,1)] )
+            for i in range(0,100,9):
+                ring.put( ticks[i:i+9] )
+            ring.finish()
+            for r in results.get( timeout=60 ):
+                self.assertTrue( np.array_equal( r, ticks ) )
+        ring.close(unlink=True)
+
+        # data frames
+        df = pd.DataFrame( dict( x=np.arange(10)*0.5, s=[ "s%ld" % i for i in range(10) ], d=pd.date_range("2023-01-01", periods=10) ),
+                           index=pd.Index( np.arange(10)*2, name="k" ) )
+        sdf = sharedarray.SharedDataFrame( df, "test_cdxbasics_df" )
+        h   = pickle.loads( pickle.dumps( sdf ) )
+        self.assertTrue( sdf.owner )
+        self.assertFalse( h.owner )
+        r  = h.get()
+        pd.testing.assert_frame_equal( r, df )
+        self.assertFalse( r['x'].to_numpy().flags.writeable )
+        with self.assertRaises(ValueError):
+            r.iloc[0,0] = 1.
+        h  = sharedarray.SharedDataFrame( df.reset_index(drop=True), "test_cdxbasics_df2" )
+        self.assertEqual( h.get()['x'].sum(), 22.5 )
+        self.assertEqual( list( h.get().index ), list(range(10)) )
+        h.unlink()
+        sdf.unlink()
+        self.assertEqual( r['x'].sum(), 22.5 )
+        df = pd.DataFrame( dict( d=np.repeat( pd.date_range("2023-01-01", periods=3, freq="B"), 2 ), k=["a","b"]*3, x=np.arange(6.) ) )
+        df = df.pivot_table( index="d", columns="k", values=["x"] )
+        self.assertIsInstance( df.columns, pd.MultiIndex )
+        df.index.freq = "B"
+        h  = sharedarray.SharedDataFrame( df, "test_cdxbasics_df3" )
+        r  = pickle.loads( pickle.dumps( h ) ).get()
+        pd.testing.assert_frame_equal( r, df )
+        self.assertEqual( r.index.freq, df.index.freq )
+        h.unlink()
+
+        sub.eraseEverything()
+
     def test_verbose(self):
 
         quiet = verbose.quiet
@@ -768,6 +1486,34 @@ class CDXBasicsTest(unittest.TestCase):
         self.assertEqual( uniqueHash( verbose1 ), uniqueHash( verbose2 ) )
 
 
+def _shared_child_sum( args ):
+    """ Attach to a pickled ndsharedarray in a child process """
+    a, i = args
+    a.array['n'][i] = i+1
+    s = float( a.array['x'].sum() )
+    a.close()
+    return s
+
+def _registry_child( registry, i ):
+    """ Create a shared block of 832 bytes with the prefix of 'registry' in a worker process """
+    with registry:
+        try:
+            a = sharedarray.sharedarray( "w%ld" % i, (100,), create=True, dtype=np.float64, full=float(i) )
+        except MemoryError:
+            return None
+        a.close()
+        return a.shared_id
+
+def _profiled_job( i ):
+    """ Record a span with the profiler active in the worker """
+    with util.active_profiler().span("work"):
+        return i
+
+def _ring_consume( args ):
+    """ Read all records of a SharedRingBuffer in a child process """
+    ring, consumer = args
+    return np.concatenate( list( ring.batches( consumer, 5 ) ) )
+
 @version("1.0")
 def f(x):
     return x